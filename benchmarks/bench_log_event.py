@@ -0,0 +1,47 @@
+"""Time spent in log_event on the request thread, with the events built inline or by EVENT_WORKERS.
+
+Usage: python benchmarks/bench_log_event.py [requests] [body items]
+"""
+import sys
+import time
+from common import start_collector, make_handler, make_body, percentile
+from moesiftornado import MoesifMiddleware
+
+
+def mask(event_model):
+    # A mask hook walking the parsed body, as the events are built with their models
+    if isinstance(event_model.request.body, dict):
+        for item in event_model.request.body.get('items', []):
+            item.pop('name', None)
+    return event_model
+
+
+def run(event_workers, requests, body):
+    middleware = MoesifMiddleware({
+        'APPLICATION_ID': 'benchmark',
+        'EVENT_WORKERS': event_workers,
+        'MASK_EVENT_MODEL': mask,
+        'CONFIG_REFRESH_INTERVAL': 0,
+    })
+    handlers = [make_handler(body) for _ in range(requests)]
+    durations = []
+    for handler in handlers:
+        start_time = time.perf_counter()
+        middleware.log_event(handler)
+        durations.append(time.perf_counter() - start_time)
+        # Requests arrive over time, leaving the workers time to build the events
+        time.sleep(0.001)
+    report = middleware.close(30)
+    print('EVENT_WORKERS=%d  log_event p50 %.3f ms  p99 %.3f ms  flushed %d  dropped %d' % (
+        event_workers, percentile(durations, 0.5) * 1e3, percentile(durations, 0.99) * 1e3,
+        report['flushed'], report['dropped']))
+
+
+if __name__ == '__main__':
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    body = make_body(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    collector = start_collector()
+    print('%d requests with a %d KB JSON body and a mask hook' % (requests, len(body) // 1024))
+    for event_workers in (0, 4):
+        run(event_workers, requests, body)
+    print('collector received %d events in %d batches' % (collector.events, collector.batches))
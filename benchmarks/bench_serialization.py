@@ -0,0 +1,66 @@
+"""Serialization of a batch: EventModel objects with jsonpickle, against event records with the EventSerializer.
+
+Usage: python benchmarks/bench_serialization.py [events]
+"""
+import json
+import sys
+import timeit
+from common import make_handler, make_body
+from moesifapi.api_helper import APIHelper
+from moesiftornado.event_mapper import EventMapper
+from moesiftornado.event_serializer import EventSerializer, orjson
+from moesiftornado.logger_helper import LoggerHelper
+from moesiftornado.settings import MoesifSettings
+
+
+def get_snapshots(events):
+    settings = MoesifSettings({'APPLICATION_ID': 'benchmark', 'GET_METADATA': lambda handler: {'a': 1, 'b': [1, 2]}})
+    logger_helper = LoggerHelper()
+    event_mapper = EventMapper()
+    body = make_body(10)
+    snapshots = []
+    for _ in range(events):
+        context = logger_helper.get_request_context(make_handler(body), settings, False)
+        snapshots.append(event_mapper.to_snapshot(context, settings, 100, False))
+    return event_mapper, snapshots
+
+
+def build_models(event_mapper, snapshots):
+    events = []
+    for snapshot in snapshots:
+        event_model = event_mapper.to_event(snapshot, event_mapper.to_request(snapshot, None),
+                                            event_mapper.to_response(snapshot))
+        event_model.request.materialize()
+        event_model.response.materialize()
+        event_model.weight = 1
+        events.append(event_model)
+    return events
+
+
+def build_records(event_mapper, snapshots):
+    return [event_mapper.to_record(snapshot, None, 1) for snapshot in snapshots]
+
+
+def measure(function, number=5):
+    return timeit.timeit(function, number=number) / number * 1e3
+
+
+if __name__ == '__main__':
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    event_mapper, snapshots = get_snapshots(events)
+    models = build_models(event_mapper, snapshots)
+    records = build_records(event_mapper, snapshots)
+    serializers = [('json', EventSerializer(use_orjson=False))]
+    if orjson is not None:
+        serializers.insert(0, ('orjson', EventSerializer()))
+
+    model_payload = json.loads(APIHelper.json_serialize(models))
+    for name, serializer in serializers:
+        if json.loads(serializer.encode_batch(records)) != model_payload:
+            print('The payload of the records with ' + name + ' differs from the payload of the models')
+
+    print('%d events with a small JSON body and metadata, per batch:' % events)
+    print('  build models  %6.1f ms   jsonpickle %6.1f ms' % (
+        measure(lambda: build_models(event_mapper, snapshots)), measure(lambda: APIHelper.json_serialize(models))))
+    print('  build records %6.1f ms   ' % measure(lambda: build_records(event_mapper, snapshots)) + '   '.join(
+        '%s %6.1f ms' % (name, measure(lambda: serializer.encode_batch(records))) for name, serializer in serializers))
@@ -0,0 +1,81 @@
+"""Helpers shared by the benchmarks: a local collector standing in for the Moesif API, and the handlers of the tests"""
+import asyncio
+import gzip
+import json
+import os
+import sys
+import threading
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+from moesifapi.configuration import Configuration
+from tests.helpers import make_handler, make_body
+
+
+class Collector(object):
+    """Count the events received on /v1/events/batch"""
+
+    def __init__(self):
+        self.batches = 0
+        self.events = 0
+
+
+class BatchHandler(tornado.web.RequestHandler):
+
+    def initialize(self, collector):
+        self.collector = collector
+
+    def post(self):
+        body = self.request.body
+        content_encoding = self.request.headers.get('Content-Encoding')
+        if content_encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif content_encoding == 'deflate':
+            body = zlib.decompress(body)
+        self.collector.batches += 1
+        self.collector.events += len(json.loads(body))
+        self.set_header('X-Moesif-Config-ETag', 'benchmark')
+
+
+class ConfigHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header('X-Moesif-Config-ETag', 'benchmark')
+        self.write({'sample_rate': 100})
+
+
+def start_collector():
+    """Serve the Moesif API from a background thread, and point the API client at it"""
+    collector = Collector()
+    started = threading.Event()
+    ports = []
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        application = tornado.web.Application([
+            (r'/v1/events/batch', BatchHandler, dict(collector=collector)),
+            (r'/v1/config', ConfigHandler),
+        ])
+        server = tornado.httpserver.HTTPServer(application)
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        server.add_sockets(sockets)
+        ports.append(sockets[0].getsockname()[1])
+        started.set()
+        tornado.ioloop.IOLoop.current().start()
+
+    thread = threading.Thread(target=serve, name='collector')
+    thread.daemon = True
+    thread.start()
+    started.wait()
+    Configuration.BASE_URI = 'http://127.0.0.1:' + str(ports[0])
+    return collector
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
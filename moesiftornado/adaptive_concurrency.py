@@ -0,0 +1,36 @@
+import threading
+
+
+class AdaptiveConcurrency(object):
+    """Limit on concurrent batch sends that adapts to the observed round trip latency.
+
+    The limit grows by one after each batch that completes close to the lowest latency seen so far,
+    and is halved when the latency degrades or a batch fails (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, max_limit, latency_tolerance=2.0, smoothing=0.2):
+        self.max_limit = max(1, int(max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.limit = self.max_limit
+        self.min_latency = None
+        self.smoothed_latency = None
+        self.lock = threading.Lock()
+
+    def record(self, latency, success):
+        with self.lock:
+            if not success:
+                self.limit = max(1, self.limit // 2)
+                return
+            if self.min_latency is None:
+                self.min_latency = self.smoothed_latency = latency
+            else:
+                # Let the baseline drift up slowly so a permanent change in latency is not penalized forever
+                self.min_latency = min(self.min_latency * 1.01, latency)
+                self.smoothed_latency += self.smoothing * (latency - self.smoothed_latency)
+            if self.smoothed_latency > self.latency_tolerance * self.min_latency:
+                self.limit = max(1, self.limit // 2)
+                # Start the next measurement from the current latency, avoid halving on every sample
+                self.smoothed_latency = latency
+            elif self.limit < self.max_limit:
+                self.limit += 1
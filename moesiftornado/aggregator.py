@@ -0,0 +1,213 @@
+from .aggregator_client import read_frame, write_frame, split_events, BATCH_FRAME, ACK_FRAME, NACK_FRAME, \
+    CONFIG_FRAME
+from .middleware import MoesifMiddleware
+import json
+import os
+import signal
+import socket
+import threading
+import time
+
+
+class EventAggregator(object):
+    """Deliver the events of all the processes of a host, received over a Unix domain socket.
+
+    The aggregator owns the only MoesifMiddleware delivering events, so the batches are built from the events
+    of every process, and the application configuration is fetched once for the host and served to the
+    processes. Events are received already serialized, and are batched without being decoded.
+
+    A batch is acknowledged once all its events are queued or spilled to disk. Otherwise it is rejected, and the
+    process sends it to Moesif directly. The socket is only accessible to the user running the aggregator.
+    """
+
+    def __init__(self, moesif_config, socket_path=None):
+        self.socket_path = socket_path or moesif_config.get('AGGREGATOR_SOCKET', None)
+        if not self.socket_path:
+            raise Exception('Moesif setting AGGREGATOR_SOCKET is required to run the aggregator')
+        # The aggregator delivers the events itself, from the background thread as no IOLoop is running
+        self.middleware = MoesifMiddleware(dict(moesif_config, AGGREGATOR_SOCKET=None, IOLOOP_DELIVERY=False))
+        self.DEBUG = self.middleware.DEBUG
+        self.server = None
+        self.is_running = False
+        # Counters are updated by the connection threads
+        self.lock = threading.Lock()
+        self.received_batches = 0
+        self.received_events = 0
+        self.rejected_batches = 0
+        self.rejected_events = 0
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise Exception('A Moesif aggregator is already listening on ' + self.socket_path)
+            except socket.error:
+                # Left over by an aggregator which did not exit cleanly
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket with mode 0600, so other users of the host cannot send events under the application id
+        umask = os.umask(0o177)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.server.listen(128)
+
+    def serve_forever(self):
+        """Accept the connections of the processes until close is called"""
+        if self.server is None:
+            self.bind()
+        self.is_running = True
+        self.middleware.start_config_refresh()
+        self.middleware.schedule_background_job()
+        self.middleware.is_event_job_scheduled = True
+        while self.is_running:
+            try:
+                connection, _ = self.server.accept()
+            except socket.error:
+                if self.is_running and self.DEBUG:
+                    print('Error while accepting a connection to the aggregator')
+                continue
+            handler = threading.Thread(target=self.handle_connection, args=(connection,),
+                                       name='moesif-aggregator-connection')
+            handler.daemon = True
+            handler.start()
+
+    def handle_connection(self, connection):
+        reader = connection.makefile('rb')
+        try:
+            while self.is_running:
+                frame_type, payload = read_frame(reader)
+                if frame_type == BATCH_FRAME:
+                    config_etag = self.middleware.config_etag
+                    reply_type = ACK_FRAME if self.add_events(split_events(payload)) else NACK_FRAME
+                    write_frame(connection, reply_type, config_etag.encode('utf-8') if config_etag else b'')
+                elif frame_type == CONFIG_FRAME:
+                    write_frame(connection, CONFIG_FRAME, self.get_config())
+                else:
+                    raise socket.error('Unexpected frame from a process')
+        except socket.error:
+            # The process exited or closed the connection
+            pass
+        except Exception as ex:
+            if self.DEBUG:
+                print('Error while receiving events from a process')
+                print(str(ex))
+        finally:
+            reader.close()
+            connection.close()
+
+    def add_events(self, events):
+        """Queue or spill all the events of a batch, return False without keeping any of them otherwise"""
+        middleware = self.middleware
+        if middleware.is_queue_closed:
+            outcome = None
+        elif middleware.moesif_events_queue.put_all(events, [len(event_data) for event_data in events]):
+            outcome = 'enqueued'
+        elif middleware.spill_log is not None and middleware.spill_log.append(events):
+            outcome = 'spilled'
+        else:
+            outcome = None
+        with self.lock:
+            if outcome is None:
+                self.rejected_batches += 1
+                self.rejected_events += len(events)
+            else:
+                self.received_batches += 1
+                self.received_events += len(events)
+        if outcome is None:
+            if self.DEBUG:
+                print('Rejected a batch of ' + str(len(events)) + ' events as the aggregator queue is full')
+            return False
+        for _ in events:
+            middleware.metrics.count_event(outcome)
+        # Flush as soon as a full batch is available instead of waiting for the timer
+        if middleware.moesif_events_queue.qsize() >= middleware.BATCH_SIZE:
+            middleware.schedule_flush()
+        return True
+
+    def get_config(self):
+        # Processes starting with the aggregator wait for its first fetch, instead of fetching it themselves
+        self.middleware.wait_for_config(self.middleware.settings.aggregator_timeout / 2.0)
+        config = self.middleware.config
+        return json.dumps({
+            'etag': self.middleware.config_etag,
+            'raw_body': config.raw_body if config is not None else None,
+        }).encode('utf-8')
+
+    def close(self, timeout=None):
+        """Stop accepting events, and flush the queued events like MoesifMiddleware.close"""
+        self.is_running = False
+        if self.server is not None:
+            try:
+                self.server.close()
+                os.unlink(self.socket_path)
+            except Exception:
+                pass
+        return self.middleware.close(timeout)
+
+    def get_stats(self):
+        return {
+            'socket_path': self.socket_path,
+            'received_batches': self.received_batches,
+            'received_events': self.received_events,
+            'rejected_batches': self.rejected_batches,
+            'rejected_events': self.rejected_events,
+            'event_queue': self.middleware.get_event_queue_stats(),
+        }
+
+
+def run_aggregator(moesif_config):
+    """Run the aggregator in the current process until it receives SIGTERM or SIGINT"""
+    aggregator = EventAggregator(moesif_config)
+    aggregator.bind()
+
+    def stop(signum, frame):
+        aggregator.is_running = False
+        # Unblock the accept call
+        aggregator.server.shutdown(socket.SHUT_RDWR)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    aggregator.serve_forever()
+    aggregator.close()
+
+
+def start_aggregator(moesif_config, timeout=10):
+    """Fork the aggregator of the host, and wait up to timeout seconds for it to accept connections.
+
+    Must be called before the processes are forked, and before a MoesifMiddleware is created.
+    Return the process id of the aggregator.
+    """
+    socket_path = moesif_config.get('AGGREGATOR_SOCKET', None)
+    if not socket_path:
+        raise Exception('Moesif setting AGGREGATOR_SOCKET is required to run the aggregator')
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_aggregator(moesif_config)
+        except Exception as ex:
+            print('Error while running the Moesif aggregator')
+            print(str(ex))
+            exit_code = 1
+        finally:
+            # Do not run the exit handlers of the parent process
+            os._exit(exit_code)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            return pid
+        except socket.error:
+            time.sleep(0.05)
+        finally:
+            probe.close()
+    if moesif_config.get('DEBUG', False):
+        print('The Moesif aggregator did not start within ' + str(timeout) + ' seconds')
+    return pid
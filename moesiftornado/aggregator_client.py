@@ -0,0 +1,155 @@
+from moesifapi.http.http_response import HttpResponse
+from .event_serializer import EventSerializer
+import json
+import socket
+import struct
+import threading
+import time
+
+# Frames are a type byte and the length of the payload, followed by the payload
+FRAME_HEADER = struct.Struct('>cI')
+# Events of a batch frame are each prefixed by their length
+EVENT_HEADER = struct.Struct('>I')
+BATCH_FRAME = b'B'
+ACK_FRAME = b'A'
+# Reply to a batch the aggregator could not queue
+NACK_FRAME = b'N'
+CONFIG_FRAME = b'C'
+
+
+def read_exactly(reader, size):
+    data = reader.read(size)
+    if data is None or len(data) < size:
+        raise socket.error('The aggregator connection was closed')
+    return data
+
+
+def read_frame(reader):
+    """Read a frame from a file object of a socket, return the frame type and the payload"""
+    frame_type, size = FRAME_HEADER.unpack(read_exactly(reader, FRAME_HEADER.size))
+    return frame_type, read_exactly(reader, size) if size else b''
+
+
+def write_frame(connection, frame_type, payload):
+    connection.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def split_events(payload):
+    """Return the encoded events of a batch frame payload"""
+    events = []
+    offset = 0
+    view = memoryview(payload)
+    while offset < len(payload):
+        size, = EVENT_HEADER.unpack_from(payload, offset)
+        offset += EVENT_HEADER.size
+        events.append(view[offset:offset + size].tobytes())
+        offset += size
+    return events
+
+
+class AggregatorClient(object):
+    """Forward event batches to the aggregator of the host over its Unix domain socket.
+
+    Events are serialized in the sender thread of the process, and the aggregator acknowledges every batch
+    with the config ETag of the application. A batch rejected by the aggregator as its queue is full is sent to
+    Moesif directly, and the connection is kept. Once the aggregator cannot be reached, it is not retried for
+    retry_interval seconds, and the events are sent to Moesif directly in the meantime.
+    """
+
+    def __init__(self, socket_path, timeout=5, retry_interval=5, serializer=None, debug=False):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.serializer = serializer if serializer is not None else EventSerializer()
+        self.debug = debug
+        self.connection = None
+        self.reader = None
+        self.retry_time = 0
+        # A single connection is shared by the sender threads
+        self.lock = threading.Lock()
+        self.forwarded_batches = 0
+        self.forwarded_events = 0
+        self.rejected_batches = 0
+        self.errors = 0
+
+    def is_available(self):
+        return self.connection is not None or time.time() >= self.retry_time
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.socket_path)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+        self.reader = connection.makefile('rb')
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.reader.close()
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.reader = None
+
+    def request(self, frame_type, payload):
+        """Send a frame and return the type and the payload of the reply, under the lock"""
+        with self.lock:
+            try:
+                if self.connection is None:
+                    self.connect()
+                write_frame(self.connection, frame_type, payload)
+                reply_type, reply = read_frame(self.reader)
+                if reply_type != frame_type and not (frame_type == BATCH_FRAME and reply_type in (ACK_FRAME,
+                                                                                                 NACK_FRAME)):
+                    raise socket.error('Unexpected frame from the aggregator')
+                return reply_type, reply
+            except Exception as ex:
+                self.disconnect()
+                self.errors += 1
+                self.retry_time = time.time() + self.retry_interval
+                if self.debug:
+                    print('Error while sending to the aggregator at ' + self.socket_path)
+                    print(str(ex))
+                raise
+
+    def send_batch(self, batch_events):
+        """Forward a batch to the aggregator and return the response headers, like a batch sent to Moesif"""
+        records = []
+        for event in batch_events:
+            payload = self.serializer.encode_event(event)
+            records.append(EVENT_HEADER.pack(len(payload)))
+            records.append(payload)
+        reply_type, config_etag = self.request(BATCH_FRAME, b''.join(records))
+        if reply_type == NACK_FRAME:
+            with self.lock:
+                self.rejected_batches += 1
+            raise Exception('The aggregator rejected the batch as its event queue is full')
+        with self.lock:
+            self.forwarded_batches += 1
+            self.forwarded_events += len(batch_events)
+        return {'X-Moesif-Config-ETag': config_etag.decode('utf-8') if config_etag else None}
+
+    def get_app_config(self):
+        """Return the application configuration fetched by the aggregator, like the Moesif api client"""
+        _, reply = self.request(CONFIG_FRAME, b'')
+        config = json.loads(reply.decode('utf-8'))
+        if config['raw_body'] is None:
+            raise Exception('The aggregator has no application configuration')
+        headers = {'X-Moesif-Config-ETag': config['etag']} if config['etag'] else {}
+        return HttpResponse(200, headers, config['raw_body'])
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'socket_path': self.socket_path,
+                'connected': self.connection is not None,
+                'forwarded_batches': self.forwarded_batches,
+                'forwarded_events': self.forwarded_events,
+                'rejected_batches': self.rejected_batches,
+                'errors': self.errors,
+            }
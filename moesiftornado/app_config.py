@@ -1,6 +1,38 @@
 from datetime import datetime
+from moesifapi.api_helper import APIHelper
+from moesifapi.configuration import Configuration
 from moesifapi.exceptions.api_exception import *
+from moesifapi.http.http_context import HttpContext
+from moesifapi.http.http_response import HttpResponse
 import json
+import os
+
+
+class SamplingRules(object):
+    """Immutable, indexed view of the sampling rules in the application configuration"""
+
+    __slots__ = ('sample_rate', 'user_sample_rate', 'company_sample_rate')
+
+    def __init__(self, sample_rate=100, user_sample_rate=None, company_sample_rate=None):
+        object.__setattr__(self, 'sample_rate', sample_rate)
+        object.__setattr__(self, 'user_sample_rate', dict(user_sample_rate) if user_sample_rate else {})
+        object.__setattr__(self, 'company_sample_rate', dict(company_sample_rate) if company_sample_rate else {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SamplingRules is immutable')
+
+    def get_sampling_percentage(self, user_id, company_id):
+        """Get sampling percentage for the user and company without any parsing"""
+        if user_id and user_id in self.user_sample_rate:
+            return self.user_sample_rate[user_id]
+
+        if company_id and company_id in self.company_sample_rate:
+            return self.company_sample_rate[company_id]
+
+        return self.sample_rate
+
+
+DEFAULT_SAMPLING_RULES = SamplingRules()
 
 
 class AppConfig:
@@ -9,11 +41,12 @@ class AppConfig:
         pass
 
     @classmethod
-    def get_config(cls, api_client, debug):
-        """Get Config"""
+    def get_config(cls, api_client, debug, etag=None):
+        """Get Config, or a response with the 304 status code when its ETag is still etag"""
         try:
-            config_api_response = api_client.get_app_config()
-            return config_api_response
+            if etag is None:
+                return api_client.get_app_config()
+            return cls.get_config_if_modified(api_client, etag)
         except APIException as inst:
             if 401 <= inst.response_code <= 403:
                 print("Unauthorized access getting application configuration. Please check your Application Id.")
@@ -25,33 +58,74 @@ class AppConfig:
                 print("Error getting application configuration:")
                 print(str(ex))
 
+    @classmethod
+    def get_config_if_modified(cls, api_client, etag):
+        # Same request as get_app_config, conditional on the ETag of the current configuration
+        headers = {
+            'content-type': 'application/json; charset=utf-8',
+            'X-Moesif-Application-Id': Configuration.application_id,
+            'If-None-Match': etag,
+        }
+        request = api_client.http_client.get(APIHelper.clean_url(Configuration.BASE_URI + '/v1/config'),
+                                             headers=headers)
+        response = api_client.http_client.execute_as_string(request)
+        if response.status_code != 304:
+            api_client.validate_response(HttpContext(request, response))
+        return response
+
+    @classmethod
+    def load_cached_config(cls, path, debug):
+        """Return the configuration saved by save_cached_config, None if there is none or it is invalid"""
+        try:
+            with open(path, 'r') as cache_file:
+                cached_config = json.load(cache_file)
+            headers = {}
+            if cached_config.get('etag'):
+                headers['X-Moesif-Config-ETag'] = cached_config['etag']
+            return HttpResponse(200, headers, cached_config['raw_body'])
+        except IOError:
+            # No configuration was cached yet
+            return None
+        except Exception as ex:
+            if debug:
+                print('Error while loading the cached application configuration')
+                print(str(ex))
+            return None
+
+    @classmethod
+    def save_cached_config(cls, path, config, debug):
+        """Save the configuration and its ETag, replacing the cached file atomically"""
+        try:
+            temporary_path = path + '.' + str(os.getpid()) + '.tmp'
+            with open(temporary_path, 'w') as cache_file:
+                json.dump({'etag': config.headers.get('X-Moesif-Config-ETag'), 'raw_body': config.raw_body},
+                          cache_file)
+            os.rename(temporary_path, path)
+        except Exception as ex:
+            if debug:
+                print('Error while caching the application configuration')
+                print(str(ex))
+
     @classmethod
     def parse_configuration(cls, config, debug):
-        """Parse configuration object and return Etag, sample rate and last updated time"""
+        """Parse configuration object and return Etag, sampling rules and last updated time"""
+        if config is None:
+            return None, DEFAULT_SAMPLING_RULES, datetime.utcnow()
         try:
-            return config.headers.get("X-Moesif-Config-ETag"), json.loads(config.raw_body).get('sample_rate', 100), datetime.utcnow()
+            config_body = json.loads(config.raw_body)
+            sampling_rules = SamplingRules(config_body.get('sample_rate', 100),
+                                           config_body.get('user_sample_rate', None),
+                                           config_body.get('company_sample_rate', None))
+            return config.headers.get("X-Moesif-Config-ETag"), sampling_rules, datetime.utcnow()
         except:
             if debug:
                 print('Error while parsing the configuration object, setting the sample rate to default')
-            return None, 100, datetime.utcnow()
+            return None, DEFAULT_SAMPLING_RULES, datetime.utcnow()
 
     @classmethod
-    def get_sampling_percentage(cls, config, user_id, company_id):
+    def get_sampling_percentage(cls, sampling_rules, user_id, company_id):
         """Get sampling percentage"""
-
-        if config is not None:
-            config_body = json.loads(config.raw_body)
-
-            user_sample_rate = config_body.get('user_sample_rate', None)
-
-            company_sample_rate = config_body.get('company_sample_rate', None)
-
-            if user_id and user_sample_rate and user_id in user_sample_rate:
-                return user_sample_rate[user_id]
-
-            if company_id and company_sample_rate and company_id in company_sample_rate:
-                return company_sample_rate[company_id]
-
-            return config_body.get('sample_rate', 100)
+        if sampling_rules is not None:
+            return sampling_rules.get_sampling_percentage(user_id, company_id)
         else:
             return 100
@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stop sending to Moesif after consecutive failures, and probe with a single batch after a cooldown"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.is_trial_in_flight = False
+        self.lock = threading.Lock()
+        self.open_count = 0
+        self.shed_events = 0
+
+    def is_open(self):
+        """Cheap check for the request path, True while events should be shed"""
+        return self.state == self.OPEN and time.time() < self.opened_at + self.cooldown
+
+    def is_healthy(self):
+        """True while closed and the last batch sent was accepted"""
+        return self.state == self.CLOSED and self.consecutive_failures == 0
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() < self.opened_at + self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+            # Only a single trial batch is sent while half open
+            if self.is_trial_in_flight:
+                return False
+            self.is_trial_in_flight = True
+            return True
+
+    def cancel_trial(self):
+        with self.lock:
+            self.is_trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.is_trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.open_count += 1
+                self.state = self.OPEN
+                self.opened_at = time.time()
+            self.is_trial_in_flight = False
+
+    def get_stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'open_count': self.open_count,
+            'shed_events': self.shed_events,
+        }
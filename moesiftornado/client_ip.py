@@ -1,102 +1,164 @@
-import re
+import ipaddress
 
 
 class ClientIp:
+    """Resolve the client IP address of a request from the proxy headers.
+
+    Without trusted proxies the left-most valid address of the forwarding headers is used. With trusted proxy
+    networks, only X-Forwarded-For and Forwarded are honored, for requests received from a trusted proxy, and
+    their chain is walked right to left, skipping the trusted proxies. The other headers are passed through
+    unchanged by most proxies, so the client could set them.
+    """
+
+    # Headers holding the client address, by priority
+    IP_HEADERS = (
+        # Standard request used by Amazon EC2, Heroku, and others.
+        'x-client-ip',
+        # Load-balancers (AWS ELB) or proxies.
+        'x-forwarded-for',
+        # Cloudflare, applied to every request to the origin.
+        # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-headers-
+        'cf-connecting-ip',
+        # Akamai and Cloudflare: True-Client-IP.
+        'true-client-ip',
+        # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
+        'x-real-ip',
+        # (Rackspace LB and Riverbed's Stingray)
+        # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
+        # https://splash.riverbed.com/docs/DOC-1926
+        'x-cluster-client-ip',
+        'x-forwarded',
+        'forwarded-for',
+        'forwarded',
+    )
+    HEADER_PRIORITY = dict((name, priority) for priority, name in enumerate(IP_HEADERS))
+    # Headers appended to by each proxy, the only ones honored with trusted proxies
+    TRUSTED_PROXY_HEADERS = ('x-forwarded-for', 'forwarded')
+
+    def __init__(self, trusted_proxies=None, cache_size=1024):
+        self.trusted_proxies = tuple(trusted_proxies or ())
+        self.cache_size = cache_size
+        # (header name, header value) -> resolved address and (None, remote ip) -> trusted, repeated values are
+        # common behind a load balancer. The cache is cleared when full, which is cheaper than tracking recency.
+        self.cache = {}
 
-    def __init__(self):
-        pass
+    @classmethod
+    def parse_ip(cls, value):
+        """Return the address of a header value, without a port or brackets, or None if it is not an IP address"""
+        value = value.strip().strip('"')
+        if value.startswith('['):
+            # [IPv6]:port
+            value = value[1:value.find(']')]
+        elif value.count(':') == 1:
+            # Azure Web App's also adds a port to IPv4 addresses
+            value = value.split(':', 1)[0]
+        try:
+            return ipaddress.ip_address(value)
+        except ValueError:
+            return None
 
     @classmethod
     def is_ip(cls, value):
-        if value:
-            ipv4 = r"^(?:(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])\.){3}(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])$"
-            ipv6 = r"^((?=.*::)(?!.*::.+::)(::)?([\dA-F]{1,4}:(:|\b)|){5}|([\dA-F]{1,4}:){6})((([\dA-F]{1,4}((?!\3)::|:\b|$))|(?!\2\3)){2}|(((2[0-4]|1\d|[1-9])?\d|25[0-5])\.?\b){4})$/i"
-            return re.match(ipv4, value) or re.match(ipv6, value)
+        return isinstance(value, str) and cls.parse_ip(value) is not None
 
-    def get_client_ip_from_x_forwarded_for(self, value):
-        try:
-            if not value or value is None:
+    @classmethod
+    def get_forwarded_chain(cls, name, value):
+        if name != 'forwarded':
+            return value.split(',')
+        # Forwarded: for=192.0.2.60;proto=http;by=203.0.113.43, for="[2001:db8:cafe::17]:4711"
+        chain = []
+        for element in value.split(','):
+            for pair in element.split(';'):
+                key, _, address = pair.partition('=')
+                if key.strip().lower() == 'for':
+                    chain.append(address)
+        return chain
+
+    def is_trusted(self, address):
+        return any(address in network for network in self.trusted_proxies)
+
+    def is_trusted_remote(self, remote_ip):
+        key = (None, remote_ip)
+        trusted = self.cache.get(key)
+        if trusted is None:
+            remote_address = self.parse_ip(remote_ip or '')
+            trusted = remote_address is not None and self.is_trusted(remote_address)
+            self.put(key, trusted)
+        return trusted
+
+    def put(self, key, value):
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = value
+
+    def get_client_ip_from_chain(self, name, value):
+        # The header may list multiple IP addresses in the format "client IP, proxy 1 IP, proxy 2 IP".
+        # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-request.html
+        addresses = [self.parse_ip(address) for address in self.get_forwarded_chain(name, value)]
+        if not self.trusted_proxies:
+            # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
+            # Therefore taking the left-most IP address that is not unknown
+            return next((address for address in addresses if address is not None), None)
+        # The right-most address was added by the closest proxy, anything left of the first untrusted
+        # address may be spoofed by the client
+        for address in reversed(addresses):
+            if address is None:
                 return None
-
+            if not self.is_trusted(address):
+                return address
+        # Every hop is a trusted proxy, the left-most one is the client
+        return addresses[0] if addresses else None
+
+    def get_client_ip_from_header(self, name, value):
+        key = (name, value)
+        address = self.cache.get(key, False)
+        if address is False:
             if not isinstance(value, str):
-                print("Expected a string, got -" + str(type(value)))
+                address = None
+            elif name == 'x-forwarded-for' or name == 'forwarded':
+                address = self.get_client_ip_from_chain(name, value)
             else:
-                # x-forwarded-for may return multiple IP addresses in the format:
-                # "client IP, proxy 1 IP, proxy 2 IP"
-                # Therefore, the right-most IP address is the IP address of the most recent proxy
-                # and the left-most IP address is the IP address of the originating client.
-                # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-request.html
-                # Azure Web App's also adds a port for some reason, so we'll only use the first part (the IP)
-                forwardedIps = []
-
-                for e in value.split(','):
-                    ip = e.strip()
-                    if ':' in ip:
-                        splitted = ip.split(':')
-                        if (len(splitted) == 2):
-                            forwardedIps.append(splitted[0])
-                    forwardedIps.append(ip)
-
-                # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
-                # Therefore taking the left-most IP address that is not unknown
-                # A Squid configuration directive can also set the value to "unknown" (http://www.squid-cache.org/Doc/config/forwarded_for/)
-                return next(item for item in forwardedIps if self.is_ip(item))
-        except StopIteration:
-            return value.encode('utf-8')
-
-    def get_client_address(self, request):
-        try:
+                address = self.parse_ip(value)
+            address = str(address) if address is not None else None
+            self.put(key, address)
+        return address
 
-            # Event Request headers
-            headers = request.headers
-
-            # Standard request used by Amazon EC2, Heroku, and others.
-            if 'X-Client-Ip' in headers:
-                if self.is_ip(headers['X-Client-Ip']):
-                    return headers['X-Client-Ip']
-
-            # Load-balancers (AWS ELB) or proxies.
-            if 'X-Forwarded-For' in headers:
-                xForwardedFor = self.get_client_ip_from_x_forwarded_for(headers['X-Forwarded-For'])
-                if self.is_ip(xForwardedFor):
-                    return xForwardedFor
-
-            # Cloudflare.
-            # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-request-
-            # CF-Connecting-IP - applied to every request to the origin.
-            if 'Cf-Connecting-Ip' in headers:
-                if self.is_ip(headers['Cf-Connecting-Ip']):
-                    return headers['Cf-Connecting-Ip']
-
-            # Akamai and Cloudflare: True-Client-IP.
-            if 'True-Client-Ip' in headers:
-                if self.is_ip(headers['True-Client-Ip']):
-                    return headers['True-Client-Ip']
-
-            # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
-            if 'X-Real-Ip' in headers:
-                if self.is_ip(headers['X-Real-Ip']):
-                    return headers['X-Real-Ip']
-
-            # (Rackspace LB and Riverbed's Stingray)
-            # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
-            # https://splash.riverbed.com/docs/DOC-1926
-            if 'X-Cluster-Client-Ip' in headers:
-                if self.is_ip(headers['X-Cluster-Client-Ip']):
-                    return headers['X-Cluster-Client-Ip']
-
-            if 'X-Forwarded' in headers:
-                if self.is_ip(headers['X-Forwarded']):
-                    return headers['X-Forwarded']
-
-            if 'Forwarded-For' in headers:
-                if self.is_ip(headers['Forwarded-For']):
-                    return headers['Forwarded-For']
-
-            if 'Forwarded' in headers:
-                if self.is_ip(headers['Forwarded']):
-                    return headers['Forwarded']
+    def get_client_ip_from_x_forwarded_for(self, value):
+        return self.get_client_ip_from_header('x-forwarded-for', value)
 
+    def get_client_address(self, request, headers=None):
+        """Return the client IP address, headers is an optional dictionary of the request headers with lowercase names"""
+        try:
+            if headers is None:
+                headers = dict((name.lower(), value) for name, value in request.headers.items())
+        except Exception:
             return request.remote_ip
-        except KeyError:
-            return request.remote_ip
+        return self.get_client_ip(request.remote_ip, headers)
+
+    def get_client_ip(self, remote_ip, headers):
+        """Return the client IP address of a request received from remote_ip, with lowercase header names"""
+        try:
+            if self.trusted_proxies:
+                if not self.is_trusted_remote(remote_ip):
+                    # The request does not come from a trusted proxy, the headers could be set by the client
+                    return remote_ip
+                for name in self.TRUSTED_PROXY_HEADERS:
+                    value = headers.get(name)
+                    if value is not None:
+                        address = self.get_client_ip_from_header(name, value)
+                        if address is not None:
+                            return address
+                return remote_ip
+
+            # Scan the request headers once, usually none or one of them holds the client address
+            candidates = [(self.HEADER_PRIORITY[name], name, value) for name, value in headers.items()
+                          if name in self.HEADER_PRIORITY]
+            candidates.sort()
+            for _, name, value in candidates:
+                address = self.get_client_ip_from_header(name, value)
+                if address is not None:
+                    return address
+
+            return remote_ip
+        except Exception:
+            return remote_ip
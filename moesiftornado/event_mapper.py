@@ -1,62 +1,139 @@
 from moesifapi.models import *
 from .parse_body import ParseBody
 from .client_ip import ClientIp
+from .lazy_body import LazyEventRequestModel, LazyEventResponseModel
 from .logger_helper import LoggerHelper
-from datetime import datetime
+from .event_snapshot import EventSnapshot
+from .event_record import EventRecord
+from .event_serializer import EventSerializer
 
 
 class EventMapper:
 
-    def __init__(self):
+    # Handling of the events larger than the byte budget of a batch
+    TRUNCATE = 'truncate'
+    SKIP = 'skip'
+    OVERSIZED_EVENT_POLICIES = (TRUNCATE, SKIP)
+
+    def __init__(self, trusted_proxies=None, request_body_max_size=1048576):
         self.parse_body = ParseBody()
-        self.client_ip = ClientIp()
+        self.request_body_max_size = request_body_max_size
+        self.client_ip = ClientIp(trusted_proxies)
         self.logger_helper = LoggerHelper()
+        # Measures the parsed bodies of the masked events
+        self.event_serializer = EventSerializer()
+
+    def to_snapshot(self, context, settings, sampling_percentage, debug):
+        """Copy the values of the finished request needed to build its event, on the IOLoop thread"""
+        handler = context.handler
+        # User and company are resolved once in the request context, the other hooks run for sampled events only
+        context.session_token = self.logger_helper.get_session_token(handler, settings, debug)
+        context.metadata = self.logger_helper.get_metadata(handler, settings, debug)
+        # Response headers
+        rsp_headers = None
+        if handler._headers:
+            rsp_headers = dict(handler._headers.get_all())
+        # Response body, captured only when the response body capture is installed on the application
+        response_capture = getattr(handler.request, 'moesif_response_body', None)
+        return EventSnapshot(context, handler, rsp_headers, response_capture, settings.log_body, sampling_percentage,
+                             self.request_body_max_size)
 
-    def to_event(self, handler, moesif_config, event_req, event_rsp, debug):
+    def to_event(self, snapshot, event_req, event_rsp):
         # Prepare Event Model
         return EventModel(request=event_req,
                           response=event_rsp,
-                          user_id=self.logger_helper.get_user_id(handler, moesif_config, debug),
-                          company_id=self.logger_helper.get_company_id(handler, moesif_config, debug),
-                          session_token=self.logger_helper.get_session_token(handler, moesif_config, debug),
-                          metadata=self.logger_helper.get_metadata(handler, moesif_config, debug),
+                          user_id=snapshot.user_id,
+                          company_id=snapshot.company_id,
+                          session_token=snapshot.session_token,
+                          metadata=snapshot.metadata,
                           direction="Incoming")
 
-    def to_request(self, handler, log_body, api_version, request_time):
+    def to_request(self, snapshot, api_version):
         # Request headers
-        req_headers = None
-        if handler.request.headers:
-            req_headers = dict(handler.request.headers.get_all())
-
-        # Request body
-        req_body = None
-        req_transfer_encoding = None
-        if log_body:
-            req_body, req_transfer_encoding = self.parse_body.parse_body(handler.request.body, req_headers)
+        req_headers = snapshot.request_headers or None
 
         # Prepare Event Request Model
-        return EventRequestModel(time=request_time,
-                                 uri=handler.request.full_url(),
-                                 verb=handler.request.method,
-                                 api_version=api_version,
-                                 ip_address=self.client_ip.get_client_address(handler.request),
-                                 headers=req_headers,
-                                 body=req_body,
-                                 transfer_encoding=req_transfer_encoding)
-
-    @classmethod
-    def to_response(cls, handler, response_time):
-        # Response headers
-        rsp_headers = None
-        if handler._headers:
-            rsp_headers = dict(handler._headers.get_all())
+        event_req = LazyEventRequestModel(time=EventRecord.format_time(snapshot.request_time),
+                                          uri=snapshot.uri,
+                                          verb=snapshot.verb,
+                                          api_version=api_version,
+                                          ip_address=self.client_ip.get_client_ip(
+                                              snapshot.remote_ip, snapshot.lowercase_request_headers),
+                                          headers=req_headers)
+
+        # Request body, kept as raw bytes until the event is serialized
+        raw_body = self.get_request_raw_body(snapshot)
+        if raw_body is not None:
+            event_req.set_raw_body(self.parse_body, *raw_body)
+        return event_req
 
-        # Response body
-        rsp_body = None
-        rsp_transfer_encoding = None
+    def to_response(self, snapshot):
         # Prepare Event Response Model
-        return EventResponseModel(time=response_time,
-                                  status=handler.get_status(),
-                                  headers=rsp_headers,
-                                  body=rsp_body,
-                                  transfer_encoding=rsp_transfer_encoding)
+        event_rsp = LazyEventResponseModel(time=EventRecord.format_time(snapshot.response_time),
+                                           status=snapshot.status,
+                                           headers=snapshot.response_headers)
+
+        # Response body, kept as raw bytes until the event is serialized
+        raw_body = self.get_response_raw_body(snapshot)
+        if raw_body is not None:
+            event_rsp.set_raw_body(self.parse_body, *raw_body)
+        return event_rsp
+
+    def get_request_raw_body(self, snapshot):
+        # Body, lowercased headers, size of the whole body and maximum size, parsed by ParseBody at serialization
+        if snapshot.request_body is not None:
+            return (snapshot.request_body, snapshot.lowercase_request_headers, snapshot.request_body_size,
+                    self.request_body_max_size)
+        return None
+
+    def get_response_raw_body(self, snapshot):
+        response_capture = snapshot.response_capture
+        if response_capture is not None and response_capture.size:
+            return (response_capture.get_body(), self.parse_body.transform_headers(snapshot.response_headers or {}),
+                    response_capture.total_size, response_capture.max_size)
+        return None
+
+    def to_record(self, snapshot, api_version, weight):
+        """Build the compact record of an event buffered until it is serialized, without the model objects"""
+        return EventRecord(snapshot, api_version,
+                           self.client_ip.get_client_ip(snapshot.remote_ip, snapshot.lowercase_request_headers),
+                           self.request_body_max_size, weight)
+
+    def estimate_event_size(self, snapshot):
+        # Approximate size of the buffered event from the raw request and response, plus the model overhead
+        event_size = 512 + len(snapshot.uri)
+        for name, value in snapshot.request_headers.items():
+            event_size += len(name) + len(value)
+        if snapshot.response_headers:
+            for name, value in snapshot.response_headers.items():
+                event_size += len(name) + len(str(value))
+        if snapshot.request_body is not None:
+            # Cut to REQUEST_BODY_MAX_SIZE by the snapshot, the size counted is the size held in memory
+            event_size += len(snapshot.request_body)
+        if snapshot.response_capture is not None:
+            event_size += snapshot.response_capture.size
+        return event_size
+
+    def limit_event_size(self, event, event_size, max_size, policy):
+        """Return the event and its estimated size, with its bodies truncated when it is larger than max_size.
+
+        Return None instead of an event larger than max_size when the policy is skip.
+        """
+        if event_size <= max_size:
+            return event, event_size
+        if policy == self.SKIP:
+            return None, 0
+        # Each body is cut to a quarter of the budget, leaving room for its encoding and the rest of the event
+        body_max_size = max_size // 4
+        if isinstance(event, EventRecord):
+            return event, event_size - event.truncate_bodies(body_max_size)
+        # Bodies of masked events are already parsed, only the ones larger than the limit once serialized are replaced
+        released = 0
+        for model in (event.request, event.response):
+            if model is not None and model.body is not None:
+                body_size = len(self.event_serializer.dumps(model.body))
+                if body_size > body_max_size:
+                    model.body = {'truncated': True, 'max_size': body_max_size, 'size': body_size}
+                    model.transfer_encoding = 'json'
+                    released += body_size
+        return event, max(0, event_size - released)
@@ -0,0 +1,124 @@
+from collections import deque
+import threading
+import queue
+import time
+
+
+class EventQueue(object):
+    """Thread-safe event buffer bounded by the number of events and their estimated size in bytes"""
+
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+    OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+    def __init__(self, max_size=100000, max_bytes=104857600, overflow_policy=DROP_NEWEST, block_timeout=0.05):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise Exception('Invalid event queue overflow policy: ' + str(overflow_policy) +
+                            ', expected one of ' + ', '.join(self.OVERFLOW_POLICIES))
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.events = deque()
+        self.current_bytes = 0
+        self.mutex = threading.Lock()
+        self.not_full = threading.Condition(self.mutex)
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        self.dropped_bytes = 0
+
+    def has_room(self, size):
+        return len(self.events) < self.max_size and self.current_bytes + size <= self.max_bytes
+
+    def put(self, event, size=0):
+        """Add an event to the queue, return False if the event was dropped due to the overflow policy"""
+        with self.mutex:
+            if size > self.max_bytes:
+                # The event alone can never fit in the buffer
+                self.dropped_newest += 1
+                self.dropped_bytes += size
+                return False
+
+            if not self.has_room(size):
+                if self.overflow_policy == self.DROP_OLDEST:
+                    while self.events and not self.has_room(size):
+                        _, dropped_size = self.events.popleft()
+                        self.current_bytes -= dropped_size
+                        self.dropped_oldest += 1
+                        self.dropped_bytes += dropped_size
+                elif self.overflow_policy == self.BLOCK:
+                    deadline = time.time() + self.block_timeout
+                    while not self.has_room(size):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.not_full.wait(remaining)
+
+                if not self.has_room(size):
+                    self.dropped_newest += 1
+                    self.dropped_bytes += size
+                    return False
+
+            self.events.append((event, size))
+            self.current_bytes += size
+            return True
+
+    def put_all(self, events, sizes):
+        """Add all the events, or none of them when they do not all fit, whatever the overflow policy"""
+        total_size = sum(sizes)
+        with self.mutex:
+            if len(self.events) + len(events) > self.max_size or self.current_bytes + total_size > self.max_bytes:
+                return False
+            self.events.extend(zip(events, sizes))
+            self.current_bytes += total_size
+            return True
+
+    def get_nowait(self):
+        with self.mutex:
+            if not self.events:
+                raise queue.Empty
+            event, size = self.events.popleft()
+            self.current_bytes -= size
+            self.not_full.notify()
+            return event
+
+    def get_batch(self, max_items, max_bytes=None):
+        """Remove and return up to max_items events, and up to max_bytes estimated bytes, under a single lock.
+
+        The first event is always returned, even when it is larger than max_bytes.
+        """
+        batch = []
+        batch_bytes = 0
+        with self.mutex:
+            while self.events and len(batch) < max_items:
+                event, size = self.events[0]
+                if max_bytes is not None and batch and batch_bytes + size > max_bytes:
+                    break
+                self.events.popleft()
+                self.current_bytes -= size
+                batch_bytes += size
+                batch.append(event)
+            if batch:
+                self.not_full.notify_all()
+        return batch
+
+    def qsize(self):
+        return len(self.events)
+
+    def empty(self):
+        return not self.events
+
+    def get_stats(self):
+        with self.mutex:
+            return {
+                'size': len(self.events),
+                'bytes': self.current_bytes,
+                'max_size': self.max_size,
+                'max_bytes': self.max_bytes,
+                'overflow_policy': self.overflow_policy,
+                'dropped_newest': self.dropped_newest,
+                'dropped_oldest': self.dropped_oldest,
+                'dropped': self.dropped_newest + self.dropped_oldest,
+                'dropped_bytes': self.dropped_bytes,
+            }
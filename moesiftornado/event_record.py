@@ -0,0 +1,119 @@
+from datetime import datetime
+import sys
+
+
+class EventRecord(object):
+    """Compact representation of a buffered event, turned into its wire format dictionary at serialization.
+
+    Headers are flat tuples of interned names and values instead of dictionaries, bodies are the raw bytes,
+    and the request and response times are timestamps, formatted only when the event is serialized.
+    """
+
+    __slots__ = ('request_time', 'response_time', 'uri', 'verb', 'api_version', 'ip_address', 'request_headers',
+                 'request_body', 'request_body_size', 'request_body_max_size', 'status', 'response_headers', 'response_body',
+                 'response_body_size', 'response_body_max_size', 'user_id', 'company_id', 'session_token',
+                 'metadata', 'weight')
+
+    def __init__(self, snapshot, api_version, ip_address, request_body_max_size, weight):
+        self.request_time = snapshot.request_time
+        self.response_time = snapshot.response_time
+        self.uri = snapshot.uri
+        self.verb = snapshot.verb
+        self.api_version = api_version
+        self.ip_address = ip_address
+        self.request_headers = self.pack_headers(snapshot.request_headers)
+        self.request_body = snapshot.request_body
+        self.request_body_size = snapshot.request_body_size
+        self.request_body_max_size = request_body_max_size
+        self.status = snapshot.status
+        self.response_headers = self.pack_headers(snapshot.response_headers)
+        self.response_body = None
+        self.response_body_size = None
+        self.response_body_max_size = None
+        response_capture = snapshot.response_capture
+        if response_capture is not None and response_capture.size:
+            self.response_body = response_capture.get_body()
+            self.response_body_size = response_capture.total_size
+            self.response_body_max_size = response_capture.max_size
+        self.user_id = snapshot.user_id
+        self.company_id = snapshot.company_id
+        self.session_token = snapshot.session_token
+        self.metadata = snapshot.metadata
+        self.weight = weight
+
+    @classmethod
+    def pack_headers(cls, headers):
+        if not headers:
+            return None
+        packed_headers = []
+        for name, value in headers.items():
+            packed_headers.append(sys.intern(str(name)))
+            packed_headers.append(value)
+        return tuple(packed_headers)
+
+    @classmethod
+    def unpack_headers(cls, packed_headers):
+        if packed_headers is None:
+            return None
+        return dict(zip(packed_headers[::2], packed_headers[1::2]))
+
+    @classmethod
+    def format_time(cls, timestamp):
+        return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    def truncate_bodies(self, max_size):
+        """Keep the beginning of the bodies larger than max_size, logged as truncated, return the bytes released"""
+        released = 0
+        if self.request_body is not None and len(self.request_body) > max_size:
+            released += len(self.request_body) - max_size
+            if self.request_body_size is None:
+                self.request_body_size = len(self.request_body)
+            self.request_body = self.request_body[:max_size]
+            self.request_body_max_size = min(self.request_body_max_size, max_size)
+        if self.response_body is not None and len(self.response_body) > max_size:
+            released += len(self.response_body) - max_size
+            self.response_body = self.response_body[:max_size]
+            self.response_body_max_size = min(self.response_body_max_size, max_size)
+        return released
+
+    def to_dictionary(self, parse_body):
+        """Return the wire format dictionary of the event, parsing the bodies with parse_body"""
+        request_headers = self.unpack_headers(self.request_headers)
+        response_headers = self.unpack_headers(self.response_headers)
+        request_body = request_transfer_encoding = None
+        if self.request_body is not None:
+            request_body, request_transfer_encoding = parse_body.parse_body(
+                self.request_body, parse_body.transform_headers(request_headers or {}), self.request_body_size,
+                self.request_body_max_size)
+        response_body = response_transfer_encoding = None
+        if self.response_body is not None:
+            response_body, response_transfer_encoding = parse_body.parse_body(
+                self.response_body, parse_body.transform_headers(response_headers or {}), self.response_body_size,
+                self.response_body_max_size)
+        return {
+            'request': {
+                'time': self.format_time(self.request_time),
+                'uri': self.uri,
+                'verb': self.verb,
+                'headers': request_headers,
+                'api_version': self.api_version,
+                'ip_address': self.ip_address,
+                'body': request_body,
+                'transfer_encoding': request_transfer_encoding,
+            },
+            'response': {
+                'time': self.format_time(self.response_time),
+                'status': self.status,
+                'headers': response_headers,
+                'body': response_body,
+                'ip_address': None,
+                'transfer_encoding': response_transfer_encoding,
+            },
+            'session_token': self.session_token,
+            'tags': None,
+            'user_id': self.user_id,
+            'company_id': self.company_id,
+            'metadata': self.metadata,
+            'direction': 'Incoming',
+            'weight': self.weight,
+        }
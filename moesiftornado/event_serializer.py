@@ -0,0 +1,66 @@
+from moesifapi.models.base_model import BaseModel
+from .parse_body import ParseBody
+from .event_record import EventRecord
+import datetime
+import json
+try:
+    # Faster JSON encoder, used when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class EventSerializer(object):
+    """Encode events to JSON from wire format dictionaries, a batch in a single call.
+
+    Events are the EventRecord built by EventMapper.to_record, whose bodies are parsed at serialization,
+    EventModel objects when a MASK_EVENT_MODEL hook is set, dictionaries replayed from the spill log, or
+    bytes already encoded by a process forwarding its events to the aggregator.
+    """
+
+    def __init__(self, use_orjson=True):
+        self.parse_body = ParseBody()
+        self.use_orjson = use_orjson and orjson is not None
+
+    def materialize(self, event):
+        """Return the wire format dictionary of an event"""
+        if isinstance(event, EventRecord):
+            return event.to_dictionary(self.parse_body)
+        if isinstance(event, BaseModel):
+            return event.to_dictionary()
+        # Events replayed from the spill log are already dictionaries
+        return event
+
+    @classmethod
+    def default(cls, value):
+        # Values the JSON encoders do not support, like the ones returned by the metadata hook
+        if isinstance(value, BaseModel):
+            return value.to_dictionary()
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        if isinstance(value, (set, frozenset, tuple)):
+            return list(value)
+        return str(value)
+
+    def dumps(self, value):
+        if self.use_orjson:
+            try:
+                return orjson.dumps(value, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+            except (TypeError, orjson.JSONEncodeError):
+                # Integers larger than 64 bits, or unsupported values, are left to the json module
+                pass
+        return json.dumps(value, default=self.default, separators=(',', ':')).encode('utf-8')
+
+    def encode_batch(self, batch_events):
+        """Return the JSON payload of a batch of events as bytes"""
+        if not any(isinstance(event, bytes) for event in batch_events):
+            return self.dumps([self.materialize(event) for event in batch_events])
+        # Events received by the aggregator are joined without being decoded
+        return b'[' + b','.join(self.encode_event(event) for event in batch_events) + b']'
+
+    def encode_event(self, event):
+        if isinstance(event, bytes):
+            return event
+        return self.dumps(self.materialize(event))
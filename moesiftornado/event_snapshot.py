@@ -0,0 +1,47 @@
+class EventSnapshot(object):
+    """Immutable copy of the request and response values needed to build an event.
+
+    Taken on the IOLoop thread when the request finishes, so the event can be built from another thread
+    without touching the handler. Bodies are held by reference, request bodies and captured response
+    chunks are bytes which are not modified once the request finished. A request body larger than
+    request_body_max_size is cut to that size, request_body_size then holds the size of the whole body.
+    """
+
+    __slots__ = ('request_time', 'response_time', 'uri', 'verb', 'remote_ip', 'request_headers',
+                 'lowercase_request_headers', 'request_body', 'request_body_size',
+                 'status', 'response_headers', 'response_capture', 'user_id', 'company_id', 'session_token',
+                 'metadata', 'sampling_percentage')
+
+    def __init__(self, context, handler, response_headers, response_capture, log_body, sampling_percentage,
+                 request_body_max_size=1048576):
+        request = handler.request
+        self.set('request_time', context.request_time)
+        self.set('response_time', context.response_time)
+        self.set('uri', request.full_url())
+        self.set('verb', request.method)
+        self.set('remote_ip', request.remote_ip)
+        # Request headers with their original names as logged, and with lowercased names for the lookups
+        self.set('request_headers', context.event_headers)
+        self.set('lowercase_request_headers', context.headers)
+        request_body = (request.body if log_body else None) or None
+        request_body_size = None
+        if request_body is not None and len(request_body) > request_body_max_size:
+            # Only the beginning is logged, copy it so the whole body is released with the request
+            request_body_size = len(request_body)
+            request_body = request_body[:request_body_max_size]
+        self.set('request_body', request_body)
+        self.set('request_body_size', request_body_size)
+        self.set('status', handler.get_status())
+        self.set('response_headers', response_headers)
+        self.set('response_capture', response_capture if log_body else None)
+        self.set('user_id', context.user_id)
+        self.set('company_id', context.company_id)
+        self.set('session_token', context.session_token)
+        self.set('metadata', context.metadata)
+        self.set('sampling_percentage', sampling_percentage)
+
+    def set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('EventSnapshot is immutable')
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class EventWorkers(object):
+    """Pool of threads building the events off the IOLoop, bounded by the number and size of pending snapshots"""
+
+    def __init__(self, max_workers, max_pending=10000, max_pending_bytes=104857600, debug=False):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.debug = debug
+        self.pending = 0
+        self.pending_bytes = 0
+        self.processed = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def submit(self, size, fn, *args):
+        """Run fn(*args) on a worker, return False if it was dropped as too many calls or bytes are pending.
+
+        size is the estimated size in bytes of the arguments, held until the call is done.
+        """
+        with self.condition:
+            if self.pending >= self.max_pending or self.pending_bytes + size > self.max_pending_bytes:
+                self.dropped += 1
+                return False
+            self.pending += 1
+            self.pending_bytes += size
+        self.executor.submit(self.run, size, fn, args)
+        return True
+
+    def run(self, size, fn, args):
+        try:
+            fn(*args)
+        except Exception as ex:
+            if self.debug:
+                print('Error while building the event in the background')
+                print(str(ex))
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.pending_bytes -= size
+                self.processed += 1
+                if not self.pending:
+                    self.condition.notify_all()
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for the pending calls, return True if none is left"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return not self.pending
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self):
+        return {
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'pending_bytes': self.pending_bytes,
+            'max_pending_bytes': self.max_pending_bytes,
+            'processed': self.processed,
+            'dropped': self.dropped,
+        }
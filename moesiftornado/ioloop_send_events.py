@@ -0,0 +1,228 @@
+from moesifapi.api_helper import APIHelper
+from moesifapi.configuration import Configuration
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Event
+from concurrent.futures import ThreadPoolExecutor
+from .adaptive_concurrency import AdaptiveConcurrency
+from .circuit_breaker import CircuitBreaker
+from .retry_buffer import RetryBuffer
+from .payload_encoder import PayloadEncoder
+from .rate_limiter import RateLimiter
+from .metrics import Metrics
+from datetime import timedelta
+import time
+try:
+    # curl client keeps the connections to Moesif alive between batches
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+
+
+class SendEventIOLoop(object):
+    """Send event batches from a coroutine running on the Tornado IOLoop with non-blocking HTTP"""
+
+    def __init__(self, moesif_events_queue, batch_size, batch_max_time, debug, request_timeout=30,
+                 batch_listener=None, max_concurrent_batches=1, retry_buffer=None, circuit_breaker=None,
+                 spill_log=None, payload_encoder=None, batch_max_bytes=None, rate_limiter=None,
+                 metrics=None):
+        self.moesif_events_queue = moesif_events_queue
+        self.batch_size = batch_size
+        self.batch_max_time = batch_max_time
+        self.debug = debug
+        self.request_timeout = request_timeout
+        # Called with the config ETag of the last successful batch after every drain
+        self.batch_listener = batch_listener
+        self.http_client = None
+        self.io_loop = None
+        self.flush_event = None
+        self.is_running = False
+        self.concurrency = AdaptiveConcurrency(max_concurrent_batches)
+        self.retry_buffer = retry_buffer if retry_buffer is not None else RetryBuffer()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.spill_log = spill_log
+        # Disk reads and writes of the spill log are kept off the IOLoop
+        self.spill_executor = ThreadPoolExecutor(max_workers=1) if spill_log is not None else None
+        self.payload_encoder = payload_encoder if payload_encoder is not None else PayloadEncoder()
+        # Batches are serialized and compressed off the IOLoop
+        self.encode_executor = ThreadPoolExecutor(max_workers=1)
+        # Batches are cut by their estimated size as well, and paced by the rate limiter
+        self.batch_max_bytes = batch_max_bytes
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.in_flight = 0
+        self.in_flight_events = 0
+        self.delivered_batches = 0
+        self.slot_released = None
+        self.last_response_etag = None
+
+    def create_http_client(self):
+        if CurlAsyncHTTPClient is not None:
+            return CurlAsyncHTTPClient(force_instance=True)
+        return AsyncHTTPClient(force_instance=True)
+
+    def start(self):
+        """Start the delivery coroutine on the current IOLoop, must be called from the IOLoop thread"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.io_loop = IOLoop.current()
+        self.http_client = self.create_http_client()
+        self.flush_event = Event()
+        self.slot_released = Condition()
+        IOLoop.current().spawn_callback(self.run)
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        if self.flush_event is not None:
+            self.flush_event.set()
+
+    def notify(self):
+        """Wake up the delivery coroutine as soon as a full batch is available"""
+        if self.flush_event is not None:
+            self.flush_event.set()
+
+    def notify_threadsafe(self):
+        """Same as notify, from a thread other than the IOLoop thread"""
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self.notify)
+
+    @gen.coroutine
+    def run(self):
+        while self.is_running:
+            try:
+                yield self.flush_event.wait(timeout=timedelta(seconds=self.batch_max_time))
+            except gen.TimeoutError:
+                pass
+            self.flush_event.clear()
+            response_etag = yield self.batch_events()
+            if self.batch_listener is not None:
+                try:
+                    self.batch_listener(response_etag)
+                except Exception as ex:
+                    if self.debug:
+                        print('Error while handling the batch response')
+                        print(str(ex))
+        if self.http_client is not None:
+            self.http_client.close()
+
+    def handle_failure(self, batch_events, attempt, status_code):
+        self.circuit_breaker.record_failure()
+        if self.retry_buffer.add(batch_events, attempt + 1, status_code):
+            if self.debug:
+                print("Scheduled retry " + str(attempt + 1) + " for a batch of " + str(len(batch_events)) + " events")
+        elif self.spill_log is not None and self.retry_buffer.is_retryable(status_code):
+            # Keep the batch on disk, it is replayed once Moesif accepts events again
+            self.spill_executor.submit(self.spill_log.append, batch_events)
+        else:
+            self.retry_buffer.drop(batch_events)
+            if self.debug:
+                print("Dropped a batch of " + str(len(batch_events)) + " events after " + str(attempt + 1) + " attempts")
+
+    @gen.coroutine
+    def send_events(self, batch_events, attempt=0):
+        response_etag = None
+        start_time = time.time()
+        success = False
+        try:
+            if self.debug:
+                print("Sending events to Moesif")
+            headers = {
+                'Content-Type': 'application/json; charset=utf-8',
+                'X-Moesif-Application-Id': Configuration.application_id,
+                'User-Agent': Configuration.version,
+            }
+            payload, content_encoding = yield self.encode_executor.submit(self.payload_encoder.encode, batch_events)
+            if content_encoding is not None:
+                headers['Content-Encoding'] = content_encoding
+            delay = self.rate_limiter.reserve(len(batch_events), len(payload))
+            if delay:
+                yield gen.sleep(delay)
+            request = HTTPRequest(APIHelper.clean_url(Configuration.BASE_URI + '/v1/events/batch'),
+                                  method='POST',
+                                  headers=headers,
+                                  body=payload,
+                                  request_timeout=self.request_timeout)
+            self.metrics.record_payload(len(payload))
+            # The latency of the batch excludes the encoding and the rate limit delay
+            send_time = time.time()
+            response = yield self.http_client.fetch(request)
+            success = True
+            self.delivered_batches += 1
+            self.metrics.record_batch(len(batch_events), time.time() - send_time, True)
+            self.circuit_breaker.record_success()
+            if self.debug:
+                print("Events sent successfully")
+            # Fetch Config ETag from response header
+            response_etag = response.headers.get("X-Moesif-Config-ETag")
+        except HTTPError as inst:
+            # Timeouts and connection errors are reported with the 599 status code
+            status_code = None if inst.code == 599 else inst.code
+            self.metrics.record_batch(len(batch_events), time.time() - send_time, False, status_code)
+            if status_code is not None and 401 <= status_code <= 403:
+                print("Unauthorized access sending event to Moesif. Please check your Application Id.")
+            if self.debug:
+                print("Error sending event to Moesif, with status code:")
+                print(inst.code)
+            self.handle_failure(batch_events, attempt, status_code)
+        except Exception as ex:
+            self.metrics.record_batch(len(batch_events), time.time() - start_time, False)
+            if self.debug:
+                print("Error sending event to Moesif")
+                print(str(ex))
+            self.handle_failure(batch_events, attempt, None)
+        self.concurrency.record(time.time() - start_time, success)
+        self.in_flight -= 1
+        self.in_flight_events -= len(batch_events)
+        self.slot_released.notify_all()
+        if response_etag is not None:
+            self.last_response_etag = response_etag
+        # Return Config Etag
+        raise gen.Return(response_etag)
+
+    @gen.coroutine
+    def can_replay(self, delivered_batches):
+        """Replay spilled events only once a batch of this drain was delivered, and none failed since"""
+        if self.delivered_batches == delivered_batches:
+            # Wait for the batches in flight to know whether Moesif accepts events again
+            while self.in_flight:
+                yield self.slot_released.wait()
+        raise gen.Return(self.delivered_batches > delivered_batches and self.circuit_breaker.is_healthy())
+
+    @gen.coroutine
+    def batch_events(self):
+        self.last_response_etag = None
+        sent_batches = 0
+        delivered_batches = self.delivered_batches
+        if self.spill_log is not None:
+            yield self.spill_executor.submit(self.spill_log.flush_pending)
+        # Keep sending full batches until the queue is drained, only the last batch may be partial.
+        # Batches due for a retry are sent first, and spilled events are replayed once the queue is empty
+        # and Moesif accepted a batch of this drain.
+        # Once stopped, the events left in the queue are sent by the flush of the middleware
+        while self.is_running and self.circuit_breaker.allow_request():
+            batch_events, attempt = self.retry_buffer.pop_due()
+            if batch_events is None:
+                batch_events = self.moesif_events_queue.get_batch(self.batch_size, self.batch_max_bytes)
+            if not batch_events and self.spill_log is not None and (yield self.can_replay(delivered_batches)):
+                batch_events = yield self.spill_executor.submit(self.spill_log.read_batch, self.batch_size,
+                                                                self.batch_max_bytes)
+            if not batch_events:
+                # Nothing was sent, do not hold the trial of a half open circuit breaker
+                self.circuit_breaker.cancel_trial()
+                break
+            # Wait for a free slot, up to the adaptive concurrency limit of batches are in flight
+            while self.in_flight >= self.concurrency.limit:
+                yield self.slot_released.wait()
+            self.in_flight += 1
+            self.in_flight_events += len(batch_events)
+            sent_batches += 1
+            IOLoop.current().spawn_callback(self.send_events, batch_events, attempt)
+        if not sent_batches and self.debug:
+            print("No events to send")
+        while self.in_flight:
+            yield self.slot_released.wait()
+        raise gen.Return(self.last_response_etag)
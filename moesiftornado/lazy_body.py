@@ -0,0 +1,30 @@
+from moesifapi.models import EventRequestModel, EventResponseModel
+
+
+class LazyBodyMixin(object):
+    """Keep the raw body bytes of a request or response model, parsed only when the model is serialized"""
+
+    raw_body = None
+
+    def set_raw_body(self, parse_body, body, headers, body_size, max_size):
+        self.raw_body = (parse_body, body, headers, body_size, max_size)
+
+    def materialize(self):
+        """Parse the raw body into the body and transfer encoding fields"""
+        if self.raw_body is not None:
+            parse_body, body, headers, body_size, max_size = self.raw_body
+            self.raw_body = None
+            self.body, self.transfer_encoding = parse_body.parse_body(body, headers, body_size, max_size)
+        return self
+
+    def to_dictionary(self):
+        self.materialize()
+        return super(LazyBodyMixin, self).to_dictionary()
+
+
+class LazyEventRequestModel(LazyBodyMixin, EventRequestModel):
+    pass
+
+
+class LazyEventResponseModel(LazyBodyMixin, EventResponseModel):
+    pass
@@ -3,21 +3,24 @@ try:
 except ImportError:
     from io import StringIO
 from .parse_body import ParseBody
-from datetime import datetime, timedelta
+from .request_context import RequestContext
 import json
+import time
 import base64
 
 
 class LoggerHelper:
 
-    def __init__(self):
+    def __init__(self, user_id_cache=None):
         self.parse_body = ParseBody()
+        self.user_id_cache = user_id_cache
 
     @classmethod
     def get_event_request_response_time(cls, handler):
-        request_time = datetime.utcnow()
-        response_time = request_time + timedelta(seconds=handler.request.request_time())
-        return request_time.strftime("%Y-%m-%dT%H:%M:%S.%f"), response_time.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        # Timestamps, formatted when the event is serialized
+        request_time = time.time()
+        response_time = request_time + handler.request.request_time()
+        return request_time, response_time
 
     @classmethod
     def transform_token(cls, token):
@@ -55,23 +58,76 @@ class LoggerHelper:
                 print(e)
         return None
 
-    def get_user_id(self, handler, moesif_config, debug):
+    @classmethod
+    def get_request_headers(cls, handler):
+        # Request headers with lowercased names
+        if handler.request.headers:
+            return dict([(k.lower(), v) for k, v in handler.request.headers.get_all()])
+        return {}
+
+    @classmethod
+    def get_event_headers(cls, handler):
+        # Request headers with the names logged to Moesif and seen by MASK_EVENT_MODEL
+        if handler.request.headers:
+            return dict(handler.request.headers.get_all())
+        return {}
+
+    def get_request_context(self, handler, settings, debug):
+        # Resolve the request values needed for sampling once
+        request_time, response_time = self.get_event_request_response_time(handler)
+        event_headers = self.get_event_headers(handler)
+        request_headers = dict([(k.lower(), v) for k, v in event_headers.items()])
+        return RequestContext(handler, request_headers, event_headers, request_time, response_time,
+                              self.get_user_id(handler, settings, debug, request_headers),
+                              self.get_company_id(handler, settings, debug))
+
+    def get_user_id_from_token(self, token, field, debug):
+        user_id = None
+        # Check if token is of type Bearer
+        if 'Bearer' in token:
+            # Fetch the bearer token
+            token = self.fetch_token(token, 'Bearer')
+            # Split the bearer token by dot(.)
+            split_token = self.split_token(token)
+            # Check if payload is not None
+            if len(split_token) >= 3 and split_token[1]:
+                # Parse and set user Id
+                user_id = self.parse_authorization_header(split_token[1], field, debug)
+        # Check if token is of type Basic
+        elif 'Basic' in token:
+            # Fetch the basic token
+            token = self.fetch_token(token, 'Basic')
+            # Decode the token
+            decoded_token = base64.b64decode(token)
+            # Transform token to string to be compatible with Python 2 and 3
+            decoded_token = self.transform_token(decoded_token)
+            # Fetch the username and set the user Id
+            user_id = decoded_token.split(':', 1)[0].strip()
+        # Check if token is of user-defined custom type
+        else:
+            # Split the token by dot(.)
+            split_token = self.split_token(token)
+            # Check if payload is not None
+            if len(split_token) > 1 and split_token[1]:
+                # Parse and set user Id
+                user_id = self.parse_authorization_header(split_token[1], field, debug)
+            else:
+                # Parse and set user Id
+                user_id = self.parse_authorization_header(token, field, debug)
+        return user_id
+
+    def get_user_id(self, handler, settings, debug, request_headers=None):
         user_id = None
         try:
-            if 'IDENTIFY_USER' in moesif_config:
-                user_id = moesif_config['IDENTIFY_USER'](handler)
+            if settings.identify_user is not None:
+                user_id = settings.identify_user(handler)
             if not user_id:
                 # Request headers
-                request_headers = {}
-                if handler.request.headers:
-                    request_headers = dict([(k.lower(), v) for k, v in handler.request.headers.get_all()])
-                # Fetch the auth header name from the config
-                auth_header_names = moesif_config.get('AUTHORIZATION_HEADER_NAME', 'authorization').lower()
-                # Split authorization header name by comma
-                auth_header_names = [x.strip() for x in auth_header_names.split(',')]
-                # Fetch the header name available in the request header
+                if request_headers is None:
+                    request_headers = self.get_request_headers(handler)
+                # Fetch the header name available in the request header, the names are split once in the settings
                 token = None
-                for auth_name in auth_header_names:
+                for auth_name in settings.authorization_header_names:
                     # Check if the auth header name in request headers
                     if auth_name in request_headers:
                         # Fetch the token from the request headers
@@ -85,40 +141,18 @@ class LoggerHelper:
                             token = None
                         break
                 # Fetch the field from the config
-                field = moesif_config.get('AUTHORIZATION_USER_ID_FIELD', 'sub').lower()
+                field = settings.authorization_user_id_field
                 # Check if token is not None
                 if token:
-                    # Check if token is of type Bearer
-                    if 'Bearer' in token:
-                        # Fetch the bearer token
-                        token = self.fetch_token(token, 'Bearer')
-                        # Split the bearer token by dot(.)
-                        split_token = self.split_token(token)
-                        # Check if payload is not None
-                        if len(split_token) >= 3 and split_token[1]:
-                            # Parse and set user Id
-                            user_id = self.parse_authorization_header(split_token[1], field, debug)
-                    # Check if token is of type Basic
-                    elif 'Basic' in token:
-                        # Fetch the basic token
-                        token = self.fetch_token(token, 'Basic')
-                        # Decode the token
-                        decoded_token = base64.b64decode(token)
-                        # Transform token to string to be compatible with Python 2 and 3
-                        decoded_token = self.transform_token(decoded_token)
-                        # Fetch the username and set the user Id
-                        user_id = decoded_token.split(':', 1)[0].strip()
-                    # Check if token is of user-defined custom type
+                    if self.user_id_cache is not None:
+                        # Reuse the user id resolved for the same header value
+                        cache_key = self.user_id_cache.get_key(token)
+                        is_cached, user_id = self.user_id_cache.get(cache_key)
+                        if not is_cached:
+                            user_id = self.get_user_id_from_token(token, field, debug)
+                            self.user_id_cache.put(cache_key, user_id)
                     else:
-                        # Split the token by dot(.)
-                        split_token = self.split_token(token)
-                        # Check if payload is not None
-                        if len(split_token) > 1 and split_token[1]:
-                            # Parse and set user Id
-                            user_id = self.parse_authorization_header(split_token[1], field, debug)
-                        else:
-                            # Parse and set user Id
-                            user_id = self.parse_authorization_header(token, field, debug)
+                        user_id = self.get_user_id_from_token(token, field, debug)
         except Exception as e:
             if debug:
                 print("can not execute identify_user function, please check moesif settings.")
@@ -126,11 +160,11 @@ class LoggerHelper:
         return user_id
 
     @classmethod
-    def get_company_id(cls, handler, moesif_config, debug):
+    def get_company_id(cls, handler, settings, debug):
         company_id = None
         try:
-            if 'IDENTIFY_COMPANY' in moesif_config:
-                company_id = moesif_config['IDENTIFY_COMPANY'](handler)
+            if settings.identify_company is not None:
+                company_id = settings.identify_company(handler)
         except Exception as e:
             if debug:
                 print("can not execute identify_company function, please check moesif settings.")
@@ -138,11 +172,11 @@ class LoggerHelper:
         return company_id
 
     @classmethod
-    def get_metadata(cls, handler, moesif_config, debug):
+    def get_metadata(cls, handler, settings, debug):
         metadata = None
         try:
-            if 'GET_METADATA' in moesif_config:
-                metadata = moesif_config['GET_METADATA'](handler)
+            if settings.get_metadata is not None:
+                metadata = settings.get_metadata(handler)
         except Exception as e:
             if debug:
                 print("can not execute get_metadata function, please check moesif settings.")
@@ -150,11 +184,11 @@ class LoggerHelper:
         return metadata
 
     @classmethod
-    def get_session_token(cls, handler, moesif_config, debug):
+    def get_session_token(cls, handler, settings, debug):
         session_token = None
         try:
-            if 'GET_SESSION_TOKEN' in moesif_config:
-                session_token = moesif_config['GET_SESSION_TOKEN'](handler)
+            if settings.get_session_token is not None:
+                session_token = settings.get_session_token(handler)
         except Exception as e:
             if debug:
                 print("can not execute get_session_token function, please check moesif settings.")
@@ -174,10 +208,10 @@ class LoggerHelper:
         return api_version
 
     @classmethod
-    def should_skip(cls, handler, moesif_config, debug):
+    def should_skip(cls, handler, settings, debug):
         try:
-            if 'SKIP' in moesif_config:
-                return moesif_config['SKIP'](handler)
+            if settings.skip is not None:
+                return settings.skip(handler)
         except Exception as e:
             if debug:
                 print("can not execute skip function, please check moesif settings.")
@@ -185,10 +219,10 @@ class LoggerHelper:
         return False
 
     @classmethod
-    def mask_event(cls, event_model, moesif_config, debug):
+    def mask_event(cls, event_model, settings, debug):
         try:
-            if 'MASK_EVENT_MODEL' in moesif_config:
-                return moesif_config['MASK_EVENT_MODEL'](event_model)
+            if settings.mask_event_model is not None:
+                return settings.mask_event_model(event_model)
         except Exception as e:
             if debug:
                 print("Can not execute MASK_EVENT_MODEL function, please check moesif settings.")
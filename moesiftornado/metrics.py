@@ -0,0 +1,148 @@
+import bisect
+import threading
+
+
+class Histogram(object):
+    """Counts of observed values by upper bound, updated under the lock of its Metrics"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last count is for the values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_stats(self):
+        """Return the cumulative count of values lower than or equal to each bucket, the count and the sum"""
+        cumulative_counts = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative_counts.append(total)
+        return {
+            'buckets': list(zip(self.buckets, cumulative_counts)),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+
+class Metrics(object):
+    """Counters of the events logged and histograms of the batches sent, cheap enough for the request path.
+
+    Event outcomes are counted on the thread logging or building the event, each counter update takes
+    an uncontended lock.
+    """
+
+    EVENT_OUTCOMES = ('seen', 'skipped', 'sampled_out', 'shed', 'enqueued', 'spilled', 'dropped', 'truncated')
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    BATCH_EVENTS_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+    BATCH_BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = dict.fromkeys(self.EVENT_OUTCOMES, 0)
+        self.batches_sent = 0
+        self.batches_failed = 0
+        # Status code of the failed batches, or 'error' when no response was received
+        self.failures = {}
+        self.batch_latency = Histogram(self.LATENCY_BUCKETS)
+        self.batch_events = Histogram(self.BATCH_EVENTS_BUCKETS)
+        self.batch_bytes = Histogram(self.BATCH_BYTES_BUCKETS)
+
+    def count_event(self, outcome):
+        with self.lock:
+            self.events[outcome] += 1
+
+    def record_batch(self, events, latency, success, status_code=None):
+        with self.lock:
+            self.batch_latency.observe(latency)
+            self.batch_events.observe(events)
+            if success:
+                self.batches_sent += 1
+            else:
+                self.batches_failed += 1
+                status = str(status_code) if status_code is not None else 'error'
+                self.failures[status] = self.failures.get(status, 0) + 1
+
+    def record_payload(self, size):
+        with self.lock:
+            self.batch_bytes.observe(size)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'events': dict(self.events),
+                'batches_sent': self.batches_sent,
+                'batches_failed': self.batches_failed,
+                'failures': dict(self.failures),
+                'batch_latency': self.batch_latency.get_stats(),
+                'batch_events': self.batch_events.get_stats(),
+                'batch_bytes': self.batch_bytes.get_stats(),
+            }
+
+
+def format_histogram(lines, name, help_text, histogram):
+    lines.append('# HELP ' + name + ' ' + help_text)
+    lines.append('# TYPE ' + name + ' histogram')
+    for bucket, count in histogram['buckets']:
+        lines.append(name + '_bucket{le="' + repr(float(bucket)) + '"} ' + str(count))
+    lines.append(name + '_bucket{le="+Inf"} ' + str(histogram['count']))
+    lines.append(name + '_sum ' + repr(float(histogram['sum'])))
+    lines.append(name + '_count ' + str(histogram['count']))
+
+
+def format_metric(lines, name, metric_type, help_text, values):
+    """Add a metric, values is a list of (labels, value) with labels a list of (name, value)"""
+    lines.append('# HELP ' + name + ' ' + help_text)
+    lines.append('# TYPE ' + name + ' ' + metric_type)
+    for labels, value in values:
+        label_text = ''
+        if labels:
+            label_text = '{' + ','.join(label + '="' + str(label_value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                                        for label, label_value in labels) + '}'
+        value_text = repr(value) if isinstance(value, float) else str(value)
+        lines.append(name + label_text + ' ' + value_text)
+
+
+def format_prometheus(stats):
+    """Return the stats of MoesifMiddleware.get_stats in the Prometheus text exposition format"""
+    lines = []
+    metrics = stats['metrics']
+    format_metric(lines, 'moesif_events_total', 'counter', 'Events by outcome',
+                  [([('outcome', outcome)], count) for outcome, count in sorted(metrics['events'].items())])
+    format_metric(lines, 'moesif_event_queue_events', 'gauge', 'Events waiting in the queue',
+                  [([], stats['event_queue']['size'])])
+    format_metric(lines, 'moesif_event_queue_bytes', 'gauge', 'Estimated bytes of the events waiting in the queue',
+                  [([], stats['event_queue']['bytes'])])
+    format_metric(lines, 'moesif_event_queue_dropped_total', 'counter', 'Events dropped by the queue overflow policy',
+                  [([], stats['event_queue']['dropped'])])
+    format_metric(lines, 'moesif_batches_total', 'counter', 'Batches sent to Moesif by result',
+                  [([('result', 'sent')], metrics['batches_sent']), ([('result', 'failed')], metrics['batches_failed'])])
+    format_metric(lines, 'moesif_batch_failures_total', 'counter', 'Failed batches by status code',
+                  [([('status', status)], count) for status, count in sorted(metrics['failures'].items())])
+    format_histogram(lines, 'moesif_batch_latency_seconds', 'Time to send a batch', metrics['batch_latency'])
+    format_histogram(lines, 'moesif_batch_events', 'Events per batch', metrics['batch_events'])
+    format_histogram(lines, 'moesif_batch_payload_bytes', 'Bytes of the batch payloads, after compression',
+                     metrics['batch_bytes'])
+    retry = stats['retry']
+    format_metric(lines, 'moesif_retry_buffer_batches', 'gauge', 'Batches waiting for a retry',
+                  [([], retry['size'])])
+    format_metric(lines, 'moesif_circuit_breaker_open', 'gauge', '1 while the circuit breaker is open',
+                  [([], 1 if retry['circuit_breaker']['state'] == 'open' else 0)])
+    if 'spill' in retry:
+        format_metric(lines, 'moesif_spill_bytes', 'gauge', 'Bytes of the events spilled to disk',
+                      [([], retry['spill']['bytes'])])
+    config = stats['config']
+    format_metric(lines, 'moesif_config_age_seconds', 'gauge', 'Time since the configuration was last fetched',
+                  [([], config['age'])])
+    if stats['profiles'] is not None:
+        format_metric(lines, 'moesif_profile_updates_total', 'counter', 'Profile updates by kind and result',
+                      [([('kind', kind), ('result', result)], profile_stats[result])
+                       for kind, profile_stats in sorted(stats['profiles'].items())
+                       for result in ('sent', 'failed', 'merged', 'dropped')])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,13 @@
+from tornado.web import RequestHandler
+from .metrics import format_prometheus
+
+
+class MoesifMetricsHandler(RequestHandler):
+    """Serve the stats of a MoesifMiddleware in the Prometheus text format"""
+
+    def initialize(self, middleware):
+        self.middleware = middleware
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(format_prometheus(self.middleware.get_stats()))
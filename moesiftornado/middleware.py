@@ -1,5 +1,6 @@
 
 from moesifapi.moesif_api_client import *
+from moesifapi.models import UserModel, CompanyModel
 from datetime import datetime, timedelta
 from .app_config import AppConfig
 from .logger_helper import LoggerHelper
@@ -7,11 +8,31 @@ from .event_mapper import EventMapper
 from .update_users import User
 from .update_companies import Company
 from .send_batch_events import SendEventAsync
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+from .event_queue import EventQueue
+from .ioloop_send_events import SendEventIOLoop
+from .retry_buffer import RetryBuffer
+from .circuit_breaker import CircuitBreaker
+from .spill_log import SpillLog
+from .user_id_cache import UserIdCache
+from .settings import MoesifSettings
+from .response_capture import ResponseBodyCapture
+from .event_workers import EventWorkers
+from .payload_encoder import PayloadEncoder
+from .event_serializer import EventSerializer
+from .aggregator_client import AggregatorClient
+from .profile_queue import ProfileQueue
+from .profile_cache import ProfileChangeCache
+from .rate_limiter import RateLimiter
+from .metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
 import atexit
-import queue
+import os
+import threading
+import time
+import functools
+import signal
 import random
 import math
 import logging
@@ -19,165 +40,640 @@ import logging
 class MoesifMiddleware(object):
 
     def __init__(self, moesif_config):
-        if moesif_config is None:
-            raise Exception('Moesif Application ID is required in settings')
-        self.moesif_config = moesif_config
+        # Validate and compile the settings once, the request path only reads attributes
+        self.settings = MoesifSettings(moesif_config)
+        self.client = MoesifAPIClient(self.settings.application_id)
 
-        if self.moesif_config.get('APPLICATION_ID', None):
-            self.client = MoesifAPIClient(self.moesif_config.get('APPLICATION_ID'))
-        else:
-            raise Exception('Moesif Application ID is required in settings')
-
-        if self.moesif_config.get('DEBUG', False):
-            Configuration.BASE_URI = self.get_configuration_uri(self.moesif_config, 'BASE_URI', 'LOCAL_MOESIF_BASEURL')
+        if self.settings.debug:
+            Configuration.BASE_URI = self.settings.base_uri
         Configuration.version = 'moesiftornado-python/0.1.4'
-        self.DEBUG = self.moesif_config.get('DEBUG', False)
-        self.api_version = self.moesif_config.get('API_VERSION', None)
+        self.DEBUG = self.settings.debug
+        # Counters of the events logged and the batches sent, see get_stats
+        self.metrics = Metrics()
+        self.api_version = self.settings.api_version
         self.api_client = self.client.api
-        self.LOG_BODY = self.moesif_config.get('LOG_BODY', True)
+        self.LOG_BODY = self.settings.log_body
         self.app_config = AppConfig()
-        self.logger_helper = LoggerHelper()
-        self.event_mapper = EventMapper()
-        self.config_etag = None
-        self.config = self.app_config.get_config(self.api_client, self.DEBUG)
+        self.user_id_cache = None
+        if self.settings.authorization_cache_size > 0:
+            self.user_id_cache = UserIdCache(self.settings.authorization_cache_size,
+                                             self.settings.authorization_cache_ttl)
+        self.logger_helper = LoggerHelper(self.user_id_cache)
+        self.event_mapper = EventMapper(self.settings.trusted_proxies, self.settings.request_body_max_size)
+        # Build the events off the IOLoop when event workers are enabled
+        self.event_workers = None
+        if self.settings.event_workers:
+            self.event_workers = EventWorkers(self.settings.event_workers, self.settings.event_worker_queue_size,
+                                              self.settings.event_worker_queue_bytes, self.settings.debug)
+        # Serializes the batches from the wire format events
+        self.event_serializer = EventSerializer()
+        # Forward the events to the aggregator of the host, which also serves the application configuration
+        self.aggregator_client = None
+        if self.settings.aggregator_socket:
+            self.aggregator_client = AggregatorClient(self.settings.aggregator_socket,
+                                                      self.settings.aggregator_timeout,
+                                                      serializer=self.event_serializer,
+                                                      debug=self.DEBUG)
+        # Start from the cached configuration, or the default sampling, until the configuration is fetched
+        self.config = None
+        if self.settings.config_cache_file:
+            self.config = self.app_config.load_cached_config(self.settings.config_cache_file, self.DEBUG)
+        # Parse the configuration once, the sampling rules are swapped as a whole on refresh
+        self.config_etag, self.sampling_rules, self.last_updated_time = self.app_config.parse_configuration(
+            self.config, self.DEBUG)
         self.sampling_percentage = 100
-        self.last_updated_time = datetime.utcnow()
-        self.send_async_events = SendEventAsync()
-        self.moesif_events_queue = queue.Queue()
-        self.BATCH_SIZE = self.moesif_config.get('BATCH_SIZE', 25)
+        self.MAX_CONCURRENT_BATCHES = self.settings.max_concurrent_batches
+        self.retry_buffer = RetryBuffer(self.settings.retry_buffer_size,
+                                        self.settings.max_retries,
+                                        self.settings.retry_backoff_base,
+                                        self.settings.retry_backoff_max)
+        self.circuit_breaker = CircuitBreaker(self.settings.circuit_breaker_threshold,
+                                              self.settings.circuit_breaker_cooldown)
+        self.spill_log = None
+        if self.settings.spill_directory:
+            self.spill_log = SpillLog(self.settings.spill_directory,
+                                      self.settings.spill_max_bytes,
+                                      self.settings.spill_segment_bytes,
+                                      # Events waiting for the next bulk write take at most a segment of memory
+                                      self.settings.spill_segment_bytes,
+                                      debug=self.DEBUG,
+                                      serializer=self.event_serializer)
+        self.payload_encoder = PayloadEncoder(self.settings.batch_compression,
+                                              self.settings.batch_compression_level,
+                                              self.settings.batch_compression_min_size,
+                                              self.event_serializer)
+        # Paces the batches sent to Moesif, shared by the senders
+        self.rate_limiter = RateLimiter(self.settings.rate_limit_events, self.settings.rate_limit_bytes)
+        self.send_async_events = SendEventAsync(self.MAX_CONCURRENT_BATCHES, self.retry_buffer, self.circuit_breaker,
+                                                self.spill_log, self.payload_encoder, self.aggregator_client,
+                                                self.settings.batch_max_bytes, self.rate_limiter, self.metrics)
+        self.moesif_events_queue = EventQueue(self.settings.event_queue_size,
+                                              self.settings.event_queue_bytes,
+                                              self.settings.event_queue_overflow_policy,
+                                              self.settings.event_queue_block_timeout)
+        self.BATCH_SIZE = self.settings.batch_size
+        self.BATCH_MAX_TIME = self.settings.batch_max_time
+        self.is_flush_scheduled = False
+        # Batches forwarded to the aggregator are written to its socket from the background thread
+        self.IOLOOP_DELIVERY = self.settings.ioloop_delivery and self.aggregator_client is None
+        self.ioloop_send_events = None
+        self.config_executor = None
+        self.config_fetched = threading.Event()
+        self.config_refresh_stopped = threading.Event()
+        # Held by the refresh in progress, concurrent refreshes are skipped
+        self.config_lock = threading.Lock()
+        if self.IOLOOP_DELIVERY:
+            self.ioloop_send_events = SendEventIOLoop(self.moesif_events_queue, self.BATCH_SIZE, self.BATCH_MAX_TIME,
+                                                      self.DEBUG, batch_listener=self.ioloop_batch_listener,
+                                                      max_concurrent_batches=self.MAX_CONCURRENT_BATCHES,
+                                                      retry_buffer=self.retry_buffer,
+                                                      circuit_breaker=self.circuit_breaker,
+                                                      spill_log=self.spill_log,
+                                                      payload_encoder=self.payload_encoder,
+                                                      batch_max_bytes=self.settings.batch_max_bytes,
+                                                      rate_limiter=self.rate_limiter,
+                                                      metrics=self.metrics)
+            # Config is fetched with the blocking api client, keep it off the IOLoop
+            self.config_executor = ThreadPoolExecutor(max_workers=1)
         self.last_event_job_run_time = datetime(1970, 1, 1, 0, 0)  # Assuming job never ran, set it to epoch start time
         self.scheduler = None
         self.is_event_job_scheduled = False
         self.user = User()
         self.company = Company()
+        # Profile updates are merged by id and sent in batches from a background thread
+        self.user_queue = None
+        self.company_queue = None
+        if self.settings.profile_updates_async:
+            # Skip the updates equal to the last profile sent, when the change cache is enabled
+            user_change_cache = company_change_cache = None
+            if self.settings.profile_change_cache_size > 0:
+                user_change_cache = ProfileChangeCache(self.settings.profile_change_cache_size,
+                                                       self.settings.profile_change_cache_ttl)
+                company_change_cache = ProfileChangeCache(self.settings.profile_change_cache_size,
+                                                          self.settings.profile_change_cache_ttl)
+            self.user_queue = ProfileQueue('user_id', UserModel, self.api_client.update_users_batch,
+                                           self.settings.profile_batch_size, self.settings.profile_batch_max_time,
+                                           self.settings.profile_queue_size, self.DEBUG, user_change_cache)
+            self.company_queue = ProfileQueue('company_id', CompanyModel, self.api_client.update_companies_batch,
+                                              self.settings.profile_batch_size,
+                                              self.settings.profile_batch_max_time,
+                                              self.settings.profile_queue_size, self.DEBUG, company_change_cache)
+        self.SHUTDOWN_TIMEOUT = self.settings.shutdown_timeout
+        self.FLUSH_BATCH_SIZE = self.settings.flush_batch_size
+        self.is_closed = False
+        self.close_report = None
+        # Set once close flushed the queue, the events of the requests finishing later are added to the close report
+        self.is_queue_closed = False
+        self.closed_events = {'spilled': 0, 'dropped': 0}
+        self.close_lock = threading.Lock()
+        # Process running the configuration refresh thread, started on first use by start_config_refresh
+        self.config_pid = None
+        self.is_config_refresh_started = False
+        # Reset in the forked processes, so log_event only checks the flag instead of calling getpid
+        self.can_detect_fork = hasattr(os, 'register_at_fork')
+        if self.can_detect_fork:
+            os.register_at_fork(after_in_child=self.reset_config_refresh)
+        # Flush the queued events when the process exits
+        atexit.register(self.close)
 
-    # Function to get configuration uri
-    def get_configuration_uri(self, settings, field, deprecated_field):
-        uri = settings.get(field)
-        if uri:
-            return uri
-        else:
-            return settings.get(deprecated_field, 'https://api.moesif.net')
+    def process_data(self, snapshot, weight):
+        # Without a mask hook, the event is buffered as a compact record, the models are only built for the hook
+        if self.settings.mask_event_model is None:
+            return self.event_mapper.to_record(snapshot, self.api_version, weight)
 
-    def process_data(self, handler, event_request_time, event_response_time):
         # Prepare Event Request Model
-        event_req = self.event_mapper.to_request(handler, self.LOG_BODY, self.api_version, event_request_time)
+        event_req = self.event_mapper.to_request(snapshot, self.api_version)
 
         # Prepare Event Response Model
-        event_rsp = self.event_mapper.to_response(handler, event_response_time)
+        event_rsp = self.event_mapper.to_response(snapshot)
 
         # Prepare Event Model
-        event_model = self.event_mapper.to_event(handler, self.moesif_config, event_req, event_rsp, self.DEBUG)
+        event_model = self.event_mapper.to_event(snapshot, event_req, event_rsp)
 
-        # Mask Event Model
-        return self.logger_helper.mask_event(event_model, self.moesif_config, self.DEBUG)
+        # Mask Event Model, the hook sees the parsed bodies
+        event_req.materialize()
+        event_rsp.materialize()
+        event_model = self.logger_helper.mask_event(event_model, self.settings, self.DEBUG)
+        if event_model:
+            # Add Weight to the event
+            event_model.weight = weight
+        return event_model
 
     def log_event(self, handler):
+        self.metrics.count_event('seen')
+        self.start_config_refresh()
+
+        # Shed events cheaply while Moesif is unreachable, unless they can be spilled to disk
+        if self.spill_log is None and self.circuit_breaker.is_open():
+            self.circuit_breaker.shed_events += 1
+            self.metrics.count_event('shed')
+            if self.DEBUG:
+                print('Skipped Event as the circuit breaker is open')
+            return
 
-        # Prepare event request and response time
-        event_request_time, event_response_time = self.logger_helper.get_event_request_response_time(handler)
         # Check if need to skip logging event
-        if not self.logger_helper.should_skip(handler, self.moesif_config, self.DEBUG):
+        if not self.logger_helper.should_skip(handler, self.settings, self.DEBUG):
             random_percentage = random.random() * 100
 
-            self.sampling_percentage = self.app_config.get_sampling_percentage(self.config,
-                                                                               self.logger_helper.get_user_id(
-                                                                                   handler, self.moesif_config, self.DEBUG),
-                                                                               self.logger_helper.get_company_id(
-                                                                                   handler, self.moesif_config, self.DEBUG))
+            # Resolve the request time, headers, user and company once for sampling and mapping
+            context = self.logger_helper.get_request_context(handler, self.settings, self.DEBUG)
+
+            self.sampling_percentage = self.app_config.get_sampling_percentage(self.sampling_rules,
+                                                                               context.user_id,
+                                                                               context.company_id)
 
             if self.sampling_percentage > random_percentage:
-                # Prepare event to be sent to Moesif
-                event_data = self.process_data(handler, event_request_time, event_response_time)
-                if event_data:
-                    # Add Weight to the event
-                    event_data.weight = 1 if self.sampling_percentage == 0 else math.floor(
-                        100 / self.sampling_percentage)
-                    try:
-                        if not self.is_event_job_scheduled and datetime.utcnow() > self.last_event_job_run_time + timedelta(
-                                minutes=5):
-                            try:
-                                self.schedule_background_job()
-                                self.is_event_job_scheduled = True
-                                self.last_event_job_run_time = datetime.utcnow()
-                            except Exception as ex:
-                                self.is_event_job_scheduled = False
-                                if self.DEBUG:
-                                    print('Error while starting the event scheduler job in background')
-                                    print(str(ex))
-                        # Add Event to the queue
-                        if self.DEBUG:
-                            print('Add Event to the queue')
-                        self.moesif_events_queue.put(event_data)
-                    except Exception as ex:
-                        if self.DEBUG:
-                            print("Error while adding event to the queue")
-                            print(str(ex))
-                else:
+                try:
+                    if not self.is_closed and not self.is_event_job_scheduled and datetime.utcnow() > self.last_event_job_run_time + timedelta(
+                            minutes=5):
+                        try:
+                            self.schedule_background_job()
+                            self.is_event_job_scheduled = True
+                            self.last_event_job_run_time = datetime.utcnow()
+                        except Exception as ex:
+                            self.is_event_job_scheduled = False
+                            if self.DEBUG:
+                                print('Error while starting the event scheduler job in background')
+                                print(str(ex))
+                    # Copy the values of the request, the handler is not used past this point
+                    snapshot = self.event_mapper.to_snapshot(context, self.settings, self.sampling_percentage,
+                                                             self.DEBUG)
+                    if self.event_workers is None or self.is_queue_closed:
+                        self.add_event(snapshot)
+                    else:
+                        # The snapshot holds its bodies until a worker builds the event
+                        estimated_size = self.event_mapper.estimate_event_size(snapshot)
+                        if not self.event_workers.submit(estimated_size, self.add_event, snapshot, estimated_size):
+                            self.metrics.count_event('dropped')
+                            if self.DEBUG:
+                                print('Dropped Event as too many events are waiting to be built')
+                except Exception as ex:
+                    self.metrics.count_event('dropped')
                     if self.DEBUG:
-                        print('Skipped Event as the moesif event model is None')
+                        print("Error while adding event to the queue")
+                        print(str(ex))
             else:
+                self.metrics.count_event('sampled_out')
                 if self.DEBUG:
                     print("Skipped Event due to sampling percentage: " + str(
                         self.sampling_percentage) + " and random percentage: " + str(random_percentage))
         else:
+            self.metrics.count_event('skipped')
             if self.DEBUG:
                 print('Skipped Event using should_skip configuration option')
 
+    def add_event(self, snapshot, estimated_size=None):
+        """Build the event of a request snapshot and add it to the queue, on the IOLoop or an event worker"""
+        # Prepare event to be sent to Moesif
+        weight = 1 if snapshot.sampling_percentage == 0 else math.floor(100 / snapshot.sampling_percentage)
+        event_data = self.process_data(snapshot, weight)
+        if event_data:
+            # Add Event to the queue
+            if self.DEBUG:
+                print('Add Event to the queue')
+            if estimated_size is None:
+                estimated_size = self.event_mapper.estimate_event_size(snapshot)
+            event_data, event_size = self.event_mapper.limit_event_size(event_data, estimated_size,
+                                                                        self.settings.batch_max_bytes,
+                                                                        self.settings.oversized_event_policy)
+            if event_data is None:
+                self.metrics.count_event('dropped')
+                if self.DEBUG:
+                    print('Skipped Event as it is larger than BATCH_MAX_BYTES')
+                return
+            if event_size != estimated_size:
+                self.metrics.count_event('truncated')
+            self.queue_event(event_data, event_size)
+        else:
+            self.metrics.count_event('skipped')
+            if self.DEBUG:
+                print('Skipped Event as the moesif event model is None')
+
+    def queue_event(self, event_data, event_size):
+        if self.is_queue_closed:
+            self.add_closed_event(event_data)
+            return
+        if self.moesif_events_queue.put(event_data, event_size):
+            self.metrics.count_event('enqueued')
+        elif self.spill_log is not None and self.spill_log.add(event_data, event_size):
+            self.metrics.count_event('spilled')
+            if self.DEBUG:
+                print('Spilled Event to disk as the event queue is full')
+        else:
+            self.metrics.count_event('dropped')
+            if self.DEBUG:
+                print('Dropped Event as the event queue is full')
+        # Flush as soon as a full batch is available instead of waiting for the timer
+        if self.moesif_events_queue.qsize() >= self.BATCH_SIZE:
+            self.schedule_flush()
+
+    def add_closed_event(self, event_data):
+        # The senders are stopped and the queue was flushed by close, the event is spilled to disk or dropped
+        if self.spill_log is not None and self.spill_log.append([event_data]):
+            outcome = 'spilled'
+        else:
+            outcome = 'dropped'
+        self.metrics.count_event(outcome)
+        with self.close_lock:
+            self.closed_events[outcome] += 1
+            if self.close_report is not None:
+                self.close_report[outcome] += 1
+        if self.DEBUG:
+            print('Event ' + outcome + ' as the middleware is closed')
+
+    def capture_response_body(self, application):
+        """Capture the response bodies of the application, up to RESPONSE_BODY_MAX_SIZE bytes per response.
+
+        Must be called before the application serves requests.
+        """
+        if not self.LOG_BODY:
+            if self.DEBUG:
+                print('Response bodies are not captured as LOG_BODY is disabled')
+            return
+        # The capture runs before the other transforms, so it sees the body before it is compressed
+        application.transforms.insert(0, functools.partial(ResponseBodyCapture,
+                                                           max_size=self.settings.response_body_max_size))
+
+    def schedule_flush(self):
+        if self.is_flush_scheduled or not self.is_event_job_scheduled:
+            return
+        if self.IOLOOP_DELIVERY:
+            if self.event_workers is not None:
+                self.ioloop_send_events.notify_threadsafe()
+            else:
+                self.ioloop_send_events.notify()
+            return
+        try:
+            self.is_flush_scheduled = True
+            self.scheduler.modify_job('moesif_events_batch_job', next_run_time=datetime.now())
+        except Exception as ex:
+            self.is_flush_scheduled = False
+            if self.DEBUG:
+                print('Error while scheduling the events flush')
+                print(str(ex))
+
     # Function to listen to the send event job response
     def moesif_event_listener(self, event):
+        # The batch job drains the queue, allow the next full batch to trigger an early flush
+        self.is_flush_scheduled = False
         if event.exception:
             if self.DEBUG:
                 print('Error reading response from the scheduled job')
         else:
             if event.retval:
                 response_etag, self.last_event_job_run_time = event.retval
-                if response_etag is not None \
-                    and self.config_etag is not None \
-                    and self.config_etag != response_etag \
-                        and datetime.utcnow() > self.last_updated_time + timedelta(minutes=5):
-                    try:
-                        self.config = self.app_config.get_config(self.api_client, self.DEBUG)
-                        self.config_etag, self.sampling_percentage, self.last_updated_time = self.app_config.parse_configuration(
-                            self.config, self.DEBUG)
-                    except Exception as ex:
-                        if self.DEBUG:
-                            print('Error while updating the application configuration')
-                            print(str(ex))
+                if self.is_config_stale(response_etag):
+                    self.update_config()
+
+    # Function to listen to the batches sent from the IOLoop
+    def ioloop_batch_listener(self, response_etag):
+        self.last_event_job_run_time = datetime.utcnow()
+        if self.is_config_stale(response_etag):
+            self.config_executor.submit(self.update_config)
+
+    def is_config_stale(self, response_etag):
+        return response_etag is not None \
+            and self.config_etag != response_etag \
+            and datetime.utcnow() > self.last_updated_time + timedelta(minutes=5)
+
+    def get_config(self):
+        if self.aggregator_client is not None and self.aggregator_client.is_available():
+            config = self.app_config.get_config(self.aggregator_client, self.DEBUG)
+            if config is not None:
+                return config
+        # Conditional on the ETag of the current configuration, answered with 304 when it did not change
+        return self.app_config.get_config(self.api_client, self.DEBUG, self.config_etag)
+
+    def start_config_refresh(self):
+        """Fetch and refresh the configuration from a background thread of the current process, on first use.
+
+        The thread is not started when the middleware is created, so a middleware created before the server forks
+        its processes starts one in each process, and creating the middleware does not wait on the network.
+        """
+        if self.is_config_refresh_started and (self.can_detect_fork or self.config_pid == os.getpid()):
+            return
+        if self.is_closed:
+            return
+        self.config_pid = os.getpid()
+        self.is_config_refresh_started = True
+        # A lock held by a thread of the parent process when it forked is never released in this process
+        self.config_lock = threading.Lock()
+        self.config_refresh_stopped = threading.Event()
+        config_thread = threading.Thread(target=self.refresh_config, name='moesif-config')
+        config_thread.daemon = True
+        config_thread.start()
+
+    def reset_config_refresh(self):
+        # The refresh thread of the parent process does not exist in the forked process
+        self.is_config_refresh_started = False
+
+    def refresh_config(self):
+        """Fetch the configuration, then refresh it every CONFIG_REFRESH_INTERVAL seconds until closed"""
+        self.update_config()
+        self.config_fetched.set()
+        interval = self.settings.config_refresh_interval
+        # Spread the refreshes of the processes started together
+        while interval and not self.config_refresh_stopped.wait(interval * random.uniform(0.9, 1.1)):
+            self.update_config()
+
+    def wait_for_config(self, timeout=None):
+        """Wait at most timeout seconds for the first configuration fetch, return True once it was attempted"""
+        self.start_config_refresh()
+        return self.config_fetched.wait(timeout)
+
+    def update_config(self):
+        if not self.config_lock.acquire(False):
+            return
+        try:
+            config = self.get_config()
+            if config is None:
+                # Keep the last known configuration
+                return
+            previous_etag = self.config_etag
+            if config.status_code == 304 or (previous_etag is not None and
+                                             config.headers.get('X-Moesif-Config-ETag') == previous_etag):
+                # Not modified, the rules are not parsed again
+                self.last_updated_time = datetime.utcnow()
+                return
+            self.config_etag, self.sampling_rules, self.last_updated_time = self.app_config.parse_configuration(
+                config, self.DEBUG)
+            self.config = config
+            if self.settings.config_cache_file and (self.config_etag is None or self.config_etag != previous_etag):
+                self.app_config.save_cached_config(self.settings.config_cache_file, config, self.DEBUG)
+        except Exception as ex:
+            if self.DEBUG:
+                print('Error while updating the application configuration')
+                print(str(ex))
+        finally:
+            self.config_lock.release()
 
     def schedule_background_job(self):
+        if self.IOLOOP_DELIVERY:
+            # Deliver events from a coroutine on the IOLoop, log_event is called from the IOLoop thread
+            self.ioloop_send_events.start()
+            return
         try:
+            # Imported only when the background thread is used
+            from apscheduler.schedulers.background import BackgroundScheduler
+            from apscheduler.triggers.interval import IntervalTrigger
+            from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+
             if not self.scheduler:
                 self.scheduler = BackgroundScheduler(daemon=True)
             if not self.scheduler.get_jobs():
                 self.scheduler.add_listener(self.moesif_event_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
                 self.scheduler.start()
                 self.scheduler.add_job(
-                    func=lambda: self.send_async_events.batch_events(self.api_client, self.moesif_events_queue,
-                                                                     self.DEBUG, self.BATCH_SIZE),
-                    trigger=IntervalTrigger(seconds=2),
+                    func=self.run_batch_job,
+                    trigger=IntervalTrigger(seconds=self.BATCH_MAX_TIME),
                     id='moesif_events_batch_job',
-                    name='Schedule events batch job every 2 second',
+                    name='Schedule events batch job every ' + str(self.BATCH_MAX_TIME) + ' second',
+                    max_instances=1,
+                    coalesce=True,
                     replace_existing=True)
 
                 # Avoid passing logging message to the ancestor loggers
                 logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
                 logging.getLogger('apscheduler.executors.default').propagate = False
-
-                # Exit handler when exiting the app
-                atexit.register(lambda: self.send_async_events.exit_handler(self.scheduler, self.DEBUG))
+                # A timer run is skipped while a long drain is still running, the running job sends its events
+                logging.getLogger('apscheduler.scheduler').setLevel(logging.ERROR)
         except Exception as ex:
             if self.DEBUG:
                 print("Error when scheduling the job")
                 print(str(ex))
 
+    def run_batch_job(self):
+        # The running job drains the queue, an early flush must not be scheduled until it is done
+        self.is_flush_scheduled = True
+        return self.send_async_events.batch_events(self.api_client, self.moesif_events_queue, self.DEBUG,
+                                                   self.BATCH_SIZE)
+
+    def flush(self, timeout=None):
+        """Send the queued events to Moesif, waiting at most timeout seconds.
+
+        Return a dictionary with the number of events flushed, and the number of events still in flight
+        at the deadline. Events which could not be sent stay queued for a retry.
+        """
+        timeout = self.SHUTDOWN_TIMEOUT if timeout is None else timeout
+        if self.event_workers is not None:
+            # Let the workers add the events of the requests already finished to the queue
+            start_time = time.time()
+            self.event_workers.wait(timeout)
+            timeout = max(0, timeout - (time.time() - start_time))
+        start_time = time.time()
+        flushed, in_flight = self.send_async_events.flush(self.api_client, self.moesif_events_queue, self.DEBUG,
+                                                          self.FLUSH_BATCH_SIZE, timeout)
+        timeout = max(0, timeout - (time.time() - start_time))
+        for profile_queue in (self.user_queue, self.company_queue):
+            if profile_queue is not None:
+                start_time = time.time()
+                profile_queue.flush(timeout)
+                timeout = max(0, timeout - (time.time() - start_time))
+        return {'flushed': flushed, 'in_flight': in_flight}
+
+    def close(self, timeout=None):
+        """Stop the background delivery and flush the queued events within timeout seconds.
+
+        The batches already sent by the background job are waited for within the same deadline. Events not
+        sent before the deadline are spilled to disk when SPILL_DIRECTORY is set, and dropped otherwise, events
+        still in flight are counted as dropped. The events of the requests finishing once the queue was flushed are
+        spilled or dropped as well. Return a dictionary with the number of events flushed, spilled and dropped,
+        updated with the events of the requests finishing later.
+        """
+        if self.is_closed:
+            return self.close_report
+        self.is_closed = True
+        self.config_refresh_stopped.set()
+        for profile_queue in (self.user_queue, self.company_queue):
+            if profile_queue is not None:
+                # The pending updates are sent by flush
+                profile_queue.stop()
+        try:
+            timeout = self.SHUTDOWN_TIMEOUT if timeout is None else timeout
+            start_time = time.time()
+            delivered_events = self.send_async_events.delivered_events
+            if self.scheduler:
+                self.send_async_events.exit_handler(self.scheduler, self.DEBUG)
+            # Let the running batch job finish its batches, the rest of the queue is flushed below
+            self.send_async_events.stop(timeout)
+            if self.ioloop_send_events is not None:
+                self.ioloop_send_events.stop()
+
+            report = self.flush(max(0, timeout - (time.time() - start_time)))
+            self.is_queue_closed = True
+            if self.event_workers is not None:
+                self.event_workers.shutdown()
+            report['flushed'] += self.send_async_events.delivered_events - delivered_events
+            # Events in flight at the deadline are abandoned when the process exits
+            report['dropped'] = report.pop('in_flight') + self.send_async_events.in_flight_events
+            if self.ioloop_send_events is not None:
+                report['dropped'] += self.ioloop_send_events.in_flight_events
+            report['spilled'] = 0
+            leftover_batches = self.retry_buffer.drain()
+            while not self.moesif_events_queue.empty():
+                leftover_batches.append(self.moesif_events_queue.get_batch(self.FLUSH_BATCH_SIZE))
+            for batch_events in leftover_batches:
+                if self.spill_log is not None and self.spill_log.append(batch_events):
+                    report['spilled'] += len(batch_events)
+                else:
+                    report['dropped'] += len(batch_events)
+            if self.spill_log is not None:
+                self.spill_log.close()
+        except Exception as ex:
+            self.is_queue_closed = True
+            report = {'flushed': 0, 'spilled': 0, 'dropped': 0}
+            if self.DEBUG:
+                print('Error while closing the moesif middleware')
+                print(str(ex))
+
+        with self.close_lock:
+            report['spilled'] += self.closed_events['spilled']
+            report['dropped'] += self.closed_events['dropped']
+            self.close_report = report
+        if self.DEBUG or report['dropped']:
+            print('Moesif middleware closed, events flushed: ' + str(report['flushed']) + ', spilled: ' +
+                  str(report['spilled']) + ', dropped: ' + str(report['dropped']))
+        return report
+
+    def install_shutdown_handler(self, io_loop=None):
+        """Close the middleware on SIGTERM and then stop the IOLoop, or call the previous SIGTERM handler.
+
+        Must be called from the thread running the IOLoop.
+        """
+        io_loop = io_loop or IOLoop.current()
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        asyncio_loop = getattr(io_loop, 'asyncio_loop', None)
+        if asyncio_loop is not None:
+            asyncio_loop.add_signal_handler(signal.SIGTERM, io_loop.spawn_callback, self.shutdown, io_loop,
+                                            previous_handler)
+        else:
+            signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(
+                self.shutdown, io_loop, previous_handler))
+
+    @gen.coroutine
+    def shutdown(self, io_loop, previous_handler=None):
+        if self.ioloop_send_events is not None:
+            self.ioloop_send_events.stop()
+        # Flush from a thread so the IOLoop keeps serving the requests in progress
+        shutdown_executor = ThreadPoolExecutor(max_workers=1)
+        yield shutdown_executor.submit(self.close)
+        shutdown_executor.shutdown(wait=False)
+        if callable(previous_handler):
+            previous_handler(signal.SIGTERM, None)
+        else:
+            io_loop.stop()
+
+    def get_stats(self):
+        """Return the counters, queue depth, batch histograms and state of the middleware in a dictionary"""
+        return {
+            'metrics': self.metrics.get_stats(),
+            'event_queue': self.get_event_queue_stats(),
+            'retry': self.get_retry_stats(),
+            'compression': self.get_compression_stats(),
+            'rate_limit': self.get_rate_limit_stats(),
+            'event_workers': self.get_event_worker_stats(),
+            'user_id_cache': self.get_user_id_cache_stats(),
+            'profiles': self.get_profile_stats(),
+            'aggregator': self.get_aggregator_stats(),
+            'config': {
+                'etag': self.config_etag,
+                'fetched': self.config is not None,
+                # Seconds since the configuration was last fetched or confirmed unchanged
+                'age': (datetime.utcnow() - self.last_updated_time).total_seconds(),
+            },
+        }
+
+    def get_event_queue_stats(self):
+        """Return the event queue depth, estimated bytes and drop counters"""
+        return self.moesif_events_queue.get_stats()
+
+    def get_retry_stats(self):
+        """Return the retry buffer and circuit breaker state and counters"""
+        stats = self.retry_buffer.get_stats()
+        stats['circuit_breaker'] = self.circuit_breaker.get_stats()
+        if self.spill_log is not None:
+            stats['spill'] = self.spill_log.get_stats()
+        return stats
+
+    def get_compression_stats(self):
+        """Return the bytes of the batches before and after compression and the time spent compressing"""
+        return self.payload_encoder.get_stats()
+
+    def get_rate_limit_stats(self):
+        """Return the rate limits and the number of batches and time throttled"""
+        return self.rate_limiter.get_stats()
+
+    def get_event_worker_stats(self):
+        """Return the number of events waiting to be built and the drop counter of the event workers"""
+        return self.event_workers.get_stats() if self.event_workers is not None else None
+
+    def get_aggregator_stats(self):
+        """Return the number of batches and events forwarded to the aggregator of the host"""
+        return self.aggregator_client.get_stats() if self.aggregator_client is not None else None
+
+    def get_user_id_cache_stats(self):
+        """Return the size and hit/miss counters of the authorization header cache"""
+        return self.user_id_cache.get_stats() if self.user_id_cache is not None else None
+
+    def get_profile_stats(self):
+        """Return the pending, merged and sent counters of the user and company profile updates"""
+        if self.user_queue is None:
+            return None
+        return {'users': self.user_queue.get_stats(), 'companies': self.company_queue.get_stats()}
+
     def update_user(self, user_profile):
+        """Update a user profile, return a Future resolved once it is sent when PROFILE_UPDATES_ASYNC is enabled"""
+        if self.user_queue is not None:
+            return self.user_queue.put(user_profile)
         self.user.update_user(user_profile, self.api_client, self.DEBUG)
 
     def update_users_batch(self, user_profiles):
         self.user.update_users_batch(user_profiles, self.api_client, self.DEBUG)
 
     def update_company(self, company_profile):
+        """Update a company profile, return a Future resolved once it is sent when PROFILE_UPDATES_ASYNC is enabled"""
+        if self.company_queue is not None:
+            return self.company_queue.put(company_profile)
         self.company.update_company(company_profile, self.api_client, self.DEBUG)
 
     def update_companies_batch(self, companies_profiles):
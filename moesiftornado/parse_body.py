@@ -1,17 +1,19 @@
-import gzip
 import json
 import base64
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
+import zlib
 
 
 class ParseBody:
 
+    # Content types never parsed as JSON, and not partially logged when truncated
+    BINARY_CONTENT_TYPES = ('image/', 'audio/', 'video/', 'font/', 'application/octet-stream', 'application/zip',
+                            'application/gzip', 'application/pdf', 'application/x-protobuf', 'application/grpc')
+
     @classmethod
     def start_with_json(cls, body):
-        return body.startswith("{") or body.startswith("[")
+        # Only look at the first bytes, stripping the whole body would copy it
+        start = body[:64].lstrip()[:1]
+        return start == b'{' or start == b'['
 
     @classmethod
     def transform_headers(cls, headers):
@@ -21,21 +23,55 @@ class ParseBody:
     def base64_body(cls, body):
         return base64.standard_b64encode(body).decode(encoding="UTF-8"), "base64"
 
-    def parse_body(self, body, headers):
+    @classmethod
+    def is_binary(cls, content_type):
+        return content_type.startswith(cls.BINARY_CONTENT_TYPES)
+
+    @classmethod
+    def truncated_body(cls, body, body_size, max_size, content_type):
+        # Marker logged in place of a body larger than the limit, with the beginning of textual bodies
+        truncated_body = {'truncated': True, 'max_size': max_size}
+        if body_size is not None:
+            truncated_body['size'] = body_size
+        if not cls.is_binary(content_type):
+            truncated_body['text'] = body[:max_size].decode('utf-8', 'replace')
+        return truncated_body, 'json'
+
+    @classmethod
+    def gunzip(cls, body, max_size):
+        """Return the decompressed body up to max_size bytes, and whether it was decompressed entirely"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed_body = decompressor.decompress(body, max_size + 1)
+        return decompressed_body[:max_size], len(decompressed_body) <= max_size
+
+    def parse_body(self, body, headers, body_size=None, max_size=1048576):
+        """Return the body to log and its transfer encoding.
+
+        body is bytes, headers a dictionary with lowercase names, and body_size the size of the whole body
+        when body is only the captured beginning of it. A body larger than max_size is replaced by a marker.
+        """
+        body_size = len(body) if body_size is None else body_size
+        content_type = ''
+        content_encoding = ''
+        if headers is not None:
+            content_type = (headers.get('content-type') or '').lower()
+            content_encoding = (headers.get('content-encoding') or '').lower()
+        try:
+            if 'gzip' in content_encoding:
+                decompressed_body, complete = self.gunzip(body, max_size)
+                if not complete or body_size > len(body):
+                    # The size of the whole decompressed body is unknown
+                    return self.truncated_body(decompressed_body, None, max_size, content_type)
+                body = decompressed_body
+                body_size = len(body)
+        except Exception:
+            # Not a valid gzip stream, log the raw bytes
+            pass
+        if body_size > max_size:
+            return self.truncated_body(body, body_size, max_size, content_type)
         try:
-            if self.start_with_json(body):
-                parsed_body = json.loads(body)
-                transfer_encoding = 'json'
-            elif (headers is not None and "content-encoding" in headers and headers["content-encoding"] is not None
-                  and "gzip" in (headers["content-encoding"]).lower()):
-                decompressed_body = gzip.GzipFile(fileobj=StringIO(body)).read()
-                if self.start_with_json(decompressed_body):
-                    parsed_body = json.loads(decompressed_body)
-                    transfer_encoding = 'json'
-                else:
-                    parsed_body, transfer_encoding = self.base64_body(decompressed_body)
-            else:
-                parsed_body, transfer_encoding = self.base64_body(body)
-        except:
-            parsed_body, transfer_encoding = self.base64_body(body)
-        return parsed_body, transfer_encoding
+            if not self.is_binary(content_type) and ('json' in content_type or self.start_with_json(body)):
+                return json.loads(body), 'json'
+        except Exception:
+            pass
+        return self.base64_body(body)
@@ -0,0 +1,83 @@
+from .event_serializer import EventSerializer
+import threading
+import time
+import zlib
+
+
+class PayloadEncoder(object):
+    """Serialize event batches to JSON, and compress the payloads of at least min_size bytes when enabled.
+
+    Reports the bytes before and after compression and the time spent compressing, to tune the level.
+    """
+
+    GZIP = 'gzip'
+    DEFLATE = 'deflate'
+    COMPRESSIONS = (GZIP, DEFLATE)
+
+    def __init__(self, compression=None, level=6, min_size=1024, serializer=None):
+        if compression is not None and compression not in self.COMPRESSIONS:
+            raise Exception('Invalid batch compression: ' + str(compression) +
+                            ', expected one of ' + ', '.join(self.COMPRESSIONS))
+        self.compression = compression
+        self.level = level
+        self.min_size = min_size
+        self.serializer = serializer if serializer is not None else EventSerializer()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.compressed_batches = 0
+        self.payload_bytes = 0
+        self.sent_bytes = 0
+        self.compressed_input_bytes = 0
+        self.compressed_output_bytes = 0
+        self.compression_time = 0.0
+
+    def serialize(self, batch_events):
+        return self.serializer.encode_batch(batch_events)
+
+    def compress(self, payload):
+        if self.compression == self.GZIP:
+            # The gzip format, with a zero modification time so the same batch is compressed to the same bytes
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return compressor.compress(payload) + compressor.flush()
+        # HTTP deflate is the zlib format
+        return zlib.compress(payload, self.level)
+
+    def encode(self, batch_events):
+        """Return the payload of a batch and its Content-Encoding, None when it is not compressed"""
+        payload = self.serialize(batch_events)
+        payload_size = len(payload)
+        content_encoding = None
+        compression_time = 0.0
+        if self.compression is not None and payload_size >= self.min_size:
+            start_time = time.time()
+            payload = self.compress(payload)
+            compression_time = time.time() - start_time
+            content_encoding = self.compression
+        with self.lock:
+            self.batches += 1
+            self.payload_bytes += payload_size
+            self.sent_bytes += len(payload)
+            if content_encoding is not None:
+                self.compressed_batches += 1
+                self.compressed_input_bytes += payload_size
+                self.compressed_output_bytes += len(payload)
+                self.compression_time += compression_time
+        return payload, content_encoding
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'compression': self.compression,
+                'level': self.level,
+                'min_size': self.min_size,
+                'batches': self.batches,
+                'compressed_batches': self.compressed_batches,
+                'payload_bytes': self.payload_bytes,
+                'sent_bytes': self.sent_bytes,
+                # Ratio of the compressed payloads only, uncompressed bytes over compressed bytes
+                'compression_ratio': float(self.compressed_input_bytes) / self.compressed_output_bytes
+                if self.compressed_output_bytes else None,
+                'compression_time': self.compression_time,
+                'avg_compression_time': self.compression_time / self.compressed_batches
+                if self.compressed_batches else None,
+            }
@@ -0,0 +1,72 @@
+from .event_serializer import EventSerializer
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+try:
+    # Faster JSON encoder, used when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ProfileChangeCache(object):
+    """Bounded LRU cache of a digest of the last profile sent per user or company id, with a TTL.
+
+    Digests are computed over the canonical JSON of the profile, with sorted keys, so an update equal to
+    the last one sent for its id within ttl seconds can be skipped.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Profile id -> (digest, expiry time)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.suppressed = 0
+        self.changed = 0
+        self.evictions = 0
+
+    @classmethod
+    def get_digest(cls, profile):
+        if orjson is not None:
+            try:
+                canonical = orjson.dumps(profile, default=EventSerializer.default,
+                                         option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+                return hashlib.blake2b(canonical, digest_size=16).digest()
+            except (TypeError, orjson.JSONEncodeError):
+                pass
+        canonical = json.dumps(profile, default=EventSerializer.default, sort_keys=True, separators=(',', ':'))
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+
+    def is_unchanged(self, profile_id, digest):
+        """Return True if digest is the digest of the last profile sent for profile_id"""
+        with self.lock:
+            entry = self.entries.get(profile_id)
+            if entry is not None:
+                if entry[0] == digest and entry[1] > time.time():
+                    self.entries.move_to_end(profile_id)
+                    self.suppressed += 1
+                    return True
+                # Until the changed profile is sent, the previous one is not the last sent anymore
+                del self.entries[profile_id]
+            self.changed += 1
+            return False
+
+    def put(self, profile_id, digest):
+        with self.lock:
+            self.entries[profile_id] = (digest, time.time() + self.ttl)
+            self.entries.move_to_end(profile_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'suppressed': self.suppressed,
+            'changed': self.changed,
+            'evictions': self.evictions,
+        }
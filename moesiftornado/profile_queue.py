@@ -0,0 +1,202 @@
+from moesifapi.api_helper import APIHelper
+from moesifapi.exceptions.api_exception import APIException
+from concurrent.futures import Future
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+
+class ProfileQueue(object):
+    """Send user or company profile updates from a background thread, merged by id and sent in batches.
+
+    Updates of the same id received within max_time seconds of the first one are merged, later fields
+    replacing earlier ones and metadata merged key by key, and sent together once the window is over or
+    batch_size ids are pending. Each update returns a Future resolved when its batch is sent.
+    With a change_cache, an update equal to the last profile sent for its id resolves to False right away.
+    """
+
+    def __init__(self, id_field, model_class, send_batch, batch_size=100, max_time=1, max_pending=10000,
+                 debug=False, change_cache=None):
+        self.id_field = id_field
+        self.model_class = model_class
+        # Called with a list of models, raises APIException when the batch is not accepted
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.max_time = max_time
+        self.max_pending = max_pending
+        self.debug = debug
+        self.change_cache = change_cache
+        # Pending updates by id, oldest first: [profile, futures, enqueue time, digest of the profile or None]
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.is_running = True
+        self.sending = 0
+        self.merged = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def to_dictionary(self, profile):
+        """Return a copy of the profile as a dictionary, None if it is not a profile"""
+        # The application may change or reuse its profile once the update is queued
+        if isinstance(profile, self.model_class):
+            # Unset fields must not replace the fields of a merged update
+            return copy.deepcopy(dict((name, value) for name, value in profile.to_dictionary().items()
+                                      if value is not None))
+        if isinstance(profile, dict):
+            return copy.deepcopy(profile)
+        try:
+            profile = APIHelper.json_deserialize(profile)
+        except Exception:
+            return None
+        return profile if isinstance(profile, dict) else None
+
+    def merge(self, profile, update):
+        merged = dict(profile)
+        for name, value in update.items():
+            if name == 'metadata' and isinstance(value, dict) and isinstance(merged.get(name), dict):
+                metadata = dict(merged[name])
+                metadata.update(value)
+                value = metadata
+            merged[name] = value
+        return merged
+
+    def put(self, profile):
+        """Queue a profile update and return a Future of its delivery"""
+        future = Future()
+        update = self.to_dictionary(profile)
+        if update is None or update.get(self.id_field) is None:
+            message = 'To update a profile, a ' + self.id_field + ' field is required'
+            print(message)
+            future.set_exception(Exception(message))
+            return future
+        profile_id = update[self.id_field]
+        digest = None
+        if self.change_cache is not None:
+            digest = self.change_cache.get_digest(update)
+            if self.change_cache.is_unchanged(profile_id, digest):
+                future.set_result(False)
+                return future
+        with self.condition:
+            if profile_id in self.pending:
+                entry = self.pending[profile_id]
+                entry[0] = self.merge(entry[0], update)
+                entry[1].append(future)
+                # The digest of the merged profile is computed once it is sent
+                entry[3] = None
+                self.merged += 1
+            elif len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                future.set_exception(Exception('Dropped the profile update as too many updates are pending'))
+                return future
+            else:
+                self.pending[profile_id] = [update, [future], time.time(), digest]
+            if self.thread is None:
+                # Started on the first update, so no thread is running when the server forks its processes
+                self.thread = threading.Thread(target=self.run, name='moesif-profiles')
+                self.thread.daemon = True
+                self.thread.start()
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+        return future
+
+    def next_batch(self, force=False):
+        """Remove and return the updates due, under the condition"""
+        batch = []
+        deadline = time.time() - self.max_time
+        # A full batch is sent without waiting for the window of its updates
+        force = force or len(self.pending) >= self.batch_size
+        while self.pending and len(batch) < self.batch_size:
+            profile_id, entry = next(iter(self.pending.items()))
+            if not force and entry[2] > deadline:
+                break
+            del self.pending[profile_id]
+            batch.append(entry)
+        self.sending += len(batch)
+        return batch
+
+    def run(self):
+        while self.is_running:
+            with self.condition:
+                batch = self.next_batch()
+                if not batch:
+                    # Wake up when the oldest update is due
+                    timeout = self.max_time
+                    if self.pending:
+                        timeout = max(0, next(iter(self.pending.values()))[2] + self.max_time - time.time())
+                    self.condition.wait(timeout)
+                    continue
+            self.send(batch)
+
+    def send(self, batch):
+        try:
+            self.send_batch([self.model_class.from_dictionary(entry[0]) for entry in batch])
+            error = None
+            if self.debug:
+                print('Sent a batch of ' + str(len(batch)) + ' profile updates')
+        except APIException as inst:
+            error = inst
+            if 401 <= inst.response_code <= 403:
+                print("Unauthorized access sending event to Moesif. Please check your Application Id.")
+            if self.debug:
+                print("Error while updating profiles, with status code:")
+                print(inst.response_code)
+        except Exception as ex:
+            error = ex
+            if self.debug:
+                print('Error while updating profiles')
+                print(str(ex))
+        if error is None and self.change_cache is not None:
+            # The profile sent is the merge of the updates of its id, not the last update
+            for entry in batch:
+                digest = entry[3] if entry[3] is not None else self.change_cache.get_digest(entry[0])
+                self.change_cache.put(entry[0][self.id_field], digest)
+        with self.condition:
+            self.sending -= len(batch)
+            if error is None:
+                self.sent += len(batch)
+            else:
+                self.failed += len(batch)
+            self.condition.notify_all()
+        for entry in batch:
+            for future in entry[1]:
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
+
+    def flush(self, timeout):
+        """Send the pending updates now, waiting at most timeout seconds. Return True if none is left"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.condition:
+                batch = self.next_batch(force=True)
+                if not batch:
+                    # Wait for the batch sent by the background thread
+                    while self.sending and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+                    return not self.pending and not self.sending
+            self.send(batch)
+        with self.condition:
+            return not self.pending and not self.sending
+
+    def stop(self):
+        """Stop the background thread, the pending updates are left to flush"""
+        self.is_running = False
+        with self.condition:
+            self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            stats = {
+                'pending': len(self.pending),
+                'merged': self.merged,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+        if self.change_cache is not None:
+            stats['change_cache'] = self.change_cache.get_stats()
+        return stats
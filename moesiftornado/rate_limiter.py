@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """Token buckets limiting the events and bytes sent to Moesif per second, 0 for no limit.
+
+    The buckets hold up to one second of tokens. A batch takes its tokens right away, and the sender waits
+    for the delay returned by reserve before sending it, so batches larger than the buckets are paced too.
+    """
+
+    def __init__(self, events_per_second=0, bytes_per_second=0):
+        self.events_per_second = events_per_second
+        self.bytes_per_second = bytes_per_second
+        self.event_tokens = float(events_per_second)
+        self.byte_tokens = float(bytes_per_second)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+        self.throttled_batches = 0
+        self.throttle_time = 0.0
+
+    def is_enabled(self):
+        return bool(self.events_per_second or self.bytes_per_second)
+
+    def reserve(self, events, size):
+        """Take the tokens of a batch, return the time in seconds to wait before sending it"""
+        if not self.is_enabled():
+            return 0
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.last_time
+            self.last_time = now
+            delay = 0
+            if self.events_per_second:
+                self.event_tokens = min(self.events_per_second,
+                                        self.event_tokens + elapsed * self.events_per_second) - events
+                if self.event_tokens < 0:
+                    delay = -self.event_tokens / self.events_per_second
+            if self.bytes_per_second:
+                self.byte_tokens = min(self.bytes_per_second,
+                                       self.byte_tokens + elapsed * self.bytes_per_second) - size
+                if self.byte_tokens < 0:
+                    delay = max(delay, -self.byte_tokens / self.bytes_per_second)
+            if delay:
+                self.throttled_batches += 1
+                self.throttle_time += delay
+            return delay
+
+    def get_stats(self):
+        return {
+            'events_per_second': self.events_per_second,
+            'bytes_per_second': self.bytes_per_second,
+            'throttled_batches': self.throttled_batches,
+            'throttle_time': self.throttle_time,
+        }
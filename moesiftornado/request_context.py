@@ -0,0 +1,19 @@
+class RequestContext(object):
+    """Per-request values resolved once and shared by sampling, event mapping and masking"""
+
+    __slots__ = ('handler', 'headers', 'event_headers', 'user_id', 'company_id', 'session_token', 'metadata',
+                 'request_time', 'response_time')
+
+    def __init__(self, handler, headers, event_headers, request_time, response_time, user_id=None, company_id=None):
+        self.handler = handler
+        # Request headers with lowercased names, for the lookups of the middleware
+        self.headers = headers
+        # Request headers with their original names, as logged to Moesif
+        self.event_headers = event_headers
+        self.request_time = request_time
+        self.response_time = response_time
+        self.user_id = user_id
+        self.company_id = company_id
+        # Resolved only for the sampled events
+        self.session_token = None
+        self.metadata = None
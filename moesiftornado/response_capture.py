@@ -0,0 +1,47 @@
+from tornado.web import OutputTransform
+
+
+class ResponseBodyCapture(OutputTransform):
+    """Output transform keeping references to the response chunks written by a handler, up to max_size bytes.
+
+    The chunks are only joined and parsed when the event is sampled. Past max_size the capture only counts
+    the bytes written, so large and streaming responses have a bounded cost.
+    """
+
+    def __init__(self, request, max_size=1048576):
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.total_size = 0
+        # Read back when the event of the request is logged
+        request.moesif_response_body = self
+
+    def capture(self, chunk):
+        if not chunk:
+            return
+        self.total_size += len(chunk)
+        remaining = self.max_size - self.size
+        if remaining <= 0:
+            return
+        if len(chunk) > remaining:
+            # Copy only the part within the limit, a reference would keep the whole chunk alive
+            chunk = chunk[:remaining]
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        self.capture(chunk)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        self.capture(chunk)
+        return chunk
+
+    @property
+    def truncated(self):
+        return self.total_size > self.size
+
+    def get_body(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+        return b''.join(self.chunks)
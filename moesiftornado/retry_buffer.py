@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class RetryBuffer(object):
+    """Bounded buffer of failed event batches waiting to be resent with exponential backoff and jitter"""
+
+    def __init__(self, max_batches=100, max_retries=3, backoff_base=1.0, backoff_max=60.0):
+        self.max_batches = max_batches
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Heap of (next attempt time, sequence, batch, attempt)
+        self.batches = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.retried_batches = 0
+        self.dropped_batches = 0
+        self.dropped_events = 0
+
+    @classmethod
+    def is_retryable(cls, status_code):
+        # Connection errors and timeouts have no status code
+        return status_code is None or status_code in (408, 429) or status_code >= 500
+
+    def get_backoff(self, attempt):
+        backoff = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        # Jitter spreads the retries of concurrent senders and processes
+        return random.uniform(backoff / 2, backoff)
+
+    def add(self, batch_events, attempt, status_code):
+        """Schedule a failed batch to be resent, return False if the batch can not be retried"""
+        with self.lock:
+            if not self.is_retryable(status_code) or attempt > self.max_retries \
+                    or len(self.batches) >= self.max_batches:
+                return False
+            heapq.heappush(self.batches, (time.time() + self.get_backoff(attempt), next(self.sequence),
+                                          batch_events, attempt))
+            return True
+
+    def restore(self, batch_events):
+        """Put back a batch taken with drain, it is due immediately"""
+        with self.lock:
+            heapq.heappush(self.batches, (time.time(), next(self.sequence), batch_events, 1))
+
+    def drop(self, batch_events):
+        with self.lock:
+            self.dropped_batches += 1
+            self.dropped_events += len(batch_events)
+
+    def drain(self):
+        """Remove and return all the batches waiting to be resent"""
+        with self.lock:
+            batches = [entry[2] for entry in sorted(self.batches)]
+            self.batches = []
+        return batches
+
+    def pop_due(self):
+        """Return the next batch whose backoff has elapsed along with its attempt number, or (None, 0)"""
+        if not self.batches:
+            return None, 0
+        with self.lock:
+            if self.batches and self.batches[0][0] <= time.time():
+                _, _, batch_events, attempt = heapq.heappop(self.batches)
+                self.retried_batches += 1
+                return batch_events, attempt
+        return None, 0
+
+    def qsize(self):
+        return len(self.batches)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size': len(self.batches),
+                'events': sum(len(entry[2]) for entry in self.batches),
+                'retried_batches': self.retried_batches,
+                'dropped_batches': self.dropped_batches,
+                'dropped_events': self.dropped_events,
+            }
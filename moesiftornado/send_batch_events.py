@@ -1,55 +1,286 @@
+from moesifapi.api_helper import APIHelper
+from moesifapi.configuration import Configuration
+from moesifapi.exceptions.api_exception import APIException
+from moesifapi.http.http_context import HttpContext
+from .adaptive_concurrency import AdaptiveConcurrency
+from .circuit_breaker import CircuitBreaker
+from .retry_buffer import RetryBuffer
+from .payload_encoder import PayloadEncoder
+from .rate_limiter import RateLimiter
+from .metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import threading
+import time
 
 
 class SendEventAsync:
+
+    def __init__(self, max_concurrent_batches=1, retry_buffer=None, circuit_breaker=None, spill_log=None,
+                 payload_encoder=None, aggregator_client=None, batch_max_bytes=None, rate_limiter=None,
+                 metrics=None):
+        self.concurrency = AdaptiveConcurrency(max_concurrent_batches)
+        self.retry_buffer = retry_buffer if retry_buffer is not None else RetryBuffer()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.spill_log = spill_log
+        self.payload_encoder = payload_encoder if payload_encoder is not None else PayloadEncoder()
+        # Batches are forwarded to the aggregator of the host when it is available
+        self.aggregator_client = aggregator_client
+        # Batches are cut by their estimated size as well, and paced by the rate limiter
+        self.batch_max_bytes = batch_max_bytes
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.executor = None
+        self.in_flight = 0
+        self.in_flight_events = 0
+        self.delivered_batches = 0
+        self.delivered_events = 0
+        # The scheduled drain stops taking batches once the sender is stopped
+        self.is_draining = False
+        self.is_stopped = False
+        self.slot_released = threading.Condition()
+
     @classmethod
     def exit_handler(cls, scheduler, debug):
         try:
-            # Shut down the scheduler
+            # Shut down the scheduler, the remaining events are flushed by the caller
             scheduler.remove_job('moesif_events_batch_job')
-            scheduler.shutdown()
+            scheduler.shutdown(wait=False)
         except Exception as ex:
             if debug:
                 print("Error while closing the queue or scheduler shut down")
                 print(str(ex))
 
-    @classmethod
-    def send_events(cls, api_client, batch_events, debug):
+    def acquire_slot(self, events):
+        """Wait for a free slot, return False if the sender was stopped meanwhile"""
+        with self.slot_released:
+            while self.in_flight >= self.concurrency.limit and not self.is_stopped:
+                self.slot_released.wait()
+            if self.is_stopped:
+                return False
+            self.in_flight += 1
+            self.in_flight_events += events
+            return True
+
+    def release_slot(self, latency, success, events):
+        self.concurrency.record(latency, success)
+        with self.slot_released:
+            self.in_flight -= 1
+            self.in_flight_events -= events
+            if success:
+                self.delivered_batches += 1
+                self.delivered_events += events
+            self.slot_released.notify_all()
+
+    def stop(self, timeout):
+        """Stop the scheduled drain, and wait at most timeout seconds for its batches in flight.
+
+        Return the number of events still in flight at the deadline.
+        """
+        deadline = time.time() + timeout
+        with self.slot_released:
+            self.is_stopped = True
+            self.slot_released.notify_all()
+            while (self.is_draining or self.in_flight) and time.time() < deadline:
+                self.slot_released.wait(deadline - time.time())
+            return self.in_flight_events
+
+    def can_replay(self, in_flight_batches, delivered_batches):
+        """Replay spilled events only once a batch of this drain was delivered, and none failed since"""
+        if self.delivered_batches == delivered_batches:
+            # Wait for the batches in flight to know whether Moesif accepts events again
+            for sent_batch in in_flight_batches:
+                sent_batch.result()
+        return self.delivered_batches > delivered_batches and self.circuit_breaker.is_healthy()
+
+    def handle_failure(self, batch_events, attempt, status_code, debug):
+        self.circuit_breaker.record_failure()
+        if self.retry_buffer.add(batch_events, attempt + 1, status_code):
+            if debug:
+                print("Scheduled retry " + str(attempt + 1) + " for a batch of " + str(len(batch_events)) + " events")
+        elif self.spill_log is not None and self.retry_buffer.is_retryable(status_code):
+            # Keep the batch on disk, it is replayed once Moesif accepts events again
+            self.spill_log.append(batch_events)
+        else:
+            self.retry_buffer.drop(batch_events)
+            if debug:
+                print("Dropped a batch of " + str(len(batch_events)) + " events after " + str(attempt + 1) + " attempts")
+
+    def post_events(self, api_client, batch_events):
+        """POST a batch to Moesif and return the response headers, raise APIException for a non 2xx status"""
+        if self.aggregator_client is not None and self.aggregator_client.is_available():
+            try:
+                return self.aggregator_client.send_batch(batch_events)
+            except Exception:
+                # The aggregator is down or its queue is full, send the batch to Moesif directly
+                pass
+        # Same request as create_events_batch, with the payload encoded by the payload encoder in the sender thread
+        payload, content_encoding = self.payload_encoder.encode(batch_events)
+        delay = self.rate_limiter.reserve(len(batch_events), len(payload))
+        if delay:
+            time.sleep(delay)
+        headers = {
+            'content-type': 'application/json; charset=utf-8',
+            'X-Moesif-Application-Id': Configuration.application_id,
+            'User-Agent': Configuration.version,
+        }
+        if content_encoding is not None:
+            headers['Content-Encoding'] = content_encoding
+        self.metrics.record_payload(len(payload))
+        start_time = time.time()
+        try:
+            request = api_client.http_client.post(APIHelper.clean_url(Configuration.BASE_URI + '/v1/events/batch'),
+                                                  headers=headers, parameters=payload)
+            # Invoke the HttpCallBack of the api client like create_events_batch
+            if api_client.http_call_back is not None:
+                api_client.http_call_back.on_before_request(request)
+            response = api_client.http_client.execute_as_string(request)
+            context = HttpContext(request, response)
+            if api_client.http_call_back is not None:
+                api_client.http_call_back.on_after_response(context)
+            api_client.validate_response(context)
+        except APIException as inst:
+            self.metrics.record_batch(len(batch_events), time.time() - start_time, False, inst.response_code)
+            raise
+        except Exception:
+            self.metrics.record_batch(len(batch_events), time.time() - start_time, False)
+            raise
+        self.metrics.record_batch(len(batch_events), time.time() - start_time, True)
+        return response.headers
+
+    def send_events(self, api_client, batch_events, debug, attempt=0):
+        start_time = time.time()
+        success = False
         try:
             if debug:
                 print("Sending events to Moesif")
-            batch_events_api_response = api_client.create_events_batch(batch_events)
+            batch_events_api_response = self.post_events(api_client, batch_events)
+            success = True
+            self.circuit_breaker.record_success()
             if debug:
                 print("Events sent successfully")
             # Fetch Config ETag from response header
             batch_events_response_config_etag = batch_events_api_response.get("X-Moesif-Config-ETag")
             # Return Config Etag
             return batch_events_response_config_etag
+        except APIException as inst:
+            if 401 <= inst.response_code <= 403:
+                print("Unauthorized access sending event to Moesif. Please check your Application Id.")
+            if debug:
+                print("Error sending event to Moesif, with status code:")
+                print(inst.response_code)
+            self.handle_failure(batch_events, attempt, inst.response_code, debug)
+            return None
         except Exception as ex:
             if debug:
                 print("Error sending event to Moesif")
                 print(str(ex))
+            self.handle_failure(batch_events, attempt, None, debug)
             return None
+        finally:
+            self.release_slot(time.time() - start_time, success, len(batch_events))
+
+    def next_batch(self, moesif_events_queue, batch_size):
+        return moesif_events_queue.get_batch(batch_size, self.batch_max_bytes)
 
     def batch_events(self, api_client, moesif_events_queue, debug, batch_size):
-        batch_events = []
+        batch_response = None
+        in_flight_batches = []
+        delivered_batches = self.delivered_batches
+        with self.slot_released:
+            self.is_draining = True
         try:
-            while not moesif_events_queue.empty():
-                batch_events.append(moesif_events_queue.get_nowait())
-                if len(batch_events) == batch_size:
+            if self.spill_log is not None:
+                self.spill_log.flush_pending()
+            # Keep sending full batches until the queue is drained, only the last batch may be partial.
+            # Batches due for a retry are sent first, and spilled events are replayed once the queue is empty
+            # and Moesif accepted a batch of this drain.
+            while not self.is_stopped and self.circuit_breaker.allow_request():
+                batch_events, attempt = self.retry_buffer.pop_due()
+                if batch_events is None:
+                    batch_events = self.next_batch(moesif_events_queue, batch_size)
+                if not batch_events and self.spill_log is not None \
+                        and self.can_replay(in_flight_batches, delivered_batches):
+                    batch_events = self.spill_log.read_batch(batch_size, self.batch_max_bytes)
+                if not batch_events:
+                    # Nothing was sent, do not hold the trial of a half open circuit breaker
+                    self.circuit_breaker.cancel_trial()
                     break
 
-            if batch_events:
-                batch_response = self.send_events(api_client, batch_events, debug)
-                batch_events[:] = []
-                return batch_response, datetime.utcnow()
-            else:
-                if debug:
-                    print("No events to send")
-                # Set the last time event job ran but no message to read from the queue
-                return None, datetime.utcnow()
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.concurrency.max_limit)
+                # Wait for a free slot, up to the adaptive concurrency limit of batches are in flight
+                if not self.acquire_slot(len(batch_events)):
+                    # Stopped while waiting, the batch is flushed or spilled on close
+                    self.retry_buffer.restore(batch_events)
+                    break
+                in_flight_batches.append(self.executor.submit(self.send_events, api_client, batch_events, debug,
+                                                              attempt))
         except:
             if debug:
                 print("No message to read from the queue")
-            # Set the last time event job ran when exception occurred while sending event
-            return None, datetime.utcnow()
+
+        if not in_flight_batches and debug:
+            print("No events to send")
+        try:
+            for sent_batch in in_flight_batches:
+                response_etag = sent_batch.result()
+                if response_etag is not None:
+                    batch_response = response_etag
+        finally:
+            with self.slot_released:
+                self.is_draining = False
+                self.slot_released.notify_all()
+        return batch_response, datetime.utcnow()
+
+    def flush(self, api_client, moesif_events_queue, debug, batch_size, timeout):
+        """Send the queued events and the batches waiting for a retry before the deadline.
+
+        Batches are sent concurrently from daemon threads, ignoring the retry backoff and the circuit breaker.
+        Failed batches are handled like any failed batch. Return the number of events sent and the number
+        of events still in flight at the deadline, whose delivery is unknown.
+        """
+        deadline = time.time() + timeout
+        retry_batches = self.retry_buffer.drain()
+        lock = threading.Lock()
+        counts = {'flushed': 0, 'in_flight': 0}
+
+        def next_flush_batch():
+            with lock:
+                if retry_batches:
+                    return retry_batches.pop(0)
+            return self.next_batch(moesif_events_queue, batch_size)
+
+        def flush_worker():
+            while time.time() < deadline:
+                batch_events = next_flush_batch()
+                if not batch_events:
+                    return
+                with lock:
+                    counts['in_flight'] += len(batch_events)
+                try:
+                    self.post_events(api_client, batch_events)
+                    with lock:
+                        counts['flushed'] += len(batch_events)
+                except APIException as inst:
+                    self.handle_failure(batch_events, 0, inst.response_code, debug)
+                except Exception:
+                    self.handle_failure(batch_events, 0, None, debug)
+                finally:
+                    with lock:
+                        counts['in_flight'] -= len(batch_events)
+
+        workers = [threading.Thread(target=flush_worker, name='moesif-flush') for _ in range(self.concurrency.max_limit)]
+        for worker in workers:
+            # A hung request must not keep the process from exiting
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+
+        # Batches not started before the deadline are kept for the caller
+        for batch_events in retry_batches:
+            self.retry_buffer.restore(batch_events)
+        with lock:
+            return counts['flushed'], counts['in_flight']
+
@@ -0,0 +1,151 @@
+from .event_queue import EventQueue
+from .payload_encoder import PayloadEncoder
+from .event_mapper import EventMapper
+import ipaddress
+import numbers
+
+
+class MoesifSettings(object):
+    """Validated, immutable settings compiled once from the moesif_config dictionary.
+
+    Hooks are resolved to a callable or None, and the authorization header names are pre-split,
+    so the request path only reads attributes.
+    """
+
+    HOOKS = {
+        'skip': 'SKIP',
+        'identify_user': 'IDENTIFY_USER',
+        'identify_company': 'IDENTIFY_COMPANY',
+        'get_metadata': 'GET_METADATA',
+        'get_session_token': 'GET_SESSION_TOKEN',
+        'mask_event_model': 'MASK_EVENT_MODEL',
+    }
+
+    __slots__ = tuple(HOOKS) + (
+        'application_id', 'debug', 'log_body', 'request_body_max_size', 'response_body_max_size', 'api_version', 'base_uri',
+        'authorization_header_names', 'authorization_user_id_field',
+        'authorization_cache_size', 'authorization_cache_ttl', 'trusted_proxies',
+        'batch_size', 'batch_max_time', 'batch_max_bytes', 'oversized_event_policy', 'max_concurrent_batches',
+        'ioloop_delivery', 'rate_limit_events', 'rate_limit_bytes',
+        'batch_compression', 'batch_compression_level', 'batch_compression_min_size',
+        'max_retries', 'retry_buffer_size', 'retry_backoff_base', 'retry_backoff_max',
+        'circuit_breaker_threshold', 'circuit_breaker_cooldown',
+        'event_queue_size', 'event_queue_bytes', 'event_queue_overflow_policy', 'event_queue_block_timeout',
+        'event_workers', 'event_worker_queue_size', 'event_worker_queue_bytes', 'shutdown_timeout', 'flush_batch_size',
+        'spill_directory', 'spill_max_bytes', 'spill_segment_bytes',
+        'aggregator_socket', 'aggregator_timeout', 'config_cache_file', 'config_refresh_interval',
+        'profile_updates_async', 'profile_batch_size', 'profile_batch_max_time', 'profile_queue_size',
+        'profile_change_cache_size', 'profile_change_cache_ttl',
+    )
+
+    def __init__(self, moesif_config):
+        if moesif_config is None or not moesif_config.get('APPLICATION_ID', None):
+            raise Exception('Moesif Application ID is required in settings')
+        self.set('application_id', moesif_config['APPLICATION_ID'])
+        self.set('debug', bool(moesif_config.get('DEBUG', False)))
+        self.set('log_body', bool(moesif_config.get('LOG_BODY', True)))
+        self.set_number(moesif_config, 'REQUEST_BODY_MAX_SIZE', 1048576, 0, True)
+        self.set_number(moesif_config, 'RESPONSE_BODY_MAX_SIZE', 1048576, 0, True)
+        self.set('api_version', moesif_config.get('API_VERSION', None))
+        self.set('base_uri', moesif_config.get('BASE_URI', None) or
+                 moesif_config.get('LOCAL_MOESIF_BASEURL', 'https://api.moesif.net'))
+
+        for name, option in self.HOOKS.items():
+            hook = moesif_config.get(option, None)
+            if hook is not None and not callable(hook):
+                raise Exception('Moesif setting ' + option + ' must be a function')
+            self.set(name, hook)
+
+        auth_header_names = moesif_config.get('AUTHORIZATION_HEADER_NAME', 'authorization')
+        if not isinstance(auth_header_names, str):
+            raise Exception('Moesif setting AUTHORIZATION_HEADER_NAME must be a string')
+        self.set('authorization_header_names',
+                 tuple(name.strip() for name in auth_header_names.lower().split(',') if name.strip()))
+        self.set('authorization_user_id_field', str(moesif_config.get('AUTHORIZATION_USER_ID_FIELD', 'sub')).lower())
+        self.set_number(moesif_config, 'AUTHORIZATION_CACHE_SIZE', 10000, 0, True)
+        self.set_number(moesif_config, 'AUTHORIZATION_CACHE_TTL', 300, 0)
+
+        trusted_proxies = moesif_config.get('TRUSTED_PROXIES', None) or ()
+        if isinstance(trusted_proxies, str):
+            trusted_proxies = trusted_proxies.split(',')
+        try:
+            self.set('trusted_proxies', tuple(ipaddress.ip_network(str(proxy).strip(), strict=False)
+                                              for proxy in trusted_proxies if str(proxy).strip()))
+        except (TypeError, ValueError):
+            raise Exception('Moesif setting TRUSTED_PROXIES must be a list of IP addresses or networks')
+
+        self.set_number(moesif_config, 'BATCH_SIZE', 25, 1, True)
+        self.set_number(moesif_config, 'BATCH_MAX_TIME', 2, 0.001)
+        self.set_number(moesif_config, 'BATCH_MAX_BYTES', 10485760, 1024, True)
+        oversized_event_policy = moesif_config.get('OVERSIZED_EVENT_POLICY', EventMapper.TRUNCATE)
+        if oversized_event_policy not in EventMapper.OVERSIZED_EVENT_POLICIES:
+            raise Exception('Moesif setting OVERSIZED_EVENT_POLICY must be one of ' +
+                            ', '.join(EventMapper.OVERSIZED_EVENT_POLICIES))
+        self.set('oversized_event_policy', oversized_event_policy)
+        self.set_number(moesif_config, 'MAX_CONCURRENT_BATCHES', 4, 1, True)
+        self.set('ioloop_delivery', bool(moesif_config.get('IOLOOP_DELIVERY', False)))
+        self.set_number(moesif_config, 'RATE_LIMIT_EVENTS', 0, 0)
+        self.set_number(moesif_config, 'RATE_LIMIT_BYTES', 0, 0)
+
+        batch_compression = moesif_config.get('BATCH_COMPRESSION', None) or None
+        if batch_compression is not None and batch_compression not in PayloadEncoder.COMPRESSIONS:
+            raise Exception('Moesif setting BATCH_COMPRESSION must be one of ' + ', '.join(PayloadEncoder.COMPRESSIONS))
+        self.set('batch_compression', batch_compression)
+        self.set_number(moesif_config, 'BATCH_COMPRESSION_LEVEL', 6, 1, True)
+        if self.batch_compression_level > 9:
+            raise Exception('Moesif setting BATCH_COMPRESSION_LEVEL must be between 1 and 9')
+        self.set_number(moesif_config, 'BATCH_COMPRESSION_MIN_SIZE', 1024, 0, True)
+
+        self.set_number(moesif_config, 'MAX_RETRIES', 3, 0, True)
+        self.set_number(moesif_config, 'RETRY_BUFFER_SIZE', 100, 0, True)
+        self.set_number(moesif_config, 'RETRY_BACKOFF_BASE', 1, 0)
+        self.set_number(moesif_config, 'RETRY_BACKOFF_MAX', 60, 0)
+        self.set_number(moesif_config, 'CIRCUIT_BREAKER_THRESHOLD', 5, 1, True)
+        self.set_number(moesif_config, 'CIRCUIT_BREAKER_COOLDOWN', 30, 0)
+
+        self.set_number(moesif_config, 'EVENT_QUEUE_SIZE', 100000, 1, True)
+        self.set_number(moesif_config, 'EVENT_QUEUE_BYTES', 104857600, 1, True)
+        overflow_policy = moesif_config.get('EVENT_QUEUE_OVERFLOW_POLICY', EventQueue.DROP_NEWEST)
+        if overflow_policy not in EventQueue.OVERFLOW_POLICIES:
+            raise Exception('Moesif setting EVENT_QUEUE_OVERFLOW_POLICY must be one of ' +
+                            ', '.join(EventQueue.OVERFLOW_POLICIES))
+        self.set('event_queue_overflow_policy', overflow_policy)
+        self.set_number(moesif_config, 'EVENT_QUEUE_BLOCK_TIMEOUT', 0.05, 0)
+
+        self.set_number(moesif_config, 'EVENT_WORKERS', 0, 0, True)
+        self.set_number(moesif_config, 'EVENT_WORKER_QUEUE_SIZE', 10000, 1, True)
+        self.set_number(moesif_config, 'EVENT_WORKER_QUEUE_BYTES', 104857600, 1, True)
+
+        self.set_number(moesif_config, 'SHUTDOWN_TIMEOUT', 5, 0)
+        self.set_number(moesif_config, 'FLUSH_BATCH_SIZE', max(self.batch_size, 100), 1, True)
+
+        self.set('spill_directory', moesif_config.get('SPILL_DIRECTORY', None) or None)
+        self.set_number(moesif_config, 'SPILL_MAX_BYTES', 268435456, 1, True)
+        self.set_number(moesif_config, 'SPILL_SEGMENT_BYTES', 16777216, 1, True)
+
+        self.set('aggregator_socket', moesif_config.get('AGGREGATOR_SOCKET', None) or None)
+        self.set_number(moesif_config, 'AGGREGATOR_TIMEOUT', 5, 0.001)
+
+        self.set('config_cache_file', moesif_config.get('CONFIG_CACHE_FILE', None) or None)
+        self.set_number(moesif_config, 'CONFIG_REFRESH_INTERVAL', 300, 0)
+
+        self.set('profile_updates_async', bool(moesif_config.get('PROFILE_UPDATES_ASYNC', True)))
+        self.set_number(moesif_config, 'PROFILE_BATCH_SIZE', 100, 1, True)
+        self.set_number(moesif_config, 'PROFILE_BATCH_MAX_TIME', 1, 0)
+        self.set_number(moesif_config, 'PROFILE_QUEUE_SIZE', 10000, 1, True)
+        self.set_number(moesif_config, 'PROFILE_CHANGE_CACHE_SIZE', 0, 0, True)
+        self.set_number(moesif_config, 'PROFILE_CHANGE_CACHE_TTL', 3600, 0)
+
+    def set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def set_number(self, moesif_config, option, default, minimum, integer=False):
+        value = moesif_config.get(option, default)
+        if isinstance(value, bool) or not isinstance(value, numbers.Real) \
+                or (integer and not isinstance(value, numbers.Integral)) or value < minimum:
+            raise Exception('Moesif setting ' + option + ' must be ' + ('an integer' if integer else 'a number') +
+                            ' greater than or equal to ' + str(minimum))
+        self.set(option.lower(), value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MoesifSettings is immutable')
@@ -0,0 +1,339 @@
+from .event_serializer import EventSerializer
+import errno
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+class SpillLog(object):
+    """Append-only spill of events on disk, rotated in segments, bounded in size and replayed with mmap.
+
+    Each segment starts with the 8 byte magic header ``MOESIF01`` followed by records. A record is the
+    4 byte big-endian length of the payload, the 4 byte big-endian CRC32 of the payload and the payload,
+    a JSON serialized event. Reading a segment stops at the first truncated or corrupt record.
+
+    A segment is named ``segment-<time in ns>-<pid>`` and its suffix tracks its state: ``.open`` while a
+    process appends to it, ``.seg`` once closed, and ``.replay-<pid>`` while a process replays it.
+    Segments left by processes that are no longer running are recovered as closed segments, when a process
+    starts using the spill and when it runs out of segments to replay or of space. The spill may be created
+    before the server forks its processes, each process takes it over on first use.
+    Events are replayed at least once, a segment is removed only after all of its events were read.
+    """
+
+    MAGIC = b'MOESIF01'
+    RECORD_HEADER = struct.Struct('>II')
+
+    def __init__(self, directory, max_bytes=268435456, segment_bytes=16777216, max_pending_bytes=16777216,
+                 debug=False, serializer=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        # Estimated bytes of the events buffered until the next bulk write
+        self.max_pending_bytes = max_pending_bytes
+        self.debug = debug
+        self.serializer = serializer if serializer is not None else EventSerializer()
+        # Process using the spill, set on first use by start_process
+        self.pid = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.active_path = None
+        self.active_file = None
+        self.active_bytes = 0
+        self.reader_path = None
+        self.reader_file = None
+        self.reader_mmap = None
+        self.reader_offset = 0
+        self.spilled_events = 0
+        self.replayed_events = 0
+        self.dropped_events = 0
+        self.evicted_segments = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.total_bytes = self.get_total_bytes()
+
+    def start_process(self):
+        """Take over the spill in the current process on first use, and recover the segments of stopped processes"""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        if self.pid is not None:
+            # Forked from the process using the spill, its segments and buffered events stay with the parent
+            for spill_file in (self.reader_mmap, self.reader_file, self.active_file):
+                try:
+                    if spill_file is not None:
+                        spill_file.close()
+                except Exception:
+                    pass
+            self.active_path = self.active_file = self.reader_path = self.reader_file = self.reader_mmap = None
+            self.active_bytes = 0
+            self.pending = []
+            self.pending_bytes = 0
+            # Locks held by a thread of the parent when it forked are never released in this process
+            self.pending_lock = threading.Lock()
+            self.write_lock = threading.Lock()
+            self.read_lock = threading.Lock()
+        self.pid = pid
+        self.recover()
+        self.total_bytes = self.get_total_bytes()
+
+    @classmethod
+    def is_process_alive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as ex:
+            return ex.errno == errno.EPERM
+        return True
+
+    def list_segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+
+    def recover(self):
+        # Release the segments of processes which stopped while appending to or replaying them
+        recovered = False
+        for name in self.list_segments():
+            base, _, state = name.partition('.')
+            if state == 'seg':
+                continue
+            owner = base.rsplit('-', 1)[-1] if state == 'open' else state.split('-', 1)[-1]
+            try:
+                if int(owner) != self.pid and not self.is_process_alive(int(owner)):
+                    os.rename(os.path.join(self.directory, name), os.path.join(self.directory, base + '.seg'))
+                    recovered = True
+            except (ValueError, OSError):
+                pass
+        return recovered
+
+    def get_total_bytes(self):
+        total_bytes = 0
+        for name in self.list_segments():
+            try:
+                total_bytes += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return total_bytes
+
+    def add(self, event, size=0):
+        """Buffer an event of size estimated bytes to spill, cheap enough for the request path.
+
+        Return False if it was dropped.
+        """
+        self.start_process()
+        with self.pending_lock:
+            if self.pending_bytes + size > self.max_pending_bytes:
+                self.dropped_events += 1
+                return False
+            self.pending.append(event)
+            self.pending_bytes += size
+            return True
+
+    def flush_pending(self):
+        """Write the buffered events to disk in bulk"""
+        self.start_process()
+        with self.pending_lock:
+            events, self.pending = self.pending, []
+            self.pending_bytes = 0
+        if events:
+            self.append(events)
+
+    def evict(self, required_bytes):
+        # Remove the oldest closed segments until the new records fit, with the segments of stopped processes
+        self.recover()
+        for name in self.list_segments():
+            if self.total_bytes + required_bytes <= self.max_bytes:
+                break
+            if not name.endswith('.seg'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                segment_size = os.path.getsize(path)
+                os.remove(path)
+                self.total_bytes -= segment_size
+                self.evicted_segments += 1
+            except OSError:
+                pass
+
+    def rotate(self):
+        if self.active_file is not None:
+            self.active_file.close()
+            os.rename(self.active_path, self.active_path[:-len('.open')] + '.seg')
+            self.active_file = None
+            self.active_path = None
+            self.active_bytes = 0
+        # Closing a segment is a good time to refresh the size accounting of segments of other processes
+        self.total_bytes = self.get_total_bytes()
+
+    def open_segment(self):
+        self.active_path = os.path.join(self.directory,
+                                        'segment-%020d-%d.open' % (int(time.time() * 1e9), self.pid))
+        self.active_file = open(self.active_path, 'ab')
+        self.active_file.write(self.MAGIC)
+        self.active_bytes = len(self.MAGIC)
+        self.total_bytes += len(self.MAGIC)
+
+    def append(self, events):
+        """Serialize and append events in a single write, without fsync"""
+        self.start_process()
+        try:
+            records = []
+            for event in events:
+                payload = self.serializer.encode_event(event)
+                records.append(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+                records.append(payload)
+            data = b''.join(records)
+            with self.write_lock:
+                if self.active_file is not None and self.active_bytes >= self.segment_bytes:
+                    self.rotate()
+                if self.total_bytes + len(data) > self.max_bytes:
+                    self.evict(len(data))
+                if self.total_bytes + len(data) > self.max_bytes:
+                    self.dropped_events += len(events)
+                    if self.debug:
+                        print('Dropped ' + str(len(events)) + ' events as the spill directory is full')
+                    return False
+                if self.active_file is None:
+                    self.open_segment()
+                self.active_file.write(data)
+                self.active_file.flush()
+                self.active_bytes += len(data)
+                self.total_bytes += len(data)
+                self.spilled_events += len(events)
+            return True
+        except Exception as ex:
+            self.dropped_events += len(events)
+            if self.debug:
+                print('Error while spilling events to disk')
+                print(str(ex))
+            return False
+
+    def open_next_segment(self):
+        closed_segments = [name for name in self.list_segments() if name.endswith('.seg')]
+        if not closed_segments and self.recover():
+            closed_segments = [name for name in self.list_segments() if name.endswith('.seg')]
+        if not closed_segments:
+            # Close the segment being appended to so its events can be replayed
+            with self.write_lock:
+                if self.active_file is None or self.active_bytes <= len(self.MAGIC):
+                    return False
+                self.rotate()
+            closed_segments = [name for name in self.list_segments() if name.endswith('.seg')]
+
+        for name in closed_segments:
+            path = os.path.join(self.directory, name)
+            reader_path = path[:-len('.seg')] + '.replay-' + str(self.pid)
+            try:
+                # Claim the segment, another process may replay it first
+                os.rename(path, reader_path)
+            except OSError:
+                continue
+            reader_file = open(reader_path, 'rb')
+            if os.fstat(reader_file.fileno()).st_size <= len(self.MAGIC):
+                reader_file.close()
+                self.remove_segment(reader_path)
+                continue
+            self.reader_path = reader_path
+            self.reader_file = reader_file
+            self.reader_mmap = mmap.mmap(reader_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.reader_mmap[:len(self.MAGIC)] != self.MAGIC:
+                if self.debug:
+                    print('Skipped spill segment with an unknown format: ' + name)
+                self.close_segment()
+                continue
+            self.reader_offset = len(self.MAGIC)
+            return True
+        return False
+
+    def next_record_size(self):
+        if self.reader_offset + self.RECORD_HEADER.size > len(self.reader_mmap):
+            return None
+        return self.RECORD_HEADER.unpack_from(self.reader_mmap, self.reader_offset)[0]
+
+    def read_record(self):
+        record_start = self.reader_offset + self.RECORD_HEADER.size
+        if record_start > len(self.reader_mmap):
+            return None
+        length, checksum = self.RECORD_HEADER.unpack_from(self.reader_mmap, self.reader_offset)
+        if record_start + length > len(self.reader_mmap):
+            return None
+        payload = self.reader_mmap[record_start:record_start + length]
+        if zlib.crc32(payload) & 0xffffffff != checksum:
+            return None
+        self.reader_offset = record_start + length
+        return payload
+
+    def remove_segment(self, path):
+        try:
+            segment_size = os.path.getsize(path)
+            os.remove(path)
+            with self.write_lock:
+                self.total_bytes -= segment_size
+        except OSError:
+            pass
+
+    def close_segment(self):
+        self.reader_mmap.close()
+        self.reader_file.close()
+        self.remove_segment(self.reader_path)
+        self.reader_mmap = None
+        self.reader_file = None
+        self.reader_path = None
+
+    def read_batch(self, max_events, max_bytes=None):
+        """Return up to max_events spilled events as dictionaries, and up to max_bytes of JSON, oldest first"""
+        self.start_process()
+        events = []
+        batch_bytes = 0
+        with self.read_lock:
+            try:
+                while len(events) < max_events:
+                    if self.reader_mmap is None and not self.open_next_segment():
+                        break
+                    if max_bytes is not None and events:
+                        record_size = self.next_record_size()
+                        if record_size is not None and batch_bytes + record_size > max_bytes:
+                            break
+                    payload = self.read_record()
+                    if payload is None:
+                        self.close_segment()
+                        continue
+                    batch_bytes += len(payload)
+                    events.append(json.loads(payload.decode('utf-8')))
+            except Exception as ex:
+                if self.debug:
+                    print('Error while replaying events from disk')
+                    print(str(ex))
+            self.replayed_events += len(events)
+        return events
+
+    def close(self):
+        self.flush_pending()
+        with self.write_lock:
+            if self.active_file is not None:
+                self.rotate()
+        with self.read_lock:
+            if self.reader_mmap is not None:
+                # Keep the unread events of the segment for the next process
+                self.reader_mmap.close()
+                self.reader_file.close()
+                os.rename(self.reader_path, self.reader_path.rsplit('.', 1)[0] + '.seg')
+                self.reader_mmap = None
+                self.reader_file = None
+                self.reader_path = None
+
+    def get_stats(self):
+        return {
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'pending': len(self.pending),
+            'pending_bytes': self.pending_bytes,
+            'spilled_events': self.spilled_events,
+            'replayed_events': self.replayed_events,
+            'dropped_events': self.dropped_events,
+            'evicted_segments': self.evicted_segments,
+        }
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+class UserIdCache(object):
+    """Bounded LRU cache of the user id resolved from an authorization header, with a TTL.
+
+    Entries are keyed by a digest of the header value, the raw tokens are not kept in memory.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Digest of the header value -> (user id, expiry time)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def get_key(cls, token):
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return hashlib.blake2b(token, digest_size=16).digest()
+
+    def get(self, key):
+        """Return (True, user id) for a cached header, (False, None) otherwise"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, user_id):
+        with self.lock:
+            self.entries[key] = (user_id, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,56 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+from moesiftornado.aggregator import EventAggregator
+from moesiftornado.aggregator_client import AggregatorClient
+
+
+class EventAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'aggregator.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start(self, moesif_config):
+        aggregator = EventAggregator(dict(moesif_config, APPLICATION_ID='app'), self.socket_path)
+        aggregator.bind()
+        aggregator.is_running = True
+
+        def serve():
+            connection, _ = aggregator.server.accept()
+            aggregator.handle_connection(connection)
+
+        handler = threading.Thread(target=serve)
+        handler.daemon = True
+        handler.start()
+        self.addCleanup(aggregator.server.close)
+        return aggregator
+
+    def test_socket_is_only_accessible_to_the_user(self):
+        self.start({})
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+    def test_batch_is_rejected_when_the_queue_is_full(self):
+        aggregator = self.start({'EVENT_QUEUE_SIZE': 3})
+        client = AggregatorClient(self.socket_path)
+        self.addCleanup(client.disconnect)
+        client.send_batch([{'i': 0}, {'i': 1}])
+        self.assertRaises(Exception, client.send_batch, [{'i': 2}, {'i': 3}])
+        # None of the events of a rejected batch are queued, and the connection is kept
+        self.assertEqual(aggregator.middleware.moesif_events_queue.get_batch(10), [b'{"i":0}', b'{"i":1}'])
+        self.assertIsNotNone(client.connection)
+        client.send_batch([{'i': 2}, {'i': 3}])
+        stats = aggregator.get_stats()
+        self.assertEqual((stats['received_batches'], stats['rejected_batches'], stats['rejected_events']), (2, 1, 2))
+        self.assertEqual(client.get_stats()['rejected_batches'], 1)
+        aggregator.middleware.moesif_events_queue.get_batch(10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import time
+import unittest
+from moesiftornado.circuit_breaker import CircuitBreaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+        for _ in range(2):
+            circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertFalse(circuit_breaker.is_healthy())
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(circuit_breaker.is_open())
+        self.assertFalse(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.get_stats()['open_count'], 1)
+
+    def test_success_resets_the_failures(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2)
+        circuit_breaker.record_failure()
+        circuit_breaker.record_success()
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.is_healthy())
+
+    def test_single_trial_after_the_cooldown(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow_request())
+        time.sleep(0.06)
+        self.assertFalse(circuit_breaker.is_open())
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one batch is sent while half open
+        self.assertFalse(circuit_breaker.allow_request())
+        circuit_breaker.cancel_trial()
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_success()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(circuit_breaker.allow_request())
+
+    def test_failed_trial_opens_again(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=5, cooldown=0.05)
+        for _ in range(5):
+            circuit_breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.get_stats()['open_count'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
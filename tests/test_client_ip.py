@@ -0,0 +1,70 @@
+import ipaddress
+import unittest
+from moesiftornado.client_ip import ClientIp
+
+
+class ClientIpTest(unittest.TestCase):
+
+    PROXY = '10.0.0.2'
+
+    def setUp(self):
+        self.client_ip = ClientIp()
+        self.trusted_client_ip = ClientIp([ipaddress.ip_network('10.0.0.0/8'), ipaddress.ip_network('fd00::/8')])
+
+    def test_left_most_address_without_trusted_proxies(self):
+        headers = {'x-forwarded-for': 'unknown, 203.0.113.7, 10.0.0.1'}
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, {'x-client-ip': '198.51.100.1'}), '198.51.100.1')
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, {}), self.PROXY)
+
+    def test_header_priority_without_trusted_proxies(self):
+        headers = {'x-real-ip': '198.51.100.2', 'x-forwarded-for': '203.0.113.7', 'x-client-ip': 'unknown'}
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+
+    def test_spoofed_headers_are_ignored_behind_trusted_proxies(self):
+        headers = {'x-client-ip': '1.1.1.1', 'true-client-ip': '1.1.1.1', 'x-real-ip': '1.1.1.1',
+                   'x-forwarded-for': '203.0.113.7'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+        # Without a forwarding chain the request is attributed to the proxy
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, {'x-client-ip': '1.1.1.1'}), self.PROXY)
+
+    def test_spoofed_chain_is_walked_from_the_right(self):
+        # The client sent X-Forwarded-For: 1.2.3.4, its own address was appended by the trusted proxy
+        headers = {'x-forwarded-for': '1.2.3.4, 203.0.113.7, 10.0.0.1'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+
+    def test_untrusted_remote_is_the_client(self):
+        headers = {'x-forwarded-for': '203.0.113.7', 'x-client-ip': '1.1.1.1'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip('198.51.100.9', headers), '198.51.100.9')
+        self.assertEqual(self.trusted_client_ip.get_client_ip(None, headers), None)
+
+    def test_all_trusted_chain_resolves_to_the_left_most_address(self):
+        headers = {'x-forwarded-for': '10.1.1.1, 10.0.0.1'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '10.1.1.1')
+
+    def test_unknown_entries_behind_trusted_proxies(self):
+        # An address left of an entry which is not an address cannot be verified
+        headers = {'x-forwarded-for': '203.0.113.7, unknown, 10.0.0.1'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), self.PROXY)
+        headers = {'x-forwarded-for': 'unknown, 203.0.113.7, 10.0.0.1'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+
+    def test_ipv6_addresses_with_brackets_and_ports(self):
+        headers = {'x-forwarded-for': '[2001:db8:cafe::17]:4711, [fd00::1]:80'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip('fd00::2', headers), '2001:db8:cafe::17')
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, {'x-forwarded-for': '203.0.113.7:8080'}),
+                         '203.0.113.7')
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, {'x-client-ip': '2001:db8::1'}), '2001:db8::1')
+
+    def test_forwarded_header(self):
+        headers = {'forwarded': 'for=1.2.3.4, for="[2001:db8:cafe::17]:4711";proto=https, for=10.0.0.1;by=10.0.0.2'}
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '2001:db8:cafe::17')
+        self.assertEqual(self.client_ip.get_client_ip(self.PROXY, {'forwarded': 'For=192.0.2.60;proto=http'}),
+                         '192.0.2.60')
+        # X-Forwarded-For comes first
+        headers['x-forwarded-for'] = '203.0.113.7'
+        self.assertEqual(self.trusted_client_ip.get_client_ip(self.PROXY, headers), '203.0.113.7')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+from moesiftornado.event_queue import EventQueue
+
+
+class EventQueueTest(unittest.TestCase):
+
+    def test_drop_newest(self):
+        event_queue = EventQueue(max_size=2, overflow_policy=EventQueue.DROP_NEWEST)
+        self.assertTrue(event_queue.put('a', 10))
+        self.assertTrue(event_queue.put('b', 10))
+        self.assertFalse(event_queue.put('c', 10))
+        self.assertEqual(event_queue.get_batch(10), ['a', 'b'])
+        stats = event_queue.get_stats()
+        self.assertEqual((stats['dropped_newest'], stats['dropped_oldest'], stats['dropped_bytes']), (1, 0, 10))
+
+    def test_drop_oldest(self):
+        event_queue = EventQueue(max_size=2, overflow_policy=EventQueue.DROP_OLDEST)
+        for event in ('a', 'b', 'c'):
+            self.assertTrue(event_queue.put(event, 10))
+        self.assertEqual(event_queue.get_batch(10), ['b', 'c'])
+        stats = event_queue.get_stats()
+        self.assertEqual((stats['dropped_newest'], stats['dropped_oldest'], stats['dropped']), (0, 1, 1))
+
+    def test_byte_limit(self):
+        event_queue = EventQueue(max_size=100, max_bytes=100)
+        self.assertTrue(event_queue.put('a', 60))
+        self.assertFalse(event_queue.put('b', 60))
+        self.assertTrue(event_queue.put('c', 40))
+        self.assertEqual(event_queue.get_stats()['bytes'], 100)
+        # An event larger than the whole buffer is dropped, whatever the policy
+        event_queue = EventQueue(max_bytes=100, overflow_policy=EventQueue.DROP_OLDEST)
+        self.assertTrue(event_queue.put('a', 60))
+        self.assertFalse(event_queue.put('b', 101))
+        self.assertEqual(event_queue.qsize(), 1)
+
+    def test_drop_oldest_frees_enough_bytes(self):
+        event_queue = EventQueue(max_bytes=100, overflow_policy=EventQueue.DROP_OLDEST)
+        for event in ('a', 'b', 'c'):
+            event_queue.put(event, 30)
+        self.assertTrue(event_queue.put('d', 70))
+        self.assertEqual(event_queue.get_batch(10), ['c', 'd'])
+        self.assertEqual(event_queue.get_stats()['bytes'], 0)
+
+    def test_block_waits_for_room(self):
+        event_queue = EventQueue(max_size=1, overflow_policy=EventQueue.BLOCK, block_timeout=5)
+        event_queue.put('a')
+        consumer = threading.Timer(0.05, event_queue.get_batch, (1,))
+        consumer.start()
+        start_time = time.time()
+        self.assertTrue(event_queue.put('b'))
+        self.assertLess(time.time() - start_time, 5)
+        consumer.join()
+        self.assertEqual(event_queue.get_batch(10), ['b'])
+
+    def test_block_drops_after_the_timeout(self):
+        event_queue = EventQueue(max_size=1, overflow_policy=EventQueue.BLOCK, block_timeout=0.05)
+        event_queue.put('a')
+        start_time = time.time()
+        self.assertFalse(event_queue.put('b'))
+        self.assertGreaterEqual(time.time() - start_time, 0.04)
+        self.assertEqual(event_queue.get_stats()['dropped_newest'], 1)
+
+    def test_get_batch_by_bytes(self):
+        event_queue = EventQueue()
+        for event, size in (('a', 40), ('b', 40), ('c', 40)):
+            event_queue.put(event, size)
+        self.assertEqual(event_queue.get_batch(10, 100), ['a', 'b'])
+        self.assertEqual(event_queue.get_batch(10, 10), ['c'])
+        self.assertTrue(event_queue.empty())
+
+    def test_invalid_policy(self):
+        self.assertRaises(Exception, EventQueue, overflow_policy='drop_all')
+
+
+if __name__ == '__main__':
+    unittest.main()
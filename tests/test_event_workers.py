@@ -0,0 +1,42 @@
+import threading
+import unittest
+from moesiftornado.event_workers import EventWorkers
+
+
+class EventWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.built = []
+
+    def build(self, value):
+        self.release.wait(5)
+        self.built.append(value)
+
+    def test_pending_calls_are_bounded_by_bytes(self):
+        event_workers = EventWorkers(1, max_pending=100, max_pending_bytes=1000)
+        self.assertTrue(event_workers.submit(600, self.build, 1))
+        self.assertTrue(event_workers.submit(400, self.build, 2))
+        self.assertFalse(event_workers.submit(1, self.build, 3))
+        self.assertEqual(event_workers.get_stats()['pending_bytes'], 1000)
+        self.release.set()
+        self.assertTrue(event_workers.wait(5))
+        stats = event_workers.get_stats()
+        self.assertEqual((stats['pending_bytes'], stats['processed'], stats['dropped']), (0, 2, 1))
+        self.assertEqual(self.built, [1, 2])
+        self.assertTrue(event_workers.submit(1000, self.build, 4))
+        self.assertTrue(event_workers.wait(5))
+        event_workers.shutdown()
+
+    def test_pending_calls_are_bounded_by_count(self):
+        event_workers = EventWorkers(1, max_pending=2, max_pending_bytes=1000)
+        self.assertTrue(event_workers.submit(1, self.build, 1))
+        self.assertTrue(event_workers.submit(1, self.build, 2))
+        self.assertFalse(event_workers.submit(1, self.build, 3))
+        self.release.set()
+        self.assertTrue(event_workers.wait(5))
+        event_workers.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
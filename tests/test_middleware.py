@@ -0,0 +1,45 @@
+import os
+import threading
+import unittest
+from moesiftornado.middleware import MoesifMiddleware
+
+
+class ConfigRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.middleware = MoesifMiddleware({'APPLICATION_ID': 'app'})
+        self.started = []
+        self.refreshed = threading.Event()
+        # Record the starts instead of fetching the configuration
+        self.middleware.refresh_config = self.refresh_config
+
+    def refresh_config(self):
+        self.started.append(os.getpid())
+        self.refreshed.set()
+
+    def test_refresh_is_started_once(self):
+        self.middleware.start_config_refresh()
+        self.middleware.start_config_refresh()
+        self.assertTrue(self.refreshed.wait(5))
+        self.middleware.start_config_refresh()
+        self.assertEqual(self.started, [os.getpid()])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_refresh_is_started_again_in_a_forked_process(self):
+        self.middleware.start_config_refresh()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            started = not self.middleware.is_config_refresh_started
+            self.middleware.start_config_refresh()
+            started = started and self.middleware.config_pid == os.getpid()
+            os.write(write_fd, b'1' if started else b'0')
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 1), b'1')
+        os.close(read_fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from moesifapi.models import UserModel
+from moesiftornado.profile_cache import ProfileChangeCache
+from moesiftornado.profile_queue import ProfileQueue
+
+
+class ProfileQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.error = None
+
+    def send_batch(self, models):
+        if self.error is not None:
+            raise self.error
+        self.batches.append([model.to_dictionary() for model in models])
+
+    def make_queue(self, batch_size=100, max_time=60, max_pending=10000, change_cache=None):
+        profile_queue = ProfileQueue('user_id', UserModel, self.send_batch, batch_size, max_time, max_pending,
+                                     change_cache=change_cache)
+        self.addCleanup(profile_queue.stop)
+        return profile_queue
+
+    def test_updates_of_the_same_id_are_merged(self):
+        profile_queue = self.make_queue()
+        first = profile_queue.put({'user_id': '1', 'ip_address': '10.0.0.1', 'metadata': {'a': 1, 'b': 1}})
+        second = profile_queue.put(UserModel(user_id='1', metadata={'b': 2, 'c': 3}))
+        other = profile_queue.put({'user_id': '2'})
+        self.assertTrue(profile_queue.flush(5))
+        self.assertEqual(len(self.batches), 1)
+        profiles = dict((profile['user_id'], profile) for profile in self.batches[0])
+        self.assertEqual(profiles['1']['ip_address'], '10.0.0.1')
+        self.assertEqual(profiles['1']['metadata'], {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(sorted(profiles), ['1', '2'])
+        for future in (first, second, other):
+            self.assertIs(future.result(1), True)
+        stats = profile_queue.get_stats()
+        self.assertEqual((stats['merged'], stats['sent'], stats['pending']), (1, 2, 0))
+
+    def test_full_batch_is_sent_by_the_background_thread(self):
+        profile_queue = self.make_queue(batch_size=2)
+        profile_queue.put({'user_id': '1'})
+        future = profile_queue.put({'user_id': '2'})
+        self.assertIs(future.result(5), True)
+        self.assertEqual([sorted(profile['user_id'] for profile in batch) for batch in self.batches], [['1', '2']])
+
+    def test_update_is_sent_after_the_window(self):
+        profile_queue = self.make_queue(max_time=0.05)
+        self.assertIs(profile_queue.put({'user_id': '1'}).result(5), True)
+
+    def test_failed_batch_sets_the_exception(self):
+        profile_queue = self.make_queue()
+        self.error = Exception('unavailable')
+        future = profile_queue.put({'user_id': '1'})
+        profile_queue.flush(5)
+        self.assertEqual(str(future.exception(1)), 'unavailable')
+        self.assertEqual(profile_queue.get_stats()['failed'], 1)
+
+    def test_invalid_and_dropped_updates(self):
+        profile_queue = self.make_queue(max_pending=1)
+        self.assertIsNotNone(profile_queue.put({'company_id': '1'}).exception(1))
+        self.assertIsNotNone(profile_queue.put('not a profile').exception(1))
+        profile_queue.put({'user_id': '1'})
+        self.assertIsNotNone(profile_queue.put({'user_id': '2'}).exception(1))
+        self.assertEqual(profile_queue.get_stats()['dropped'], 1)
+        # An update of a pending id is merged
+        self.assertFalse(profile_queue.put({'user_id': '1'}).done())
+
+    def test_profile_is_copied(self):
+        profile_queue = self.make_queue()
+        profile = {'user_id': '1', 'metadata': {'plan': 'free'}}
+        profile_queue.put(profile)
+        profile['user_id'] = '2'
+        profile['metadata']['plan'] = 'paid'
+        metadata = {'plan': 'free'}
+        profile_queue.put(UserModel(user_id='3', metadata=metadata))
+        metadata['plan'] = 'paid'
+        profile_queue.flush(5)
+        self.assertEqual(sorted((profile['user_id'], profile['metadata']['plan']) for profile in self.batches[0]),
+                         [('1', 'free'), ('3', 'free')])
+
+    def test_json_profile(self):
+        profile_queue = self.make_queue()
+        profile_queue.put('{"user_id": "1", "metadata": {"a": 1}}')
+        profile_queue.flush(5)
+        self.assertEqual(self.batches[0][0]['metadata'], {'a': 1})
+
+    def test_unchanged_profile_is_skipped(self):
+        profile_queue = self.make_queue(change_cache=ProfileChangeCache())
+        profile_queue.put({'user_id': '1', 'metadata': {'a': 1}})
+        profile_queue.flush(5)
+        self.assertIs(profile_queue.put({'metadata': {'a': 1}, 'user_id': '1'}).result(1), False)
+        self.assertFalse(profile_queue.put({'user_id': '1', 'metadata': {'a': 2}}).done())
+
+    def test_change_cache_holds_the_merged_profile_sent(self):
+        profile_queue = self.make_queue(change_cache=ProfileChangeCache())
+        profile_queue.put({'user_id': '1', 'ip_address': '10.0.0.1'})
+        profile_queue.put({'user_id': '1', 'metadata': {'a': 1}})
+        profile_queue.flush(5)
+        # Only the merged profile was sent, the last update alone was not
+        self.assertFalse(profile_queue.put({'user_id': '1', 'metadata': {'a': 1}}).done())
+        profile_queue.flush(5)
+        self.assertIs(profile_queue.put({'user_id': '1', 'metadata': {'a': 1}}).result(1), False)
+        self.assertEqual(len(self.batches), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
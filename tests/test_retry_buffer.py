@@ -0,0 +1,52 @@
+import time
+import unittest
+from moesiftornado.retry_buffer import RetryBuffer
+
+
+class RetryBufferTest(unittest.TestCase):
+
+    def test_backoff_grows_exponentially_with_jitter(self):
+        retry_buffer = RetryBuffer(backoff_base=1, backoff_max=60)
+        for attempt, backoff in ((1, 1), (2, 2), (3, 4), (4, 8), (10, 60)):
+            for _ in range(20):
+                self.assertTrue(backoff / 2.0 <= retry_buffer.get_backoff(attempt) <= backoff)
+
+    def test_retryable_status_codes(self):
+        for status_code in (None, 408, 429, 500, 502, 503):
+            self.assertTrue(RetryBuffer.is_retryable(status_code))
+        for status_code in (400, 401, 403, 404, 413):
+            self.assertFalse(RetryBuffer.is_retryable(status_code))
+
+    def test_batch_is_due_after_its_backoff(self):
+        retry_buffer = RetryBuffer(backoff_base=0.05)
+        self.assertTrue(retry_buffer.add(['a'], 1, 503))
+        self.assertEqual(retry_buffer.pop_due(), (None, 0))
+        time.sleep(0.06)
+        self.assertEqual(retry_buffer.pop_due(), (['a'], 1))
+        self.assertEqual(retry_buffer.get_stats()['retried_batches'], 1)
+
+    def test_batch_is_not_retried(self):
+        retry_buffer = RetryBuffer(max_batches=1, max_retries=2)
+        self.assertFalse(retry_buffer.add(['a'], 1, 401))
+        self.assertFalse(retry_buffer.add(['a'], 3, 503))
+        self.assertTrue(retry_buffer.add(['a'], 2, None))
+        # The buffer is full
+        self.assertFalse(retry_buffer.add(['b'], 1, 503))
+        retry_buffer.drop(['b', 'c'])
+        stats = retry_buffer.get_stats()
+        self.assertEqual((stats['size'], stats['events'], stats['dropped_batches'], stats['dropped_events']),
+                         (1, 1, 1, 2))
+
+    def test_drain_and_restore(self):
+        retry_buffer = RetryBuffer(backoff_base=60)
+        retry_buffer.add(['a'], 1, 503)
+        retry_buffer.add(['b'], 3, 503)
+        self.assertEqual(sorted(retry_buffer.drain()), [['a'], ['b']])
+        self.assertEqual(retry_buffer.qsize(), 0)
+        # A restored batch is due immediately
+        retry_buffer.restore(['a'])
+        self.assertEqual(retry_buffer.pop_due(), (['a'], 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
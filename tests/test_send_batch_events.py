@@ -0,0 +1,51 @@
+import unittest
+from moesifapi.controllers.api_controller import ApiController
+from moesifapi.http.http_call_back import HttpCallBack
+from moesifapi.http.http_response import HttpResponse
+from moesifapi.http.requests_client import RequestsClient
+from moesiftornado.send_batch_events import SendEventAsync
+
+
+class FakeHttpClient(RequestsClient):
+
+    def __init__(self, status_code):
+        super(FakeHttpClient, self).__init__()
+        self.status_code = status_code
+        self.requests = []
+
+    def execute_as_string(self, request):
+        self.requests.append(request)
+        return HttpResponse(self.status_code, {'X-Moesif-Config-ETag': 'etag'}, '')
+
+
+class RecordingCallBack(HttpCallBack):
+
+    def __init__(self):
+        self.calls = []
+
+    def on_before_request(self, request):
+        self.calls.append(('before', request.query_url))
+
+    def on_after_response(self, context):
+        self.calls.append(('after', context.response.status_code))
+
+
+class SendEventAsyncTest(unittest.TestCase):
+
+    def test_http_call_back_of_the_api_client_is_invoked(self):
+        call_back = RecordingCallBack()
+        api_client = ApiController(FakeHttpClient(201), call_back)
+        headers = SendEventAsync().post_events(api_client, [{'request': {}, 'response': {}}])
+        self.assertEqual(headers['X-Moesif-Config-ETag'], 'etag')
+        self.assertEqual([call[0] for call in call_back.calls], ['before', 'after'])
+        self.assertTrue(call_back.calls[0][1].endswith('/v1/events/batch'))
+        self.assertEqual(call_back.calls[1][1], 201)
+        # The response is also passed to the call back when Moesif rejects the batch
+        call_back.calls = []
+        api_client = ApiController(FakeHttpClient(500), call_back)
+        self.assertRaises(Exception, SendEventAsync().post_events, api_client, [{}])
+        self.assertEqual(call_back.calls[1], ('after', 500))
+
+
+if __name__ == '__main__':
+    unittest.main()
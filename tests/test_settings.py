@@ -0,0 +1,82 @@
+import ipaddress
+import unittest
+from moesiftornado.settings import MoesifSettings
+
+
+class MoesifSettingsTest(unittest.TestCase):
+
+    def get_error(self, moesif_config):
+        with self.assertRaises(Exception) as context:
+            MoesifSettings(moesif_config)
+        return str(context.exception)
+
+    def test_defaults(self):
+        settings = MoesifSettings({'APPLICATION_ID': 'app'})
+        self.assertEqual(settings.application_id, 'app')
+        self.assertEqual(settings.authorization_header_names, ('authorization',))
+        self.assertEqual(settings.authorization_user_id_field, 'sub')
+        self.assertIsNone(settings.identify_user)
+        self.assertEqual(settings.batch_size, 25)
+        self.assertEqual(settings.flush_batch_size, 100)
+        self.assertEqual(settings.trusted_proxies, ())
+
+    def test_compiled_values(self):
+        identify_user = lambda handler: 'user'
+        settings = MoesifSettings({
+            'APPLICATION_ID': 'app',
+            'IDENTIFY_USER': identify_user,
+            'AUTHORIZATION_HEADER_NAME': 'X-Api-Key, Authorization,',
+            'AUTHORIZATION_USER_ID_FIELD': 'User_Id',
+            'TRUSTED_PROXIES': '10.0.0.0/8, 192.168.1.1',
+            'BATCH_SIZE': 200,
+        })
+        self.assertIs(settings.identify_user, identify_user)
+        self.assertEqual(settings.authorization_header_names, ('x-api-key', 'authorization'))
+        self.assertEqual(settings.authorization_user_id_field, 'user_id')
+        self.assertEqual(settings.trusted_proxies, (ipaddress.ip_network('10.0.0.0/8'),
+                                                    ipaddress.ip_network('192.168.1.1/32')))
+        self.assertEqual(settings.flush_batch_size, 200)
+
+    def test_immutable(self):
+        settings = MoesifSettings({'APPLICATION_ID': 'app'})
+        with self.assertRaises(AttributeError):
+            settings.batch_size = 10
+
+    def test_application_id_is_required(self):
+        self.assertIn('Application ID is required', self.get_error({}))
+        self.assertIn('Application ID is required', self.get_error({'APPLICATION_ID': ''}))
+        self.assertRaises(Exception, MoesifSettings, None)
+
+    def test_hooks_must_be_functions(self):
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'SKIP': True}),
+                         'Moesif setting SKIP must be a function')
+
+    def test_numbers_are_validated(self):
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'BATCH_SIZE': 0}),
+                         'Moesif setting BATCH_SIZE must be an integer greater than or equal to 1')
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'BATCH_SIZE': 2.5}),
+                         'Moesif setting BATCH_SIZE must be an integer greater than or equal to 1')
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'BATCH_MAX_TIME': '2'}),
+                         'Moesif setting BATCH_MAX_TIME must be a number greater than or equal to 0.001')
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'EVENT_QUEUE_SIZE': True}),
+                         'Moesif setting EVENT_QUEUE_SIZE must be an integer greater than or equal to 1')
+        self.assertIn('BATCH_COMPRESSION_LEVEL', self.get_error({'APPLICATION_ID': 'app',
+                                                                 'BATCH_COMPRESSION_LEVEL': 10}))
+
+    def test_choices_are_validated(self):
+        self.assertIn('EVENT_QUEUE_OVERFLOW_POLICY must be one of',
+                      self.get_error({'APPLICATION_ID': 'app', 'EVENT_QUEUE_OVERFLOW_POLICY': 'drop'}))
+        self.assertIn('BATCH_COMPRESSION must be one of',
+                      self.get_error({'APPLICATION_ID': 'app', 'BATCH_COMPRESSION': 'br'}))
+        self.assertIn('OVERSIZED_EVENT_POLICY must be one of',
+                      self.get_error({'APPLICATION_ID': 'app', 'OVERSIZED_EVENT_POLICY': 'drop'}))
+
+    def test_strings_are_validated(self):
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'AUTHORIZATION_HEADER_NAME': ['authorization']}),
+                         'Moesif setting AUTHORIZATION_HEADER_NAME must be a string')
+        self.assertEqual(self.get_error({'APPLICATION_ID': 'app', 'TRUSTED_PROXIES': ['proxy.local']}),
+                         'Moesif setting TRUSTED_PROXIES must be a list of IP addresses or networks')
+
+
+if __name__ == '__main__':
+    unittest.main()
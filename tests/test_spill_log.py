@@ -0,0 +1,138 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from moesiftornado.spill_log import SpillLog
+
+
+class SpillLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get_segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def get_dead_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def write_segment(self, name, events):
+        spill_log = SpillLog(tempfile.mkdtemp())
+        spill_log.append(events)
+        spill_log.close()
+        segment = os.listdir(spill_log.directory)[0]
+        shutil.move(os.path.join(spill_log.directory, segment), os.path.join(self.directory, name))
+        shutil.rmtree(spill_log.directory)
+
+    def test_events_are_replayed_in_order(self):
+        spill_log = SpillLog(self.directory, segment_bytes=100)
+        for i in range(5):
+            self.assertTrue(spill_log.append([{'i': i * 2}, {'i': i * 2 + 1}]))
+        self.assertGreater(len(self.get_segments()), 1)
+        self.assertEqual([event['i'] for event in spill_log.read_batch(4)], [0, 1, 2, 3])
+        self.assertEqual([event['i'] for event in spill_log.read_batch(100)], list(range(4, 10)))
+        self.assertEqual(spill_log.read_batch(100), [])
+        self.assertEqual(self.get_segments(), [])
+        stats = spill_log.get_stats()
+        self.assertEqual((stats['spilled_events'], stats['replayed_events'], stats['bytes']), (10, 10, 0))
+
+    def test_segment_format(self):
+        spill_log = SpillLog(self.directory)
+        spill_log.append([{'a': 1}])
+        spill_log.close()
+        segment, = self.get_segments()
+        self.assertTrue(segment.endswith('-%d.seg' % os.getpid()))
+        with open(os.path.join(self.directory, segment), 'rb') as segment_file:
+            data = segment_file.read()
+        payload = b'{"a":1}'
+        self.assertEqual(data[:8], SpillLog.MAGIC)
+        self.assertEqual(SpillLog.RECORD_HEADER.unpack(data[8:16])[0], len(payload))
+        self.assertEqual(data[16:], payload)
+
+    def test_replay_stops_at_a_corrupt_record(self):
+        spill_log = SpillLog(self.directory)
+        spill_log.append([{'i': 0}, {'i': 1}, {'i': 2}])
+        spill_log.close()
+        path = os.path.join(self.directory, self.get_segments()[0])
+        with open(path, 'r+b') as segment_file:
+            # Flip a byte of the payload of the second record
+            segment_file.seek(8 + 2 * SpillLog.RECORD_HEADER.size + len(b'{"i":0}') + 2)
+            segment_file.write(b'9')
+        self.assertEqual(SpillLog(self.directory).read_batch(100), [{'i': 0}])
+        self.assertEqual(self.get_segments(), [])
+
+    def test_replay_stops_at_a_truncated_record(self):
+        spill_log = SpillLog(self.directory)
+        spill_log.append([{'i': 0}, {'i': 1}])
+        spill_log.close()
+        path = os.path.join(self.directory, self.get_segments()[0])
+        with open(path, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(path) - 2)
+        self.assertEqual(SpillLog(self.directory).read_batch(100), [{'i': 0}])
+
+    def test_size_cap_evicts_the_oldest_segments(self):
+        spill_log = SpillLog(self.directory, max_bytes=200, segment_bytes=50)
+        for i in range(10):
+            self.assertTrue(spill_log.append([{'i': i, 'data': 'x' * 20}]))
+        self.assertLessEqual(spill_log.get_total_bytes(), 200)
+        self.assertGreater(spill_log.get_stats()['evicted_segments'], 0)
+        self.assertEqual(spill_log.read_batch(100)[-1]['i'], 9)
+        # A batch larger than the cap is dropped
+        self.assertFalse(spill_log.append([{'data': 'x' * 300}]))
+        self.assertEqual(spill_log.get_stats()['dropped_events'], 1)
+
+    def test_pending_events_are_bounded_by_bytes(self):
+        spill_log = SpillLog(self.directory, max_pending_bytes=100)
+        self.assertTrue(spill_log.add({'i': 0}, 60))
+        self.assertFalse(spill_log.add({'i': 1}, 60))
+        self.assertEqual(spill_log.get_stats()['pending_bytes'], 60)
+        spill_log.flush_pending()
+        self.assertEqual(spill_log.get_stats()['pending_bytes'], 0)
+        self.assertTrue(spill_log.add({'i': 2}, 60))
+        spill_log.flush_pending()
+        self.assertEqual(spill_log.read_batch(100), [{'i': 0}, {'i': 2}])
+
+    def test_segments_of_stopped_processes_are_recovered(self):
+        pid = self.get_dead_pid()
+        self.write_segment('segment-%020d-%d.open' % (1, pid), [{'i': 0}])
+        self.write_segment('segment-%020d-%d.replay-%d' % (2, os.getpid() + 1, pid), [{'i': 1}])
+        # A segment appended to by a running process is left alone
+        self.write_segment('segment-%020d-%d.open' % (3, os.getppid()), [{'i': 2}])
+        self.assertEqual(SpillLog(self.directory).read_batch(100), [{'i': 0}, {'i': 1}])
+        self.assertEqual(self.get_segments(), ['segment-%020d-%d.open' % (3, os.getppid())])
+
+    def test_segments_of_stopped_processes_are_evicted(self):
+        spill_log = SpillLog(self.directory, max_bytes=200)
+        spill_log.append([{'i': 0}])
+        self.write_segment('segment-%020d-%d.open' % (1, self.get_dead_pid()), [{'data': 'x' * 100}])
+        spill_log.rotate()
+        self.assertTrue(spill_log.append([{'data': 'y' * 100}]))
+        self.assertEqual(spill_log.get_stats()['evicted_segments'], 1)
+        events = spill_log.read_batch(100)
+        self.assertEqual(events[0], {'i': 0})
+        self.assertEqual(events[1], {'data': 'y' * 100})
+        self.assertEqual(len(events), 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_forked_process_uses_its_own_segments(self):
+        spill_log = SpillLog(self.directory)
+        spill_log.append([{'i': 0}])
+        pid = os.fork()
+        if pid == 0:
+            # Exit without closing the spill, as a worker killed
+            spill_log.append([{'i': 1}])
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertTrue(any(name.endswith('-%d.open' % pid) for name in self.get_segments()))
+        self.assertEqual(sorted(event['i'] for event in spill_log.read_batch(100)), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()